@@ -10,6 +10,7 @@ import tensorflow.keras.layers as kl
 from tqdm import tqdm
 
 from model import PolicyWithValue
+from util import compute_returns
 
 
 @ray.remote(num_cpus=1)
@@ -94,13 +95,17 @@ def learn(num_agents=5, env_name="CartPole-v1", gamma=0.98, entropy_coef=0.01,
             [agent.collect_trajectory.remote() for agent in agents])
 
         #: mixed n-step return の計算
-        for trajectory in trajectories:
-            trajectory["R"] = [0] * trajectory_length
-            value, _ = policy(np.atleast_2d(trajectory["s2"][-1]))
-            R = value[0][0].numpy()
-            for i in reversed(range(trajectory_length)):
-                R = trajectory["r"][i] + gamma * (1 - trajectory["dones"][i]) * R
-                trajectory["R"][i] = R
+        #: 全agentの最終状態の価値を1回のforwardで評価してbootstrapする
+        last_values, _ = policy(
+            np.array([trajectory["s2"][-1] for trajectory in trajectories], dtype=np.float32))
+
+        mb_returns = compute_returns(
+            np.array([trajectory["r"] for trajectory in trajectories]),
+            np.array([trajectory["dones"] for trajectory in trajectories]),
+            gamma, last_values.numpy())
+
+        for trajectory, returns in zip(trajectories, mb_returns):
+            trajectory["R"] = returns.tolist()
 
         #: trajectoriesをまとめる
         (states, actions, next_states, rewards,
@@ -0,0 +1,105 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from models import ActorCriticNet
+
+
+#: CPUにはfloat16の畳み込みカーネルがなく極端に遅くなるので、float16はGPUがあるときだけ計測する
+MIXED_PRECISIONS = [None, "bfloat16"] + (
+    ["float16"] if tf.config.experimental.list_physical_devices("GPU") else [])
+
+
+def random_frames(n, uint8):
+
+    frames = np.random.randint(0, 256, size=(n, 84, 84, 4)).astype(np.uint8)
+
+    return frames if uint8 else (frames / 255).astype(np.float32)
+
+
+def measure(func, n_iters):
+
+    #: 初回のtraceは計測から除く
+    func()
+
+    start = time.time()
+
+    for _ in range(n_iters):
+        func()
+
+    return n_iters / (time.time() - start)
+
+
+def benchmark_update(n_iters=50, batch_size=75):
+    """float32と mixed precision (uint8入力) で1回の勾配ステップのスループットを比べる
+        batch_sizeはn_procs=15, TRAJECTORY_SIZE=5 のときの1回のupdateに相当
+    """
+    selected_actions = np.random.randint(4, size=(batch_size, 1))
+
+    discounted_rewards = np.random.normal(size=(batch_size, 1)).astype(np.float32)
+
+    results = {}
+
+    for mixed_precision in MIXED_PRECISIONS:
+
+        acnet = ActorCriticNet(action_space=4, mixed_precision=mixed_precision)
+
+        states = random_frames(batch_size, uint8=mixed_precision is not None)
+
+        results[mixed_precision] = measure(
+            lambda: acnet.update(states, selected_actions, discounted_rewards), n_iters)
+
+    for mixed_precision, updates_per_sec in results.items():
+        print(f"update {mixed_precision or 'float32':<10}{updates_per_sec:>8.1f} updates/sec,",
+              f"{updates_per_sec / results[None]:.2f}x")
+
+    return results
+
+
+def benchmark_inference(n_iters=50, batch_size=256):
+    """同じ重みでのforwardのスループットと、float32に対するvalue・行動確率の誤差
+    """
+    frames = random_frames(batch_size, uint8=True)
+
+    base = ActorCriticNet(action_space=4)
+
+    base_values, base_logits = base.predict(frames / np.float32(255))
+
+    base_probs = np.exp(base_logits) / np.exp(base_logits).sum(axis=1, keepdims=True)
+
+    results = {}
+
+    for mixed_precision in MIXED_PRECISIONS:
+
+        acnet = ActorCriticNet(action_space=4, mixed_precision=mixed_precision)
+
+        inputs = frames if mixed_precision is not None else frames / np.float32(255)
+
+        acnet.predict(inputs)
+        acnet.set_weights(base.get_weights())
+
+        values, logits = acnet.predict(inputs)
+
+        probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+
+        results[mixed_precision] = measure(lambda: acnet.predict(inputs), n_iters)
+
+        print(f"forward {mixed_precision or 'float32':<10}"
+              f"{results[mixed_precision] * batch_size:>10.0f} states/sec,",
+              f"{results[mixed_precision] / results[None]:.2f}x,",
+              f"max |ΔV| {np.abs(values - base_values).max():.2e},",
+              f"max |Δπ| {np.abs(probs - base_probs).max():.2e}")
+
+    return results
+
+
+def main():
+
+    benchmark_inference()
+
+    benchmark_update()
+
+
+if __name__ == "__main__":
+    main()
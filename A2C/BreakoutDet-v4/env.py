@@ -19,19 +19,26 @@ class Step:
     info: dict
 
 
-def preprocess(frame):
+def preprocess(frame, uint8=False):
+    """
+        uint8=Trueなら0-255のuint8のまま返し、[0, 1]への正規化はネットワーク内で行う
+    """
 
     frame = Image.fromarray(frame)
     frame = frame.convert("L")
     frame = frame.crop((0, 20, 160, 210))
     frame = frame.resize((84, 84))
+
+    if uint8:
+        return np.array(frame, dtype=np.uint8)
+
     frame = np.array(frame, dtype=np.float32)
     frame = frame / 255
 
     return frame
 
 
-def workerfunc(conn, env_func):
+def workerfunc(conn, env_func, uint8=False):
 
     NUM_FRAMES = 4
 
@@ -49,18 +56,18 @@ def workerfunc(conn, env_func):
 
         if cmd == 'step':
             frame, reward, done, info = env.step(action)
-            frame = preprocess(frame)
+            frame = preprocess(frame, uint8)
             frames.append(frame)
 
             if done:
                 frame = env.reset()
-                frame = preprocess(frame)
+                frame = preprocess(frame, uint8)
                 for _ in range(NUM_FRAMES):
                     frames.append(frame)
 
                 for _ in range(random.randint(0, 10)):
                     frame, _, _, _ = env.step(FIRE_ACTION)
-                    frame = preprocess(frame)
+                    frame = preprocess(frame, uint8)
                     frames.append(frame)
 
             elif info["ale.lives"] != lives:
@@ -73,7 +80,7 @@ def workerfunc(conn, env_func):
         elif cmd == 'reset':
             frame = env.reset()
 
-            frame = preprocess(frame)
+            frame = preprocess(frame, uint8)
             for _ in range(NUM_FRAMES):
                 frames.append(frame)
 
@@ -93,7 +100,7 @@ def workerfunc(conn, env_func):
 
 class SubProcVecEnv:
 
-    def __init__(self, env_funcs):
+    def __init__(self, env_funcs, uint8=False):
 
         self.closed = False
 
@@ -105,7 +112,7 @@ class SubProcVecEnv:
 
         self.worker_conns = [pipe[1] for pipe in pipes]
 
-        self.workers = [Process(target=workerfunc, args=(worker_conn, env_func))
+        self.workers = [Process(target=workerfunc, args=(worker_conn, env_func, uint8))
                         for (worker_conn, env_func)
                         in zip(self.worker_conns, env_funcs)]
 
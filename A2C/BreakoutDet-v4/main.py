@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 
 from env import SubProcVecEnv, preprocess
 from models import ActorCriticNet
+from util import compute_returns
 
 
 def envfunc_proto(env_id):
@@ -28,11 +29,16 @@ class A2CAgent:
 
     ACTION_SPACE = 4
 
-    def __init__(self, n_procs, gamma=0.99, weights=None):
+    def __init__(self, n_procs, gamma=0.99, weights=None, mixed_precision=None):
 
         self.n_procs = n_procs
 
-        self.ACNet = ActorCriticNet(action_space=self.ACTION_SPACE)
+        #: None (float32), "float16", "bfloat16"
+        #: mixed precisionではフレームをuint8のまま扱い、ネットワーク内で正規化する
+        self.uint8_frames = mixed_precision is not None
+
+        self.ACNet = ActorCriticNet(action_space=self.ACTION_SPACE,
+                                    mixed_precision=mixed_precision)
 
         if weights:
             pass
@@ -41,7 +47,7 @@ class A2CAgent:
 
         self.vecenv = SubProcVecEnv(
             [functools.partial(envfunc_proto, env_id=i)
-             for i in range(self.n_procs)])
+             for i in range(self.n_procs)], uint8=self.uint8_frames)
 
         self.states = None
 
@@ -120,29 +126,11 @@ class A2CAgent:
         """
         last_values, _ = self.ACNet.predict(self.states)
 
-        mb_discounted_rewards = np.zeros(mb_rewards.shape)
-        for n, (rewards, dones, last_value) in enumerate(zip(mb_rewards, mb_dones, last_values.flatten())):
-            rewards = rewards.tolist()
-            dones = dones.tolist()
-
-            discounted_rewards = self.discount_with_dones(rewards, dones, last_value)
-            mb_discounted_rewards[n] = discounted_rewards
+        mb_discounted_rewards = compute_returns(
+            mb_rewards, mb_dones, self.gamma, last_values)
 
         return (mb_states, mb_actions, mb_discounted_rewards)
 
-    def discount_with_dones(self, rewards, dones, last_value):
-
-        R = 0 if dones[-1] else last_value
-
-        discounted_rewards = []
-        for r, done in zip(reversed(rewards), reversed(dones)):
-            R = r + (not done) * self.gamma * R
-            discounted_rewards.append(R)
-
-        discounted_rewards.reverse()
-
-        return discounted_rewards
-
     def save_model(self):
 
         self.ACNet.save_weights("checkpoints/best")
@@ -164,7 +152,7 @@ class A2CAgent:
 
         for i in range(n):
 
-            frame = preprocess(env.reset())
+            frame = preprocess(env.reset(), self.uint8_frames)
 
             frames = collections.deque(maxlen=4)
 
@@ -182,7 +170,7 @@ class A2CAgent:
 
                 frame, reward, done, _ = env.step(action[0])
 
-                frames.append(preprocess(frame))
+                frames.append(preprocess(frame, self.uint8_frames))
 
                 total_reward += reward
 
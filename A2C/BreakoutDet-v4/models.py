@@ -7,6 +7,8 @@ import tensorflow.keras.layers as kl
 import tensorflow_probability as tfp
 import numpy as np
 
+from util import mixed_precision_policy, loss_scale_optimizer, normalize_frames
+
 
 class ActorCriticNet(tf.keras.Model):
 
@@ -16,36 +18,44 @@ class ActorCriticNet(tf.keras.Model):
 
     MAX_GRAD_NORM = 0.5
 
-    def __init__(self, action_space, lr=0.00005):
+    def __init__(self, action_space, lr=0.00005, mixed_precision=None):
 
         super(ActorCriticNet, self).__init__()
 
         self.action_space = action_space
 
+        self.mixed_precision = mixed_precision
+
+        #: mixed precisionでは中間層をfloat16/bfloat16で計算し、logits (softmax) とvalueの出力層だけfloat32に戻す
+        dtype = mixed_precision_policy(mixed_precision)
+
         self.conv1 = kl.Conv2D(32, 8, strides=4, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
 
         self.conv2 = kl.Conv2D(64, 4, strides=2, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
 
         self.conv3 = kl.Conv2D(64, 3, strides=1, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
 
-        self.flat1 = kl.Flatten()
+        self.flat1 = kl.Flatten(dtype=dtype)
 
         self.dense1 = kl.Dense(512, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
 
         self.logits = kl.Dense(self.action_space,
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype="float32")
 
-        self.values = kl.Dense(1, kernel_initializer="he_normal")
+        self.values = kl.Dense(1, kernel_initializer="he_normal", dtype="float32")
 
-        self.optimizer = tf.keras.optimizers.Adam(lr=lr)
+        self.optimizer = loss_scale_optimizer(
+            tf.keras.optimizers.Adam(lr=lr), mixed_precision)
 
     @tf.function
     def call(self, x):
 
+        x = normalize_frames(x)
+
         x = self.conv1(x)
 
         x = self.conv2(x)
@@ -62,9 +72,19 @@ class ActorCriticNet(tf.keras.Model):
 
         return values, logits
 
+    def to_tensor(self, states):
+        """uint8のフレームはuint8のまま渡す (正規化はcallの中)
+        """
+        states = np.atleast_2d(states)
+
+        if states.dtype != np.uint8:
+            states = states.astype(np.float32)
+
+        return tf.convert_to_tensor(states)
+
     def sample_action(self, states):
 
-        states = tf.convert_to_tensor(np.atleast_2d(states), dtype=tf.float32)
+        states = self.to_tensor(states)
 
         _, logits = self(states)
 
@@ -78,7 +98,7 @@ class ActorCriticNet(tf.keras.Model):
 
     def predict(self, states):
 
-        states = tf.convert_to_tensor(np.atleast_2d(states), dtype=tf.float32)
+        states = self.to_tensor(states)
 
         values, logits = self(states)
 
@@ -113,7 +133,15 @@ class ActorCriticNet(tf.keras.Model):
 
             total_loss = tf.reduce_mean(policy_loss + self.VALUE_COEF * value_loss)
 
-        grads = tape.gradient(total_loss, self.trainable_variables)
+            if self.mixed_precision == "float16":
+                scaled_loss = self.optimizer.get_scaled_loss(total_loss)
+
+        if self.mixed_precision == "float16":
+            grads = self.optimizer.get_unscaled_gradients(
+                tape.gradient(scaled_loss, self.trainable_variables))
+        else:
+            grads = tape.gradient(total_loss, self.trainable_variables)
+
         grads, grad_norm = tf.clip_by_global_norm(grads, self.MAX_GRAD_NORM)
         self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
 
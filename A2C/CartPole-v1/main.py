@@ -12,6 +12,7 @@ import matplotlib.pyplot as plt
 
 from env import SubProcVecEnv
 from models import ActorCriticNet
+from util import compute_returns
 
 
 def envfunc_proto(env_id):
@@ -117,29 +118,11 @@ class A2CAgent:
         """
         last_values, _ = self.ACNet.predict(self.states)
 
-        mb_discounted_rewards = np.zeros(mb_rewards.shape)
-        for n, (rewards, dones, last_value) in enumerate(zip(mb_rewards, mb_dones, last_values.flatten())):
-            rewards = rewards.tolist()
-            dones = dones.tolist()
-
-            discounted_rewards = self.discount_with_dones(rewards, dones, last_value)
-            mb_discounted_rewards[n] = discounted_rewards
+        mb_discounted_rewards = compute_returns(
+            mb_rewards, mb_dones, self.gamma, last_values)
 
         return (mb_states, mb_actions, mb_discounted_rewards)
 
-    def discount_with_dones(self, rewards, dones, last_value):
-
-        R = 0 if dones[-1] else last_value
-
-        discounted_rewards = []
-        for r, done in zip(reversed(rewards), reversed(dones)):
-            R = r + (not done) * self.gamma * R
-            discounted_rewards.append(R)
-
-        discounted_rewards.reverse()
-
-        return discounted_rewards
-
     def save_model(self):
 
         self.ACNet.save_weights("checkpoints/best")
@@ -0,0 +1,83 @@
+import numpy as np
+import tensorflow as tf
+
+
+def discounted_cumsum(x, discounts, initial=None):
+    """y[:, t] = x[:, t] + discounts[:, t] * y[:, t+1] を時間方向に逆順で計算する (pure NumPy)
+
+        x, discounts: (n_envs, T)
+        initial: (n_envs,) y[:, T]に相当するbootstrap値, Noneなら0
+        pythonのループは時間方向のみで、env方向はまとめて計算する
+    """
+    n_envs, T = x.shape
+
+    y = np.zeros((n_envs, T), dtype=np.float32)
+
+    last = np.zeros(n_envs, dtype=np.float32) if initial is None else initial
+
+    for t in reversed(range(T)):
+        last = x[:, t] + discounts[:, t] * last
+        y[:, t] = last
+
+    return y
+
+
+@tf.function
+def discounted_cumsum_tf(x, discounts, initial):
+    """discounted_cumsumのtf.scan版 (グラフ内で完結させたいとき用)
+    """
+    #: (n_envs, T) -> (T, n_envs)
+    elems = (tf.transpose(x), tf.transpose(discounts))
+
+    y = tf.scan(lambda acc, elem: elem[0] + elem[1] * acc,
+                elems, initializer=initial, reverse=True)
+
+    return tf.transpose(y)
+
+
+def _discounted_cumsum(x, discounts, initial, use_tf):
+
+    x = x.astype(np.float32)
+
+    discounts = discounts.astype(np.float32)
+
+    if initial is None:
+        initial = np.zeros(x.shape[0], dtype=np.float32)
+    else:
+        initial = np.asarray(initial, dtype=np.float32).reshape(x.shape[0])
+
+    if use_tf:
+        return discounted_cumsum_tf(x, discounts, initial).numpy()
+    else:
+        return discounted_cumsum(x, discounts, initial)
+
+
+def compute_gae(rewards, values, next_values, dones, gamma, lam, use_tf=False):
+    """Generalized Advantage Estimation (GAE, 2016)
+
+        入力はすべて (n_envs, T)
+        戻り値はadvantageと価値関数のターゲット (advantage + value)
+    """
+    is_nonterminals = 1 - np.asarray(dones, dtype=np.float32)
+
+    deltas = rewards + gamma * is_nonterminals * next_values - values
+
+    advantages = _discounted_cumsum(
+        deltas, gamma * lam * is_nonterminals, None, use_tf)
+
+    return advantages, advantages + values
+
+
+def compute_returns(rewards, dones, gamma, last_values=None, use_tf=False):
+    """doneで打ち切る割引報酬和
+
+        rewards, dones: (n_envs, T)
+        last_values: (n_envs,) 最終ステップの次状態の価値でbootstrapする
+    """
+    is_nonterminals = 1 - np.asarray(dones, dtype=np.float32)
+
+    if last_values is not None:
+        last_values = np.asarray(last_values).reshape(-1)
+
+    return _discounted_cumsum(
+        rewards, gamma * is_nonterminals, last_values, use_tf)
@@ -0,0 +1,302 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+from dataclasses import dataclass
+from pathlib import Path
+import multiprocessing as mp
+import queue
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import gym
+import matplotlib.pyplot as plt
+
+from models import ActorCriticNet
+from shared import SharedParameters, SharedAdam
+
+MONITOR_DIR = Path(__file__).parent / "history"
+
+
+@dataclass
+class Step:
+
+    state: np.ndarray
+
+    action: int
+
+    reward: float
+
+    next_state: np.ndarray
+
+    done: bool
+
+
+class A3CAgent:
+    """プロセス版A3Cのワーカー
+
+        グローバルパラメータは共有メモリ上のflatバッファとして全ワーカーから
+        ロックなしで読み書きされる (Hogwild!)
+        スレッド版のようなget_weights/set_weightsによるグローバルネットワーク経由の
+        コピーやGILによる直列化は発生しない
+    """
+
+    MAX_TRAJECTORY = 5
+
+    def __init__(self, agent_id, env,
+                 global_counter, action_space,
+                 shared_params, optimizer,
+                 gamma, history_queue, global_steps_fin):
+
+        self.agent_id = agent_id
+
+        self.env = env
+
+        self.global_counter = global_counter
+
+        self.action_space = action_space
+
+        self.shared_params = shared_params
+
+        self.optimizer = optimizer
+
+        self.local_ACNet = ActorCriticNet(self.action_space)
+
+        self.local_ACNet.build(
+            input_shape=(None, self.env.observation_space.shape[0]))
+
+        self.gamma = gamma
+
+        self.history_queue = history_queue
+
+        self.global_steps_fin = global_steps_fin
+
+        self.param_views = self.shared_params.views()
+
+        self.flat_grads = np.zeros(self.shared_params.size, dtype=np.float32)
+
+    def pull(self):
+        """共有パラメータをローカルネットワークへ読み込む
+        """
+        for var, view in zip(self.local_ACNet.trainable_variables, self.param_views):
+            var.assign(view)
+
+    def play(self):
+
+        self.total_reward = 0
+
+        self.state = self.env.reset()
+
+        self.pull()
+
+        while self.global_counter.value < self.global_steps_fin:
+
+            trajectory = self.play_n_steps(N=self.MAX_TRAJECTORY)
+
+            states = [step.state for step in trajectory]
+
+            actions = [step.action for step in trajectory]
+
+            if trajectory[-1].done:
+                R = 0
+            else:
+                values, _ = self.local_ACNet(
+                    tf.convert_to_tensor(np.atleast_2d(trajectory[-1].next_state),
+                                         dtype=tf.float32))
+                R = values[0][0].numpy()
+
+            discounted_rewards = []
+            for step in reversed(trajectory):
+                R = step.reward + self.gamma * R
+                discounted_rewards.append(R)
+            discounted_rewards.reverse()
+
+            with tf.GradientTape() as tape:
+
+                total_loss = self.compute_loss(states, actions, discounted_rewards)
+
+            grads = tape.gradient(
+                total_loss, self.local_ACNet.trainable_variables)
+
+            #: 共有バッファへ直接勾配を適用し、最新のパラメータを読み直す
+            self.shared_params.flatten(
+                [grad.numpy() for grad in grads], out=self.flat_grads)
+
+            self.optimizer.apply_gradients(self.flat_grads)
+
+            self.pull()
+
+            with self.global_counter.get_lock():
+                self.global_counter.value += len(trajectory)
+
+    def play_n_steps(self, N):
+
+        trajectory = []
+
+        for _ in range(N):
+
+            action = self.local_ACNet.sample_action(self.state)
+
+            next_state, reward, done, info = self.env.step(action)
+
+            step = Step(self.state, action, reward, next_state, done)
+
+            trajectory.append(step)
+
+            if done:
+                self.history_queue.put(
+                    (self.agent_id, self.total_reward, self.global_counter.value))
+
+                self.total_reward = 0
+
+                self.state = self.env.reset()
+
+                break
+
+            else:
+                self.total_reward += reward
+                self.state = next_state
+
+        return trajectory
+
+    def compute_loss(self, states, actions, discounted_rewards):
+
+        states = tf.convert_to_tensor(
+            np.vstack(states), dtype=tf.float32)
+
+        values, logits = self.local_ACNet(states)
+
+        discounted_rewards = tf.convert_to_tensor(
+            np.vstack(discounted_rewards), dtype=tf.float32)
+
+        advantages = discounted_rewards - values
+
+        value_loss = advantages ** 2
+
+        actions_onehot = tf.one_hot(actions, self.action_space, dtype=tf.float32)
+
+        action_probs = tf.nn.softmax(logits)
+
+        log_action_prob = actions_onehot * tf.math.log(action_probs + 1e-20)
+
+        log_action_prob = tf.reduce_sum(log_action_prob, axis=1, keepdims=True)
+
+        entropy = -1 * tf.reduce_sum(
+            action_probs * tf.math.log(action_probs + 1e-20),
+            axis=1, keepdims=True)
+
+        policy_loss = tf.reduce_sum(
+            log_action_prob * tf.stop_gradient(advantages),
+            axis=1, keepdims=True)
+
+        policy_loss += 0.01 * entropy
+        policy_loss *= -1
+
+        total_loss = tf.reduce_mean(0.5 * value_loss + policy_loss)
+
+        return total_loss
+
+
+def worker(agent_id, env_id, action_space, shared_params, optimizer,
+           global_counter, history_queue, gamma, global_steps_fin):
+    """ワーカープロセスのエントリポイント
+
+        1プロセス1コアで動かすためTFのスレッドプールは1に絞る
+    """
+
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    agent = A3CAgent(agent_id=agent_id,
+                     env=gym.make(env_id),
+                     global_counter=global_counter,
+                     action_space=action_space,
+                     shared_params=shared_params,
+                     optimizer=optimizer,
+                     gamma=gamma,
+                     history_queue=history_queue,
+                     global_steps_fin=global_steps_fin)
+
+    agent.play()
+
+
+def main():
+
+    ENV_ID = "CartPole-v1"
+
+    ACTION_SPACE = 2
+
+    NUM_AGENTS = mp.cpu_count()
+
+    N_STEPS = 50000
+
+    if not MONITOR_DIR.exists():
+        MONITOR_DIR.mkdir()
+
+    global_ACNet = ActorCriticNet(ACTION_SPACE)
+
+    global_ACNet.build(input_shape=(None, 4))
+
+    shared_params = SharedParameters(
+        [var.shape for var in global_ACNet.trainable_variables])
+
+    shared_params.set_weights(
+        [var.numpy() for var in global_ACNet.trainable_variables])
+
+    optimizer = SharedAdam(shared_params, lr=0.0004)
+
+    global_counter = mp.Value("l", 0)
+
+    history_queue = mp.Queue()
+
+    workers = [mp.Process(target=worker,
+                          args=(f"agent_{agent_id}", ENV_ID, ACTION_SPACE,
+                                shared_params, optimizer, global_counter,
+                                history_queue, 0.99, N_STEPS))
+               for agent_id in range(NUM_AGENTS)]
+
+    start = time.time()
+
+    for proc in workers:
+        proc.start()
+
+    global_history = []
+
+    while any(proc.is_alive() for proc in workers) or not history_queue.empty():
+
+        try:
+            agent_id, total_reward, global_steps = history_queue.get(timeout=1.0)
+        except queue.Empty:
+            continue
+
+        global_history.append(total_reward)
+
+        elapsed = time.time() - start
+        print(f"Global step {global_steps}")
+        print(f"Total Reward: {total_reward}")
+        print(f"Agent: {agent_id}")
+        print(f"Env steps/sec: {global_steps / elapsed:.1f}")
+        print()
+
+    for proc in workers:
+        proc.join()
+
+    elapsed = time.time() - start
+    print(f"{NUM_AGENTS} workers: {global_counter.value} steps in {elapsed:.1f} sec",
+          f"({global_counter.value / elapsed:.1f} env steps/sec)")
+
+    plt.plot(range(len(global_history)), global_history)
+    plt.plot([0, len(global_history)], [195, 195], "--", color="darkred")
+    plt.xlabel("episodes")
+    plt.ylabel("Total Reward")
+    plt.savefig(MONITOR_DIR / "a3c_hogwild_cartpole-v1.png")
+
+    df = pd.DataFrame()
+    df["Total Reward"] = global_history
+    df.to_csv(MONITOR_DIR / "a3c_hogwild_cartpole-v1.csv", index=None)
+
+
+if __name__ == "__main__":
+    mp.set_start_method("spawn")
+    main()
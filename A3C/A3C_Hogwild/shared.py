@@ -0,0 +1,119 @@
+import ctypes
+import multiprocessing as mp
+
+import numpy as np
+
+
+class SharedParameters:
+    """全パラメータを共有メモリ上の1本のfloat32バッファに配置する
+
+        各ワーカーはロックをとらずに読み書きする (Hogwild!)
+        変数ごとのndarrayはflatバッファへのviewなのでコピーは発生しない
+    """
+
+    def __init__(self, shapes):
+
+        self.shapes = [tuple(shape) for shape in shapes]
+
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+
+        self.size = sum(self.sizes)
+
+        self.buffer = mp.RawArray(ctypes.c_float, self.size)
+
+        self._flat = None
+
+    def __getstate__(self):
+        #: RawArrayはプロセス生成時にのみ子プロセスへ引き渡せる
+        state = self.__dict__.copy()
+        state["_flat"] = None
+        return state
+
+    @property
+    def flat(self):
+        if self._flat is None:
+            self._flat = np.frombuffer(self.buffer, dtype=np.float32)
+        return self._flat
+
+    def views(self):
+        """変数ごとのview (zero-copy)
+        """
+        views = []
+        n = 0
+        for shape, size in zip(self.shapes, self.sizes):
+            views.append(self.flat[n:n+size].reshape(shape))
+            n += size
+        return views
+
+    def set_weights(self, weights):
+        for view, w in zip(self.views(), weights):
+            view[...] = w
+
+    def flatten(self, arrays, out=None):
+        """勾配などの変数リストをflatバッファと同じ並びに詰める
+        """
+        if out is None:
+            out = np.empty(self.size, dtype=np.float32)
+        n = 0
+        for arr, size in zip(arrays, self.sizes):
+            out[n:n+size] = np.asarray(arr).ravel()
+            n += size
+        return out
+
+
+class SharedAdam:
+    """共有メモリ上に一次・二次モーメントを持つAdam
+
+        モーメントもパラメータもロックなしでin-placeに更新する
+        A3C論文のshared RMSPropと同じく、統計量を全ワーカーで共有することが重要
+    """
+
+    def __init__(self, params, lr=0.0004, beta_1=0.9, beta_2=0.999, epsilon=1e-7):
+
+        self.params = params
+
+        self.lr = lr
+
+        self.beta_1 = beta_1
+
+        self.beta_2 = beta_2
+
+        self.epsilon = epsilon
+
+        self.m_buffer = mp.RawArray(ctypes.c_float, params.size)
+
+        self.v_buffer = mp.RawArray(ctypes.c_float, params.size)
+
+        self.t = mp.RawValue(ctypes.c_long, 0)
+
+        self._m, self._v = None, None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_m"], state["_v"] = None, None
+        return state
+
+    def _attach(self):
+        if self._m is None:
+            self._m = np.frombuffer(self.m_buffer, dtype=np.float32)
+            self._v = np.frombuffer(self.v_buffer, dtype=np.float32)
+
+    def apply_gradients(self, flat_grads):
+
+        self._attach()
+
+        #: 他ワーカーと競合しうるが、Hogwildなので多少のずれは許容する
+        self.t.value += 1
+        t = self.t.value
+
+        m, v, params = self._m, self._v, self.params.flat
+
+        m *= self.beta_1
+        m += (1 - self.beta_1) * flat_grads
+
+        v *= self.beta_2
+        v += (1 - self.beta_2) * np.square(flat_grads)
+
+        lr_t = self.lr * np.sqrt(1 - self.beta_2 ** t) / (1 - self.beta_1 ** t)
+
+        params -= lr_t * m / (np.sqrt(v) + self.epsilon)
@@ -0,0 +1,398 @@
+from pathlib import Path
+import shutil
+import time
+
+import ray
+from ray.util.queue import Queue, Full
+import gym
+from gym import wrappers
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tqdm import tqdm
+
+from model import PolicyWithValue
+import vtrace
+
+
+@ray.remote
+class ParameterServer:
+    """learnerの最新の重みを保持し、actorからのpullに応える
+    """
+
+    def __init__(self):
+
+        self.weights = None
+
+        self.version = 0
+
+        self.running = True
+
+    def push(self, weights):
+
+        self.weights = weights
+
+        self.version += 1
+
+    def pull(self, version):
+        """手元より新しい重みがあるときだけ重みを返す
+        """
+        if version == self.version:
+            return self.running, version, None
+        else:
+            return self.running, self.version, self.weights
+
+    def stop(self):
+
+        self.running = False
+
+
+@ray.remote(num_cpus=1)
+class Actor:
+
+    def __init__(self, actor_id, env_name, trajectory_length=20):
+
+        self.actor_id = actor_id
+
+        self.trajectory_length = trajectory_length
+
+        self.env = gym.make(env_name)
+
+        self.action_space = self.env.action_space.n
+
+        self.obs_space = self.env.observation_space.shape[0]
+
+        self.state = self.env.reset()
+
+        self.episode_reward = 0
+
+        self.policy = PolicyWithValue(action_space=self.action_space)
+
+        #: initialize weights
+        self.policy(np.atleast_2d(self.state).astype(np.float32))
+
+        self.version = -1
+
+    def run(self, queue, param_server):
+        """learnerを待たずにrolloutを生成し続ける
+
+            重みは各rolloutの開始時に新しいものがあれば取得するため、
+            actorの方策はlearnerよりわずかに古い (V-traceで補正する)
+            キューが満杯のときはlearnerが追いつくまで待つ
+        """
+        while True:
+
+            running, version, weights = ray.get(
+                param_server.pull.remote(self.version))
+
+            if not running:
+                return
+
+            if weights is not None:
+                self.policy.set_weights(weights)
+                self.version = version
+
+            trajectory = self._rollout()
+
+            while True:
+                try:
+                    queue.put(trajectory, timeout=1.0)
+                    break
+                except Full:
+                    running, _, _ = ray.get(param_server.pull.remote(self.version))
+                    if not running:
+                        return
+
+    def _rollout(self):
+
+        T = self.trajectory_length
+
+        trajectory = {}
+
+        trajectory["s"] = np.zeros((T, self.obs_space), dtype=np.float32)
+
+        trajectory["a"] = np.zeros(T, dtype=np.int32)
+
+        trajectory["r"] = np.zeros(T, dtype=np.float32)
+
+        trajectory["dones"] = np.zeros(T, dtype=np.float32)
+
+        #: 行動方策 μ(a|s)
+        trajectory["mu"] = np.zeros(T, dtype=np.float32)
+
+        episode_rewards = []
+
+        for i in range(T):
+
+            action, prob = self.policy.sample_action_with_prob(self.state)
+
+            next_state, reward, done, _ = self.env.step(action)
+
+            trajectory["s"][i] = self.state
+            trajectory["a"][i] = action
+            trajectory["r"][i] = reward
+            trajectory["dones"][i] = done
+            trajectory["mu"][i] = prob
+
+            self.episode_reward += reward
+
+            if done:
+                episode_rewards.append(self.episode_reward)
+                self.episode_reward = 0
+                self.state = self.env.reset()
+            else:
+                self.state = next_state
+
+        #: V-traceのbootstrap用
+        trajectory["last_s"] = np.array(self.state, dtype=np.float32)
+
+        trajectory["episode_rewards"] = episode_rewards
+
+        trajectory["version"] = self.version
+
+        return trajectory
+
+
+class Learner:
+
+    def __init__(self, action_space, gamma=0.99, lr=5e-4, entropy_coef=0.01,
+                 baseline_coef=0.5, max_grad_norm=40.):
+
+        self.action_space = action_space
+
+        self.gamma = gamma
+
+        self.ent_coef = entropy_coef
+
+        self.baseline_coef = baseline_coef
+
+        self.max_grad_norm = max_grad_norm
+
+        self.policy = PolicyWithValue(action_space=action_space)
+
+        self.optimizer = tf.keras.optimizers.Adam(lr=lr)
+
+    def update(self, trajectories):
+        """batch_size本のtrajectoryをまとめて1回更新する
+        """
+        states = np.stack([traj["s"] for traj in trajectories])
+        actions = np.stack([traj["a"] for traj in trajectories])
+        rewards = np.stack([traj["r"] for traj in trajectories])
+        dones = np.stack([traj["dones"] for traj in trajectories])
+        mu = np.stack([traj["mu"] for traj in trajectories])
+        last_states = np.stack([traj["last_s"] for traj in trajectories])
+
+        return self._train_step(states, actions, rewards, dones, mu, last_states)
+
+    @tf.function
+    def _train_step(self, states, actions, rewards, dones, mu, last_states):
+        """
+            入力はbatch-major (B, T, ...)、V-traceはtime-major (T, B)で計算する
+        """
+        B, T = tf.shape(states)[0], tf.shape(states)[1]
+
+        #: (B, T) -> (T, B)
+        actions = tf.transpose(actions)
+        rewards = tf.transpose(rewards)
+        discounts = self.gamma * (1. - tf.transpose(dones))
+        mu = tf.transpose(mu)
+
+        with tf.GradientTape() as tape:
+
+            values, action_probs = self.policy(
+                tf.reshape(states, (B * T, -1)))
+
+            values = tf.transpose(tf.reshape(values, (B, T)))
+
+            action_probs = tf.transpose(
+                tf.reshape(action_probs, (B, T, self.action_space)), (1, 0, 2))
+
+            bootstrap_value, _ = self.policy(last_states)
+            bootstrap_value = tf.reshape(bootstrap_value, (B,))
+
+            #: 学習中の方策 π(a|s)
+            actions_onehot = tf.one_hot(actions, self.action_space, dtype=tf.float32)
+            pi = tf.reduce_sum(action_probs * actions_onehot, axis=2)
+            log_pi = tf.math.log(pi + 1e-5)
+
+            log_rhos = log_pi - tf.math.log(mu + 1e-5)
+
+            vtrace_returns = vtrace.from_importance_weights(
+                log_rhos=log_rhos, discounts=discounts, rewards=rewards,
+                values=values, bootstrap_value=bootstrap_value)
+
+            policy_loss = -1 * tf.reduce_mean(log_pi * vtrace_returns.pg_advantages)
+
+            value_loss = tf.reduce_mean(tf.square(vtrace_returns.vs - values))
+
+            entropy = tf.reduce_mean(tf.reduce_sum(
+                -1 * action_probs * tf.math.log(action_probs + 1e-5), axis=2))
+
+            loss = policy_loss + self.baseline_coef * value_loss - self.ent_coef * entropy
+
+        grads = tape.gradient(loss, self.policy.trainable_variables)
+        grads, _ = tf.clip_by_global_norm(grads, self.max_grad_norm)
+        self.optimizer.apply_gradients(
+            zip(grads, self.policy.trainable_variables))
+
+        info = {"policy_loss": policy_loss, "value_loss": value_loss,
+                "entropy": entropy, "rho": tf.reduce_mean(tf.exp(log_rhos))}
+
+        return info
+
+
+def learn(num_actors=4, env_name="CartPole-v1", trajectory_length=20,
+          batch_size=16, queue_size=None, num_updates=5000,
+          test_freq=100, logdir="log", num_cpus=None):
+    """IMPALA: actorとlearnerを分離した非同期学習
+
+        actorは最新の重みを待たずに走り続け、bounded queueへtrajectoryを送る
+        learnerはqueueからbatch_size本ずつ取り出してV-traceで補正しつつ更新する
+    """
+
+    ray.init(num_cpus=num_cpus)
+
+    env = gym.make(env_name)
+    action_space = env.action_space.n
+
+    learner = Learner(action_space=action_space)
+    learner.policy(np.atleast_2d(env.reset()).astype(np.float32))
+
+    queue_size = queue_size if queue_size else 4 * batch_size
+    queue = Queue(maxsize=queue_size)
+
+    param_server = ParameterServer.remote()
+    param_server.push.remote(learner.policy.get_weights())
+
+    actors = [Actor.remote(actor_id=i, env_name=env_name,
+                           trajectory_length=trajectory_length)
+              for i in range(num_actors)]
+
+    work_in_progresses = [actor.run.remote(queue, param_server) for actor in actors]
+
+    logdir = Path(__file__).parent / logdir
+    if logdir.exists():
+        shutil.rmtree(logdir)
+    summary_writer = tf.summary.create_file_writer(str(logdir))
+
+    env_frames = 0
+    policy_lags = []
+    start = time.time()
+
+    for n in tqdm(range(num_updates)):
+
+        trajectories = [queue.get() for _ in range(batch_size)]
+
+        info = learner.update(trajectories)
+
+        param_server.push.remote(learner.policy.get_weights())
+
+        env_frames += batch_size * trajectory_length
+
+        #: trajectoryを生成した方策が何step前のものか
+        lags = [(n + 1) - traj["version"] for traj in trajectories]
+        policy_lags.extend(lags)
+
+        episode_rewards = sum([traj["episode_rewards"] for traj in trajectories], [])
+
+        with summary_writer.as_default():
+            tf.summary.scalar("policy_loss", info["policy_loss"], step=n)
+            tf.summary.scalar("value_loss", info["value_loss"], step=n)
+            tf.summary.scalar("entropy", info["entropy"], step=n)
+            tf.summary.scalar("rho", info["rho"], step=n)
+            tf.summary.scalar("policy_lag", np.mean(lags), step=n)
+            tf.summary.scalar("queue_size", queue.qsize(), step=n)
+            tf.summary.scalar("env_frames_per_sec",
+                              env_frames / (time.time() - start), step=n)
+            if episode_rewards:
+                tf.summary.scalar("train_reward", np.mean(episode_rewards), step=n)
+
+        if test_freq and n % test_freq == 0:
+            test_rewards = test_play(learner.policy, env_name)
+            with summary_writer.as_default():
+                tf.summary.scalar("test_reward", test_rewards, step=n)
+
+    elapsed = time.time() - start
+
+    param_server.stop.remote()
+    ray.get(work_in_progresses)
+    ray.shutdown()
+
+    stats = {"num_actors": num_actors,
+             "env_frames": env_frames,
+             "elapsed_sec": elapsed,
+             "env_frames_per_sec": env_frames / elapsed,
+             "updates_per_sec": num_updates / elapsed,
+             "mean_policy_lag": np.mean(policy_lags)}
+
+    return learner.policy, stats
+
+
+def benchmark(actor_counts=(4, 16, 64), num_updates=500, env_name="CartPole-v1"):
+    """actor数ごとのスループット計測
+
+        1台のマシン上で論理CPU数を超えるactorを立てる場合もあるため、
+        rayにはactor数+1 (learner) のCPUがあるものとして起動する
+    """
+
+    results = []
+
+    for num_actors in actor_counts:
+
+        _, stats = learn(num_actors=num_actors, env_name=env_name,
+                         num_updates=num_updates, test_freq=None,
+                         logdir=f"log_benchmark/{num_actors}",
+                         num_cpus=num_actors + 1)
+
+        print(f"{num_actors} actors: {stats['env_frames_per_sec']:.1f} frames/sec,",
+              f"{stats['updates_per_sec']:.2f} updates/sec,",
+              f"policy lag {stats['mean_policy_lag']:.2f}")
+
+        results.append(stats)
+
+    df = pd.DataFrame(results)
+    df.to_csv(Path(__file__).parent / "benchmark.csv", index=None)
+
+    return df
+
+
+def test_play(policy, env_name, monitordir=None):
+    if monitordir:
+        env = wrappers.Monitor(gym.make(env_name),
+                               monitordir, force=True,
+                               video_callable=(lambda ep: True))
+    else:
+        env = gym.make(env_name)
+
+    state = env.reset()
+
+    total_rewards = 0
+
+    while True:
+
+        action = policy.sample_action(state)
+
+        next_state, reward, done, _ = env.step(action)
+
+        total_rewards += reward
+
+        if done:
+            break
+        else:
+            state = next_state
+
+    return total_rewards
+
+
+if __name__ == '__main__':
+    policy, stats = learn()
+    print(stats)
+
+    print("Start TestPlay")
+    monitordir = Path(__file__).parent / "mp4"
+    if monitordir.exists():
+        shutil.rmtree(monitordir)
+
+    for i in range(3):
+        total_rewards = test_play(policy, "CartPole-v1", monitordir)
+        print(f"Test {i}:", total_rewards)
@@ -0,0 +1,77 @@
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+
+VTraceReturns = collections.namedtuple("VTraceReturns", ["vs", "pg_advantages"])
+
+
+@tf.function
+def from_importance_weights(log_rhos, discounts, rewards, values,
+                            bootstrap_value, clip_rho_threshold=1.0,
+                            clip_pg_rho_threshold=1.0):
+    """V-trace targetの計算 (IMPALA, Espeholt et al. 2018)
+
+    Args:
+        log_rhos: log π(a|s) - log μ(a|s), shape==(T, B)
+        discounts: γ * (1 - done), shape==(T, B)
+        rewards: shape==(T, B)
+        values: V(s_t), shape==(T, B)
+        bootstrap_value: V(s_T), shape==(B,)
+
+    Note:
+        すべてtime-majorで与えること
+        勾配はvs, pg_advantagesに流さない
+    """
+    rhos = tf.exp(log_rhos)
+
+    clipped_rhos = tf.minimum(clip_rho_threshold, rhos)
+
+    cs = tf.minimum(1.0, rhos)
+
+    values_t_plus_1 = tf.concat(
+        [values[1:], tf.expand_dims(bootstrap_value, 0)], axis=0)
+
+    deltas = clipped_rhos * (rewards + discounts * values_t_plus_1 - values)
+
+    #: v_s - V(x_s) = δ_s + γ c_s (v_{s+1} - V(x_{s+1})) を後ろからscan
+    vs_minus_v_xs = tf.scan(
+        lambda acc, x: x[0] + x[1] * x[2] * acc,
+        (deltas, discounts, cs),
+        initializer=tf.zeros_like(bootstrap_value),
+        reverse=True)
+
+    vs = vs_minus_v_xs + values
+
+    vs_t_plus_1 = tf.concat(
+        [vs[1:], tf.expand_dims(bootstrap_value, 0)], axis=0)
+
+    clipped_pg_rhos = tf.minimum(clip_pg_rho_threshold, rhos)
+
+    pg_advantages = clipped_pg_rhos * (rewards + discounts * vs_t_plus_1 - values)
+
+    return VTraceReturns(vs=tf.stop_gradient(vs),
+                         pg_advantages=tf.stop_gradient(pg_advantages))
+
+
+if __name__ == "__main__":
+    #: on-policy (log_rhos=0) ではn-step returnに一致する
+    T, B = 5, 2
+    rewards = np.ones((T, B), dtype=np.float32)
+    discounts = np.full((T, B), 0.9, dtype=np.float32)
+    values = np.zeros((T, B), dtype=np.float32)
+    bootstrap_value = np.ones(B, dtype=np.float32)
+
+    returns = from_importance_weights(
+        np.zeros((T, B), dtype=np.float32), discounts, rewards,
+        values, bootstrap_value)
+
+    R = bootstrap_value
+    expected = []
+    for t in reversed(range(T)):
+        R = rewards[t] + discounts[t] * R
+        expected.append(R)
+
+    print(returns.vs.numpy()[:, 0])
+    print(np.array(expected[::-1])[:, 0])
@@ -0,0 +1,170 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class Experience:
+
+    state: np.ndarray
+
+    action: int
+
+    reward: float
+
+    next_state: np.ndarray
+
+    done: bool
+
+
+class SumTree:
+    """優先度の和を保持する完全二分木
+
+        葉 (capacity個) に各experienceの優先度、内部ノードに子の和をもつ
+        サンプリングと更新はバッチ全体をnumpyで同時に処理する
+    """
+
+    def __init__(self, capacity):
+
+        #: 全ての葉が同じ深さになるよう2の冪に切り上げる
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[indices + self.capacity]
+
+    def update(self, indices, priorities):
+
+        idx = np.asarray(indices) + self.capacity
+
+        self.tree[idx] = priorities
+
+        idx = np.unique(idx // 2)
+        while True:
+            self.tree[idx] = self.tree[2 * idx] + self.tree[2 * idx + 1]
+            if idx[0] == 1:
+                break
+            idx = np.unique(idx // 2)
+
+    def find(self, values):
+        """累積優先度がvaluesとなる葉のindexを返す
+        """
+        idx = np.ones(len(values), dtype=np.int64)
+
+        while idx[0] < self.capacity:
+            left = 2 * idx
+            go_right = values > self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            idx = np.where(go_right, left + 1, left)
+
+        return idx - self.capacity
+
+
+class PrioritizedReplayBuffer:
+    """Ape-X用の優先度つきリプレイ
+
+        actorが計算した初期優先度つきでまとめて追加できる
+        サンプリングはsum-treeによりO(log N)
+    """
+
+    ALPHA = 0.6
+
+    EPSILON = 0.01
+
+    def __init__(self, max_experiences):
+
+        self.max_experiences = max_experiences
+
+        self.count = 0
+
+        self.experiences = []
+
+        self.sumtree = SumTree(self.max_experiences)
+
+        self.max_priority = 1.0
+
+    def add_experience(self, exp):
+
+        self.add_experiences([exp])
+
+    def add_experiences(self, exps, td_errors=None):
+
+        if td_errors is None:
+            priorities = np.full(len(exps), self.max_priority)
+        else:
+            priorities = (np.abs(td_errors) + self.EPSILON) ** self.ALPHA
+            self.max_priority = max(self.max_priority, priorities.max())
+
+        indices = []
+        for exp in exps:
+
+            if len(self.experiences) == self.max_experiences:
+                self.experiences[self.count] = exp
+            else:
+                self.experiences.append(exp)
+
+            indices.append(self.count)
+
+            if self.count == self.max_experiences-1:
+                self.count = 0
+            else:
+                self.count += 1
+
+        self.sumtree.update(np.array(indices), priorities)
+
+    def get_minibatch(self, batch_size, beta):
+
+        N = len(self.experiences)
+
+        total = self.sumtree.total()
+
+        #: 区間を等分して各区間から1つずつサンプル
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * total / batch_size
+
+        indices = np.minimum(self.sumtree.find(values), N - 1)
+
+        probs = self.sumtree.get(indices) / total
+
+        weights = (probs * N) ** -beta
+
+        weights /= weights.max()
+
+        selected_experiences = [self.experiences[idx] for idx in indices]
+
+        return indices, weights.astype(np.float32), selected_experiences
+
+    def update_priority(self, indices, td_errors):
+
+        assert len(indices) == len(td_errors)
+
+        priorities = (np.abs(td_errors) + self.EPSILON) ** self.ALPHA
+
+        self.sumtree.update(indices, priorities)
+
+        self.max_priority = max(self.max_priority, priorities.max())
+
+    def __len__(self):
+        return len(self.experiences)
+
+
+if __name__ == "__main__":
+
+    buffer = PrioritizedReplayBuffer(max_experiences=16)
+
+    exps = [Experience(None, 0, i, None, False) for i in range(20)]
+    buffer.add_experiences(exps, td_errors=np.arange(20))
+
+    print(len(buffer), buffer.sumtree.total())
+
+    indices, weights, experiences = buffer.get_minibatch(4, 0.5)
+    print(indices)
+    print(weights)
+
+    buffer.update_priority(indices, np.zeros(len(indices)))
+    print(buffer.sumtree.total())
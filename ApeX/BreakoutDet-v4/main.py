@@ -0,0 +1,424 @@
+from pathlib import Path
+import shutil
+import collections
+import pickle
+import zlib
+import time
+
+import ray
+import gym
+import numpy as np
+import tensorflow as tf
+
+from model import QNetwork
+from buffer import Experience, PrioritizedReplayBuffer
+from util import preprocess, TargetNetworkUpdater
+
+
+def compress(exp):
+    """stateとnext_stateで重複するフレームは1回だけ保存する
+
+        next_stateはstateをkフレームずらしたものなので、state + next_stateの末尾kフレームの
+        4+k枚 (uint8) だけを持てば両方を復元できる (n-step, n_frames=4なら7枚で元の8枚の代わり)
+        フレームごとに連続した配置 (4+k, 84, 84) にしてからzlibにかける
+    """
+    n_frames = exp.state.shape[-1]
+
+    k = next(k for k in range(n_frames + 1)
+             if np.array_equal(exp.state[..., k:], exp.next_state[..., :n_frames-k]))
+
+    frames = np.concatenate(
+        [exp.state[0], exp.next_state[0, ..., n_frames-k:]], axis=-1)
+
+    frames = np.ascontiguousarray(np.moveaxis(frames, -1, 0))
+
+    return zlib.compress(pickle.dumps(
+        (frames, n_frames, exp.action, exp.reward, exp.done)))
+
+
+def decompress(blob):
+
+    frames, n_frames, action, reward, done = pickle.loads(zlib.decompress(blob))
+
+    frames = np.moveaxis(frames, 0, -1)[np.newaxis, ...]
+
+    return Experience(frames[..., :n_frames], action, reward,
+                      frames[..., -n_frames:], done)
+
+
+@ray.remote(num_cpus=1)
+class Actor:
+    """ε固定で環境を進め、初期優先度を計算してreplayへ送るactor
+    """
+
+    def __init__(self, pid, epsilon, env_name, gamma, n_step=3, n_frames=4):
+
+        self.pid = pid
+
+        self.epsilon = epsilon
+
+        self.env = gym.make(env_name)
+
+        self.action_space = self.env.action_space.n
+
+        self.gamma = gamma
+
+        self.n_step = n_step
+
+        self.n_frames = n_frames
+
+        self.qnet = QNetwork(self.action_space)
+
+        self.local_buffer = []
+
+        self.nstep_buffer = collections.deque(maxlen=self.n_step)
+
+        self._reset_env()
+
+        #: initialize weights
+        self.qnet(self.state)
+
+    def _reset_env(self):
+
+        frame = preprocess(self.env.reset())
+        self.frames = collections.deque(
+            [frame] * self.n_frames, maxlen=self.n_frames)
+
+        self.state = np.stack(self.frames, axis=2)[np.newaxis, ...]
+
+        self.lives = 5
+
+        self.episode_reward = 0
+
+        self.nstep_buffer.clear()
+
+    def rollout(self, weights, replay, n_steps=100):
+        """n_stepsだけ環境を進め、溜まった遷移を初期優先度つきでreplayへ送る
+        """
+
+        self.qnet.set_weights(weights)
+
+        episode_rewards = []
+
+        for _ in range(n_steps):
+
+            if np.random.random() < self.epsilon:
+                action = np.random.choice(self.action_space)
+            else:
+                action = np.argmax(self.qnet.predict(self.state))
+
+            next_frame, reward, done, info = self.env.step(action)
+
+            self.episode_reward += reward
+
+            self.frames.append(preprocess(next_frame))
+
+            next_state = np.stack(self.frames, axis=2)[np.newaxis, ...]
+
+            #: ライフ損失もエピソード終端として扱う
+            life_lost = info["ale.lives"] != self.lives
+            self.lives = info["ale.lives"]
+
+            self.nstep_buffer.append(
+                Experience(self.state, action, np.clip(reward, -1, 1),
+                           next_state, done or life_lost))
+
+            if len(self.nstep_buffer) == self.n_step:
+                self.local_buffer.append(self._nstep_experience())
+
+            if done or life_lost:
+                #: n step未満の遷移もすべて吐き出す
+                if len(self.nstep_buffer) == self.n_step:
+                    self.nstep_buffer.popleft()
+                while self.nstep_buffer:
+                    self.local_buffer.append(self._nstep_experience())
+                    self.nstep_buffer.popleft()
+
+            if done:
+                episode_rewards.append(self.episode_reward)
+                self._reset_env()
+            else:
+                self.state = next_state
+
+        experiences, self.local_buffer = self.local_buffer, []
+
+        td_errors = self.compute_td_errors(experiences)
+
+        replay.push.remote([compress(exp) for exp in experiences], td_errors)
+
+        return self.pid, episode_rewards, n_steps
+
+    def _nstep_experience(self):
+
+        nstep_return = sum([self.gamma ** i * exp.reward
+                            for i, exp in enumerate(self.nstep_buffer)])
+
+        first, last = self.nstep_buffer[0], self.nstep_buffer[-1]
+
+        return Experience(first.state, first.action, nstep_return,
+                          last.next_state, last.done)
+
+    def compute_td_errors(self, experiences):
+        """初期優先度の計算
+
+            actorはtarget networkを持たないので手元のネットワークで代用する
+        """
+        states = np.vstack([exp.state for exp in experiences])
+        actions = np.array([exp.action for exp in experiences])
+        rewards = np.array([exp.reward for exp in experiences], dtype=np.float32)
+        next_states = np.vstack([exp.next_state for exp in experiences])
+        dones = np.array([exp.done for exp in experiences], dtype=np.float32)
+
+        qvalues = self.qnet(states).numpy()
+        next_qvalues = self.qnet(next_states).numpy()
+
+        q = qvalues[np.arange(len(experiences)), actions]
+        target_q = rewards + (1 - dones) * self.gamma ** self.n_step * next_qvalues.max(axis=1)
+
+        return target_q - q
+
+
+@ray.remote
+class Replay:
+    """全actorで共有する中央リプレイ
+
+        experienceは圧縮済みのbytesのまま保持する
+    """
+
+    def __init__(self, buffer_size):
+
+        self.buffer = PrioritizedReplayBuffer(max_experiences=buffer_size)
+
+    def push(self, experiences, td_errors):
+
+        self.buffer.add_experiences(experiences, td_errors)
+
+    def sample_minibatch(self, batch_size, beta):
+
+        return self.buffer.get_minibatch(batch_size, beta)
+
+    def update_priority(self, indices, td_errors):
+
+        self.buffer.update_priority(indices, td_errors)
+
+    def size(self):
+
+        return len(self.buffer)
+
+
+class Learner:
+
+    def __init__(self, action_space, gamma, n_step):
+
+        self.action_space = action_space
+
+        self.gamma = gamma
+
+        self.n_step = n_step
+
+        self.qnet = QNetwork(self.action_space)
+
+        self.target_qnet = QNetwork(self.action_space)
+
+        self.target_updater = TargetNetworkUpdater(self.target_qnet, self.qnet)
+
+    def update(self, minibatch):
+
+        indices, weights, compressed_experiences = minibatch
+
+        experiences = [decompress(blob) for blob in compressed_experiences]
+
+        states = np.vstack([exp.state for exp in experiences])
+        actions = np.array([exp.action for exp in experiences], dtype=np.int32)
+        rewards = np.array([exp.reward for exp in experiences], dtype=np.float32)
+        next_states = np.vstack([exp.next_state for exp in experiences])
+        dones = np.array([exp.done for exp in experiences], dtype=np.float32)
+
+        #: Double DQN
+        next_actions = np.argmax(self.qnet(next_states), axis=1)
+        next_qvalues = self.target_qnet(next_states).numpy()
+        next_qvalues = next_qvalues[np.arange(len(experiences)), next_actions]
+
+        target_values = rewards + (1 - dones) * self.gamma ** self.n_step * next_qvalues
+
+        td_errors, loss = self.qnet.update(
+            states, actions, target_values.astype(np.float32), weights)
+
+        return indices, td_errors, loss
+
+
+def learn(num_actors=8, env_name="BreakoutDeterministic-v4", n_updates=200000,
+          gamma=0.99, n_step=3, batch_size=512, buffer_size=2000000,
+          min_experiences=50000, target_update_period=2500,
+          weight_sync_period=400, logdir="log"):
+    """Ape-X: 分散優先度つき経験再生
+
+        actorはεのはしご (ε_i = 0.4^(1 + 7i/(N-1))) で探索しつつ
+        初期優先度を計算して中央リプレイへ送る
+        learnerはリプレイからサンプルして学習し、優先度の更新を非同期に送り返す
+
+        リプレイのメモリ: 1遷移はuint8フレーム7枚 (約49KB) をzlib圧縮したbytesで、
+        圧縮後は画面次第だがBreakout風のフレームで約1-2KB、buffer_size=2Mで数GB程度
+        (float32のフレームスタック2つをそのまま持つと圧縮前で約226KB/遷移)
+    """
+
+    ray.init()
+
+    env = gym.make(env_name)
+    action_space = env.action_space.n
+
+    logdir = Path(__file__).parent / logdir
+    if logdir.exists():
+        shutil.rmtree(logdir)
+    summary_writer = tf.summary.create_file_writer(str(logdir))
+
+    replay = Replay.remote(buffer_size=buffer_size)
+
+    learner = Learner(action_space=action_space, gamma=gamma, n_step=n_step)
+
+    frame = preprocess(env.reset())
+    dummy_state = np.stack([frame] * 4, axis=2)[np.newaxis, ...]
+    learner.qnet(dummy_state)
+    learner.target_qnet(dummy_state)
+    learner.target_updater.hard_update()
+
+    if num_actors > 1:
+        epsilons = [0.4 ** (1 + 7 * i / (num_actors - 1)) for i in range(num_actors)]
+    else:
+        epsilons = [0.4]
+
+    actors = [Actor.remote(pid=i, epsilon=epsilons[i], env_name=env_name,
+                           gamma=gamma, n_step=n_step)
+              for i in range(num_actors)]
+
+    weights = ray.put(learner.qnet.get_weights())
+
+    wip_actors = [actor.rollout.remote(weights, replay) for actor in actors]
+
+    env_steps = 0
+    episode_count = 0
+
+    #: リプレイが溜まるまではactorだけを回す
+    while ray.get(replay.size.remote()) < min_experiences:
+        finished, wip_actors = ray.wait(wip_actors, num_returns=1)
+        pid, episode_rewards, steps = ray.get(finished[0])
+        env_steps += steps
+        wip_actors.append(actors[pid].rollout.remote(weights, replay))
+
+    print("Start learning, env steps:", env_steps)
+
+    #: サンプリングを先行させてlearnerが待たないようにする
+    beta = 0.4
+    wip_minibatches = [replay.sample_minibatch.remote(batch_size, beta) for _ in range(2)]
+
+    start = time.time()
+    start_env_steps = env_steps
+
+    for n in range(1, n_updates+1):
+
+        beta = 0.4 + 0.6 * n / n_updates
+
+        minibatch = ray.get(wip_minibatches.pop(0))
+        wip_minibatches.append(replay.sample_minibatch.remote(batch_size, beta))
+
+        indices, td_errors, loss = learner.update(minibatch)
+
+        #: 優先度の更新は待たない
+        replay.update_priority.remote(indices, td_errors)
+
+        if n % target_update_period == 0:
+            learner.target_updater.hard_update()
+
+        if n % weight_sync_period == 0:
+            weights = ray.put(learner.qnet.get_weights())
+
+        finished, wip_actors = ray.wait(
+            wip_actors, num_returns=len(wip_actors), timeout=0)
+
+        for job in finished:
+            pid, episode_rewards, steps = ray.get(job)
+            env_steps += steps
+            wip_actors.append(actors[pid].rollout.remote(weights, replay))
+
+            with summary_writer.as_default():
+                for episode_reward in episode_rewards:
+                    episode_count += 1
+                    tf.summary.scalar(f"train_score_actor{pid}", episode_reward,
+                                      step=episode_count)
+
+        if n % 100 == 0:
+            elapsed = time.time() - start
+            with summary_writer.as_default():
+                tf.summary.scalar("loss", loss, step=n)
+                tf.summary.scalar("env_steps", env_steps, step=n)
+                tf.summary.scalar("env_steps_per_sec",
+                                  (env_steps - start_env_steps) / elapsed, step=n)
+                tf.summary.scalar("updates_per_sec", n / elapsed, step=n)
+                tf.summary.scalar("buffer_size", ray.get(replay.size.remote()), step=n)
+
+        if n % 5000 == 0:
+            test_scores, test_steps = test_play(learner.qnet, env_name)
+            print(f"Update: {n}, env steps: {env_steps}, test score: {test_scores[0]}")
+            with summary_writer.as_default():
+                tf.summary.scalar("test_score", test_scores[0], step=n)
+                tf.summary.scalar("test_step", test_steps[0], step=n)
+            learner.qnet.save_weights("checkpoints/qnet")
+
+    ray.shutdown()
+
+    return learner.qnet
+
+
+def test_play(qnet, env_name, n_testplay=1, monitor_dir=None, n_frames=4):
+
+    if monitor_dir:
+        monitor_dir = Path(monitor_dir)
+        if monitor_dir.exists():
+            shutil.rmtree(monitor_dir)
+        monitor_dir.mkdir()
+        env = gym.wrappers.Monitor(
+            gym.make(env_name), monitor_dir, force=True,
+            video_callable=(lambda ep: True))
+    else:
+        env = gym.make(env_name)
+
+    scores = []
+    steps = []
+    for _ in range(n_testplay):
+
+        frame = preprocess(env.reset())
+        frames = collections.deque([frame] * n_frames, maxlen=n_frames)
+
+        done = False
+        episode_steps = 0
+        episode_rewards = 0
+
+        while not done:
+            state = np.stack(frames, axis=2)[np.newaxis, ...]
+            if np.random.random() < 0.05:
+                action = np.random.choice(qnet.action_space)
+            else:
+                action = np.argmax(qnet.predict(state))
+            next_frame, reward, done, _ = env.step(action)
+            frames.append(preprocess(next_frame))
+
+            episode_rewards += reward
+            episode_steps += 1
+            if episode_steps > 500 and episode_rewards < 3:
+                #: ゲーム開始(action: 0)しないまま停滞するケースへの対処
+                break
+
+        scores.append(episode_rewards)
+        steps.append(episode_steps)
+
+    return scores, steps
+
+
+def main():
+    qnet = learn(num_actors=8)
+    qnet.save_weights("checkpoints/qnet_fin")
+    test_play(qnet, "BreakoutDeterministic-v4", n_testplay=5, monitor_dir="mp4")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.layers as kl
+
+from util import normalize_frames
+
+
+class QNetwork(tf.keras.Model):
+
+    def __init__(self, action_space=4, lr=0.00025/4):
+
+        super(QNetwork, self).__init__()
+
+        self.action_space = action_space
+
+        self.conv1 = kl.Conv2D(32, 8, strides=4, activation="relu",
+                               kernel_initializer="he_normal")
+
+        self.conv2 = kl.Conv2D(64, 4, strides=2, activation="relu",
+                               kernel_initializer="he_normal")
+
+        self.conv3 = kl.Conv2D(64, 3, strides=1, activation="relu",
+                               kernel_initializer="he_normal")
+
+        self.flatten1 = kl.Flatten()
+
+        self.dense1 = kl.Dense(512, activation="relu",
+                               kernel_initializer="he_normal")
+
+        self.dense2 = kl.Dense(512, activation="relu",
+                               kernel_initializer="he_normal")
+
+        self.values = kl.Dense(1, kernel_initializer="he_normal")
+
+        self.advantages = kl.Dense(self.action_space,
+                                   kernel_initializer="he_normal")
+
+        self.optimizer = tf.keras.optimizers.Adam(lr=lr)
+
+    @tf.function
+    def call(self, x):
+
+        x = normalize_frames(x)
+
+        x = self.conv1(x)
+        x = self.conv2(x)
+        x = self.conv3(x)
+        x = self.flatten1(x)
+
+        x1 = self.dense1(x)
+        values = self.values(x1)
+
+        x2 = self.dense2(x)
+        advantages = self.advantages(x2)
+
+        scaled_advantages = advantages - tf.reduce_mean(advantages, axis=1, keepdims=True)
+
+        q_values = values + scaled_advantages
+
+        return q_values
+
+    def huber_loss(self, errors, weights):
+        errors = errors * weights
+        is_smaller_error = tf.abs(errors) < 1.0
+        squared_loss = tf.square(errors) * 0.5
+        linear_loss = tf.abs(errors) - 0.5
+
+        return tf.where(is_smaller_error, squared_loss, linear_loss)
+
+    def predict(self, states):
+        if len(states.shape) == 3:
+            states = states[np.newaxis, ...]
+        return self(states).numpy()
+
+    def update(self, states, selected_actions, target_values, weights):
+
+        selected_actions_onehot = tf.one_hot(selected_actions,
+                                             self.action_space)
+        with tf.GradientTape() as tape:
+
+            selected_action_values = tf.reduce_sum(
+                self(states) * selected_actions_onehot, axis=1)
+
+            td_errors = target_values - selected_action_values
+
+            loss = tf.reduce_mean(self.huber_loss(td_errors, weights))
+
+        gradients = tape.gradient(loss, self.trainable_variables)
+        gradients, _ = tf.clip_by_global_norm(gradients, 40.)
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+
+        return td_errors.numpy(), loss
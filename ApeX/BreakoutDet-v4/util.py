@@ -0,0 +1,95 @@
+import numpy as np
+from PIL import Image
+import tensorflow as tf
+
+
+def preprocess(frame):
+    """Breakout向けの切り取りであることに注意
+
+        リプレイのメモリを抑えるため0-255のuint8のまま返し、[0, 1]への正規化はネットワーク内で行う
+    """
+
+    frame = Image.fromarray(frame)
+    frame = frame.convert("L")
+    frame = frame.crop((0, 20, 160, 210))
+    frame = frame.resize((84, 84))
+    frame = np.array(frame, dtype=np.uint8)
+
+    return frame
+
+
+def normalize_frames(x):
+    """uint8で渡されたフレームをグラフ内で[0, 1]のfloat32に変換する (floatの入力はそのまま)
+    """
+    if x.dtype == tf.uint8:
+        x = tf.cast(x, tf.float32) / 255.
+
+    return x
+
+
+class TargetNetworkUpdater:
+    """targetネットワークの変数をonlineネットワークの変数と対応づけて保持し、
+       target = (1 - tau) * target + tau * online をグラフ内のassignで行う
+
+        重みをnumpyに書き出さないのでhostとの往復コピーが発生しない
+        fused=Trueなら全変数を1本のベクトルに連結して1回の演算でまとめて計算する
+        tf.functionの中から呼ぶとそのグラフに埋め込まれる
+        両ネットワークはbuild済みであること
+    """
+
+    def __init__(self, target_network, online_network, tau=1.0, fused=False):
+
+        self.target_network = target_network
+
+        self.online_network = online_network
+
+        self.tau = tau
+
+        self.fused = fused
+
+    def _variables(self):
+
+        target_vars = self.target_network.weights
+
+        online_vars = self.online_network.weights
+
+        assert len(target_vars) == len(online_vars) > 0
+
+        return target_vars, online_vars
+
+    def soft_update(self, tau=None):
+
+        tau = self.tau if tau is None else tau
+
+        return self._soft_update(tf.constant(tau, dtype=tf.float32))
+
+    def hard_update(self):
+
+        return self._hard_update()
+
+    @tf.function
+    def _soft_update(self, tau):
+
+        target_vars, online_vars = self._variables()
+
+        if self.fused:
+            sizes = [tf.size(var) for var in target_vars]
+
+            flat_target = tf.concat([tf.reshape(var, [-1]) for var in target_vars], 0)
+            flat_online = tf.concat([tf.reshape(var, [-1]) for var in online_vars], 0)
+
+            flat_new = (1 - tau) * flat_target + tau * flat_online
+
+            for var, value in zip(target_vars, tf.split(flat_new, sizes)):
+                var.assign(tf.reshape(value, var.shape))
+        else:
+            for target_var, online_var in zip(target_vars, online_vars):
+                target_var.assign((1 - tau) * target_var + tau * online_var)
+
+    @tf.function
+    def _hard_update(self):
+
+        target_vars, online_vars = self._variables()
+
+        for target_var, online_var in zip(target_vars, online_vars):
+            target_var.assign(online_var)
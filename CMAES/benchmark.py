@@ -0,0 +1,213 @@
+import time
+
+import numpy as np
+
+from cmaes import CMAES, SepCMAES
+from main import levi_func
+
+
+#: テスト関数: 個体群 X (n, dim) をまとめて評価し、shape==(n,)の適合度を返す
+#: https://en.wikipedia.org/wiki/Test_functions_for_optimization
+
+
+def sphere(X):
+
+    return np.sum(X ** 2, axis=1)
+
+
+def ellipsoid(X):
+    """条件数1e6の悪条件な二次関数
+    """
+    dim = X.shape[1]
+
+    scales = 1e6 ** (np.arange(dim) / max(dim - 1, 1))
+
+    return np.sum(scales * X ** 2, axis=1)
+
+
+def rosenbrock(X):
+
+    return np.sum(100 * (X[:, 1:] - X[:, :-1] ** 2) ** 2 + (1 - X[:, :-1]) ** 2, axis=1)
+
+
+def rastrigin(X):
+
+    return 10 * X.shape[1] + np.sum(X ** 2 - 10 * np.cos(2 * np.pi * X), axis=1)
+
+
+def ackley(X):
+
+    dim = X.shape[1]
+
+    return (-20 * np.exp(-0.2 * np.sqrt(np.sum(X ** 2, axis=1) / dim))
+            - np.exp(np.sum(np.cos(2 * np.pi * X), axis=1) / dim)
+            + 20 + np.e)
+
+
+def levy(X):
+    """任意次元のLevy関数、最小値は x = (1, ..., 1) で 0
+    """
+    W = 1 + (X - 1) / 4
+
+    return (np.sin(np.pi * W[:, 0]) ** 2
+            + np.sum((W[:, :-1] - 1) ** 2 * (1 + 10 * np.sin(np.pi * W[:, 1:]) ** 2), axis=1)
+            + (W[:, -1] - 1) ** 2 * (1 + np.sin(2 * np.pi * W[:, -1]) ** 2))
+
+
+def levi(X):
+    """main.pyのlevi_func (回転ありのLevi N.13) を個体群に対して評価する、2次元のみ
+    """
+    assert X.shape[1] == 2
+
+    return levi_func(X[:, 0], X[:, 1])
+
+
+#: 関数名 -> (関数, 初期点の範囲, 最小値)
+FUNCTIONS = {
+    "sphere": (sphere, (-5, 5), 0.),
+    "ellipsoid": (ellipsoid, (-5, 5), 0.),
+    "rosenbrock": (rosenbrock, (-2, 2), 0.),
+    "rastrigin": (rastrigin, (-5.12, 5.12), 0.),
+    "ackley": (ackley, (-32, 32), 0.),
+    "levy": (levy, (-10, 10), 0.),
+    "levi": (levi, (-10, 10), 0.),
+}
+
+
+class Timer:
+    """sample_population/updateそれぞれの所要時間を積算する
+    """
+
+    def __init__(self):
+
+        self.elapsed = {"sample_population": 0., "update": 0.}
+
+        self.n = 0
+
+    def run_generation(self, es, func, gen):
+
+        start = time.perf_counter()
+        X = es.sample_population()
+        self.elapsed["sample_population"] += time.perf_counter() - start
+
+        fitnesses = func(X)
+
+        start = time.perf_counter()
+        es.update(X, fitnesses, gen)
+        self.elapsed["update"] += time.perf_counter() - start
+
+        self.n += 1
+
+        return fitnesses
+
+    def per_generation(self, key):
+
+        return self.elapsed[key] / self.n
+
+
+def benchmark_speed(dims=(2, 10, 100, 1000), n_generations=100, func=sphere):
+    """次元ごとに1世代あたりのsample_population/updateの時間を計測する
+    """
+    print(f"{'dim':>6}{'ES':>10}{'lam':>6}{'eigen_interval':>16}"
+          f"{'sample [ms]':>14}{'update [ms]':>14}")
+
+    results = {}
+
+    for dim in dims:
+        for ES in [CMAES, SepCMAES]:
+
+            np.random.seed(0)
+
+            es = ES(centroid=np.random.uniform(-5, 5, dim), sigma=2.0)
+
+            timer = Timer()
+
+            for gen in range(n_generations):
+                timer.run_generation(es, func, gen)
+
+            sample_ms = timer.per_generation("sample_population") * 1000
+            update_ms = timer.per_generation("update") * 1000
+
+            results[(dim, ES.__name__)] = (sample_ms, update_ms)
+
+            print(f"{dim:>6}{ES.__name__:>10}{es.lam:>6}{es.eigen_interval:>16}"
+                  f"{sample_ms:>14.3f}{update_ms:>14.3f}")
+
+    return results
+
+
+def run(func, dim, lower, upper, fopt, ES=CMAES, sigma=None,
+        max_evals=None, tol=1e-8, seed=0):
+    """1回のCMA-ESで fopt + tol に届くまでの評価回数を返す (届かなければNone)
+    """
+    np.random.seed(seed)
+
+    sigma = sigma if sigma else 0.3 * (upper - lower)
+
+    max_evals = max_evals if max_evals else 1000 * dim ** 2 + 10000
+
+    es = ES(centroid=np.random.uniform(lower, upper, dim), sigma=sigma)
+
+    n_evals, gen, best = 0, 0, np.inf
+
+    while n_evals < max_evals:
+
+        X = es.sample_population()
+
+        fitnesses = func(X)
+
+        es.update(X, fitnesses, gen)
+
+        n_evals += len(X)
+
+        gen += 1
+
+        best = min(best, fitnesses.min())
+
+        if best - fopt < tol:
+            return n_evals, best
+
+    return None, best
+
+
+def benchmark_convergence(dims=(2, 10), functions=None, n_trials=5):
+    """関数と次元ごとに、目標値に届いた試行の割合と届くまでの平均評価回数を表示する
+    """
+    functions = functions if functions else list(FUNCTIONS)
+
+    print(f"{'function':>12}{'dim':>6}{'success':>10}{'mean evals':>14}{'median best':>14}")
+
+    results = {}
+
+    for name in functions:
+
+        func, (lower, upper), fopt = FUNCTIONS[name]
+
+        for dim in dims:
+
+            if name == "levi" and dim != 2:
+                continue
+
+            trials = [run(func, dim, lower, upper, fopt, seed=seed) for seed in range(n_trials)]
+
+            evals = [n for n, _ in trials if n is not None]
+
+            results[(name, dim)] = trials
+
+            mean_evals = f"{np.mean(evals):.0f}" if evals else "-"
+
+            print(f"{name:>12}{dim:>6}{len(evals):>7}/{n_trials:<2}{mean_evals:>14}"
+                  f"{np.median([best for _, best in trials]):>14.2e}")
+
+    return results
+
+
+def main():
+
+    benchmark_speed()
+
+    benchmark_convergence()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import numpy as np
+
+
+class CMAES:
+    """(μ/μ_w, λ)-CMA-ES
+
+        C = B D^2 B^T の固有値分解は毎世代ではなく
+        eigen_interval (≒ 1/(c_1+c_μ)/dim/10) 世代ごとにだけ計算し直し、
+        サンプリングとp_σの更新はキャッシュしたB, Dを使う
+        (Cの変化は1世代あたりO(c_1+c_μ)なので古いB, Dでも十分な近似になる)
+    """
+
+    def __init__(self, centroid, sigma, lam=None):
+
+        #: 次元数
+        self.dim = len(centroid)
+
+        #: 世代ごと総個体数λとエリート数μ
+        self.lam = lam if lam else int(4 + 3*np.log(self.dim))
+        self.mu = int(np.floor(self.lam / 2))
+
+        #: 正規分布中心とその学習率
+        self.centroid = np.array(centroid, dtype=np.float64)
+        self.c_m = 1.0
+
+        #: 順位にもとづく重み係数
+        weights = np.log(0.5*(self.lam + 1)) - np.log(np.arange(1, 1+self.mu).reshape(1, -1))
+        self.weights = weights / weights.sum()
+        self.mu_eff = 1. / (self.weights ** 2).sum()
+
+        #: ステップサイズ： 進化パスと学習率
+        self.sigma = float(sigma)
+        self.p_sigma = np.zeros(self.dim)
+        self.c_sigma = (self.mu_eff + 2) / (self.dim + self.mu_eff + 5)
+        self.d_sigma = 1 + 2 * max(
+            0, np.sqrt((self.mu_eff - 1)/(self.dim + 1)) - 1
+            ) + self.c_sigma
+
+        #: 共分散行列： 進化パスとrank-μ, rank-one更新の学習率
+        self.p_c = np.zeros(self.dim)
+        self.c_c = (4 + self.mu_eff / self.dim) / (self.dim + 4 + 2 * self.mu_eff / self.dim)
+        self.c_1 = 2.0 / ((self.dim+1.3)**2 + self.mu_eff)
+        self.c_mu = min(
+            1 - self.c_1,
+            2.0 * (self.mu_eff - 2 + 1/self.mu_eff) / ((self.dim + 2) ** 2 + self.mu_eff)
+            )
+
+        #: E||N(0, I)||
+        self.E_normal = np.sqrt(self.dim) * (1 - 1/(4*self.dim) + 1/(21 * self.dim **2))
+
+        self.init_covariance()
+
+        #: 停止判定 (tolfun) 用: 直近の世代ごとの最良適合度と現世代の適合度の幅
+        self.fitness_history = np.full(10 + int(np.ceil(30 * self.dim / self.lam)), np.nan)
+        self.fitness_range = np.inf
+        self.gen = 0
+
+    def init_covariance(self):
+
+        self.C = np.identity(self.dim)
+
+        #: 固有値分解のキャッシュ： C = B diag(D)^2 B^T
+        self.B = np.identity(self.dim)
+        self.D = np.ones(self.dim)
+        self.eigen_interval = max(1, int(1. / (self.c_1 + self.c_mu) / self.dim / 10))
+        self.eigen_gen = 0
+
+    def update_eigen(self, gen=None, force=False):
+        """前回の分解からeigen_interval世代以上経っていればCを分解し直す
+        """
+        if not force and gen is not None and gen - self.eigen_gen < self.eigen_interval:
+            return
+
+        #: 数値誤差で崩れた対称性を上三角から戻してから分解する
+        self.C = np.triu(self.C) + np.triu(self.C, 1).T
+
+        eigvals, self.B = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.maximum(eigvals, 1e-300))
+
+        if gen is not None:
+            self.eigen_gen = gen
+
+    def sample_population(self):
+        """個体群の発生
+            C = BDDB^T, y = BDz ~ N(0, C)
+        """
+        #: z ~ N(0, 1)
+        Z = np.random.normal(0, 1, size=(self.lam, self.dim))
+
+        #: y~N(0, C)
+        Y = self.transform(Z)
+
+        #: X~N(μ, σC)
+        X = self.centroid + self.sigma * Y
+
+        return X
+
+    def update(self, X, fitnesses, gen):
+        """update parameters
+
+        Args:
+            X (np.ndarray): 個体群, shape==(self.lam, self.dim)
+            fitnesses (list): 適合度
+            gen (int): 現在の世代数
+        """
+
+        #: 1. Selection and recombination
+        old_centroid = self.centroid
+        old_sigma = self.sigma
+
+        #: 全個体数はλから上位μ個体を選出
+        elite_indices = np.argsort(fitnesses)[:self.mu]
+
+        self.fitness_history[gen % len(self.fitness_history)] = np.min(fitnesses)
+        self.fitness_range = np.ptp(fitnesses)
+        self.gen = gen + 1
+        X_elite = X[elite_indices, :]
+        Y_elite = (X_elite - old_centroid) / old_sigma
+
+        X_w = np.matmul(self.weights, X_elite)[0]
+        Y_w = np.matmul(self.weights, Y_elite)[0]
+
+        #: 正規分布中心の更新
+        self.centroid = (1 - self.c_m) * old_centroid + self.c_m * X_w
+
+        #: 2. Step-size control
+        invsqrtC_Y_w = self.inverse_transform(Y_w)
+
+        new_p_sigma = (1 - self.c_sigma) * self.p_sigma
+        new_p_sigma += np.sqrt(self.c_sigma * (2 - self.c_sigma) * self.mu_eff) * invsqrtC_Y_w
+        self.p_sigma = new_p_sigma
+
+        norm_p_sigma = np.sqrt((self.p_sigma ** 2).sum())
+
+        self.sigma = self.sigma * np.exp(
+            (self.c_sigma / self.d_sigma) * (norm_p_sigma / self.E_normal - 1)
+        )
+
+        #: 3. Covariance matrix adaptatio (CMA)
+        #: Note, h_σ: heaviside関数はステップサイズσが大きいときにはCの更新を中断させる
+        left = norm_p_sigma / np.sqrt(1 - (1 - self.c_sigma) ** (2 * (gen+1)))
+        right = (1.4 + 2 / (self.dim + 1)) * self.E_normal
+        hsigma = 1 if left < right else 0
+        d_hsigma = (1 - hsigma) * self.c_c * (2 - self.c_c)
+
+        #: p_cの更新
+        new_p_c = (1 - self.c_c) * self.p_c
+        new_p_c += hsigma * np.sqrt(self.c_c * (2 - self.c_c) * self.mu_eff) * Y_w
+        self.p_c = new_p_c
+
+        self.update_covariance(Y_elite, d_hsigma, gen)
+
+    def transform(self, Z):
+        """z ~ N(0, I) -> y = BDz ~ N(0, C)
+            (BD)z を個体ぶんまとめて Z (BD)^T で計算する
+        """
+        return np.matmul(Z, (self.B * self.D).T)
+
+    def inverse_transform(self, y):
+        """C^(-1/2) y = B D^-1 B^T y をキャッシュしたB, Dで計算する (dim×dimの行列は作らない)
+        """
+        return np.matmul(self.B, np.matmul(self.B.T, y) / self.D)
+
+    def update_covariance(self, Y_elite, d_hsigma, gen):
+
+        #: Cはin-placeで更新して (dim×dim) の一時配列を増やさない
+        self.C *= (1 + self.c_1 * d_hsigma - self.c_1 - self.c_mu)
+        self.C += self.c_1 * np.outer(self.p_c, self.p_c)
+
+        #: rank-μ更新: Σ w_i y_i y_i^T = (w * Y^T) Y を1回の行列積で
+        self.C += self.c_mu * np.matmul(self.weights * Y_elite.T, Y_elite)
+
+        self.update_eigen(gen + 1)
+
+
+class SepCMAES(CMAES):
+    """Separable CMA-ES (sep-CMA, Ros & Hansen 2008)
+
+        共分散行列を対角に制限し、Cは分散のベクトル (shape==(dim,)) で持つ
+        メモリと1世代の計算量がO(λ dim)になるのでNNの重みのような
+        1万次元以上の探索でも使える
+        対角成分だけを学習するぶん学習率c_1, c_μを (dim+2)/3 倍に引き上げる
+    """
+
+    def __init__(self, centroid, sigma, lam=None):
+
+        super().__init__(centroid, sigma, lam=lam)
+
+        self.c_1 = self.c_1 * (self.dim + 2) / 3
+        self.c_mu = min(1 - self.c_1, self.c_mu * (self.dim + 2) / 3)
+
+    def init_covariance(self):
+
+        self.C = np.ones(self.dim)
+
+        #: 固有値分解は不要 (B = I)
+        self.B = None
+        self.D = np.ones(self.dim)
+        self.eigen_interval = 1
+
+    def update_eigen(self, gen=None, force=False):
+
+        self.D = np.sqrt(self.C)
+
+    def transform(self, Z):
+
+        return Z * self.D
+
+    def inverse_transform(self, y):
+
+        return y / self.D
+
+    def update_covariance(self, Y_elite, d_hsigma, gen):
+
+        self.C *= (1 + self.c_1 * d_hsigma - self.c_1 - self.c_mu)
+        self.C += self.c_1 * self.p_c ** 2
+        self.C += self.c_mu * np.matmul(self.weights, Y_elite ** 2)[0]
+
+        self.update_eigen(gen + 1)
@@ -0,0 +1,179 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+
+
+class Evaluator:
+    """個体群の適合度評価
+
+        fitness_func(x, seed) -> float を個体ごとに呼び、
+        完了順に関わらず適合度を個体群の順番 (Xの行順) で返す
+        seedは個体ごとに振るので、エピソード評価のような確率的な目的関数でも
+        (X, seeds) が同じなら同じ適合度が再現できる
+    """
+
+    def __init__(self, fitness_func, timeout=None, penalty=np.inf, seed=None):
+
+        self.fitness_func = fitness_func
+
+        #: 1回のevaluate全体の制限時間 (秒) 、超過した個体はpenaltyとして扱う
+        self.timeout = timeout
+
+        #: 最小化問題なので既定は+inf (必ず最下位になる)
+        self.penalty = penalty
+
+        self.rng = np.random.RandomState(seed)
+
+    def sample_seeds(self, n):
+
+        return self.rng.randint(0, 2**31 - 1, size=n)
+
+    def evaluate(self, X, seeds=None):
+        """
+        Args:
+            X (np.ndarray): 個体群, shape==(n, dim)
+            seeds (np.ndarray): 個体ごとのseed, Noneならself.rngから発生
+
+        Returns:
+            np.ndarray: shape==(n,), 個体群の順番での適合度
+        """
+        seeds = self.sample_seeds(len(X)) if seeds is None else seeds
+
+        fitnesses = np.full(len(X), self.penalty, dtype=np.float64)
+
+        self._evaluate(X, seeds, fitnesses)
+
+        return fitnesses
+
+    def _evaluate(self, X, seeds, fitnesses):
+
+        start = time.time()
+
+        for i, (x, seed) in enumerate(zip(X, seeds)):
+            if self.timeout is not None and time.time() - start > self.timeout:
+                break
+            fitnesses[i] = self.fitness_func(x, seed)
+
+    def close(self):
+        pass
+
+
+class ProcessPoolEvaluator(Evaluator):
+    """concurrent.futuresのプロセスプールで個体ごとに並列評価する
+
+        fitness_funcはpickle可能 (モジュールのトップレベルで定義された関数) であること
+        initializerでworkerごとの重い初期化 (gym環境の作成など) を1回だけ行える
+        TensorFlowを使う目的関数ではforkを避けてmp_context=spawnを渡す
+        Note. プロセスプールは実行中のタスクを止められないので、
+        時間切れの個体は結果を捨ててpenaltyにするだけでworkerはそのまま走り切る
+    """
+
+    def __init__(self, fitness_func, n_workers=None, timeout=None, penalty=np.inf,
+                 seed=None, initializer=None, initargs=(), mp_context=None):
+
+        super().__init__(fitness_func, timeout=timeout, penalty=penalty, seed=seed)
+
+        self.pool = ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=mp_context,
+            initializer=initializer, initargs=initargs)
+
+    def _evaluate(self, X, seeds, fitnesses):
+
+        futures = {self.pool.submit(self.fitness_func, x, seed): i
+                   for i, (x, seed) in enumerate(zip(X, seeds))}
+
+        _, not_done = wait(futures, timeout=self.timeout)
+
+        for future in not_done:
+            future.cancel()
+
+        for future, i in futures.items():
+            if future in not_done:
+                continue
+            fitnesses[i] = future.result()
+
+    def close(self):
+
+        self.pool.shutdown(wait=False)
+
+
+class EvalWorker:
+    """RayEvaluatorのworker、fitness_funcを保持して1個体ずつ評価する
+    """
+
+    def __init__(self, fitness_func):
+
+        self.fitness_func = fitness_func
+
+    def evaluate(self, x, seed):
+
+        return self.fitness_func(x, seed)
+
+
+class RayEvaluator(Evaluator):
+    """Rayのactorで個体ごとに並列評価する
+
+        n_workers個のactorに1個体ずつ投げ、ray.waitで完了したactorから
+        順に次の個体を割り当てる (評価時間がばらついてもactorを遊ばせない)
+        時間切れになったactorはkillして作り直す
+    """
+
+    def __init__(self, fitness_func, n_workers=4, timeout=None, penalty=np.inf, seed=None):
+
+        import ray
+
+        super().__init__(fitness_func, timeout=timeout, penalty=penalty, seed=seed)
+
+        self.ray = ray
+
+        if not ray.is_initialized():
+            ray.init()
+
+        self.remote_worker = ray.remote(num_cpus=1)(EvalWorker)
+
+        self.workers = [self.remote_worker.remote(fitness_func) for _ in range(n_workers)]
+
+    def _evaluate(self, X, seeds, fitnesses):
+
+        ray = self.ray
+
+        start = time.time()
+
+        queue = list(range(len(X)))
+
+        idle_workers = list(self.workers)
+
+        #: ObjectRef -> (個体index, worker)
+        running = {}
+
+        while queue or running:
+
+            while queue and idle_workers:
+                i, worker = queue.pop(0), idle_workers.pop()
+                running[worker.evaluate.remote(X[i], seeds[i])] = (i, worker)
+
+            if self.timeout is None:
+                remaining = None
+            else:
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+
+            finished, _ = ray.wait(list(running), num_returns=1, timeout=remaining)
+
+            for ref in finished:
+                i, worker = running.pop(ref)
+                fitnesses[i] = ray.get(ref)
+                idle_workers.append(worker)
+
+        #: 時間切れで走り続けているactorは作り直す
+        for i, worker in running.values():
+            ray.kill(worker)
+            self.workers[self.workers.index(worker)] = self.remote_worker.remote(
+                self.fitness_func)
+
+    def close(self):
+
+        for worker in self.workers:
+            self.ray.kill(worker)
@@ -0,0 +1,48 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+import tensorflow.keras.layers as kl
+import numpy as np
+
+
+class PolicyNetwork(tf.keras.Model):
+    """決定論的方策 (DDPG/TD3のActorNetworkと同じ構造)
+
+        CMA-ESで重みを直接探索するのでoptimizerは持たない
+    """
+
+    def __init__(self, action_space, action_range=2.0):
+
+        super(PolicyNetwork, self).__init__()
+
+        self.action_space = action_space
+
+        self.action_range = action_range
+
+        self.dense1 = kl.Dense(64, activation="relu")
+
+        self.dense2 = kl.Dense(64, activation="relu")
+
+        self.actions = kl.Dense(self.action_space, activation="tanh")
+
+    @tf.function
+    def call(self, s):
+
+        x = self.dense1(s)
+
+        x = self.dense2(x)
+
+        actions = self.actions(x)
+
+        actions = actions * self.action_range
+
+        return actions
+
+    def sample_action(self, state):
+
+        state = np.atleast_2d(state).astype(np.float32)
+
+        action = self(state).numpy()[0]
+
+        return action
@@ -0,0 +1,216 @@
+import multiprocessing
+import time
+
+import gym
+import numpy as np
+
+from cmaes import CMAES, SepCMAES
+from evaluator import Evaluator, ProcessPoolEvaluator, RayEvaluator
+from models import PolicyNetwork
+
+
+class FlatWeights:
+    """Kerasモデルのtrainable_variablesを1本のnumpyベクトルとして読み書きする
+    """
+
+    def __init__(self, model):
+
+        self.variables = model.trainable_variables
+
+        self.shapes = [var.shape for var in self.variables]
+
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+
+        self.size = sum(self.sizes)
+
+    def get_flat(self):
+
+        return np.concatenate([var.numpy().ravel() for var in self.variables])
+
+    def set_flat(self, flat):
+
+        for var, value, shape in zip(self.variables,
+                                     np.split(flat, np.cumsum(self.sizes)[:-1]),
+                                     self.shapes):
+            var.assign(value.reshape(shape).astype(np.float32))
+
+
+def build_policy(env, policy_fn):
+
+    policy = policy_fn(action_space=env.action_space.shape[0],
+                       action_range=float(env.action_space.high[0]))
+
+    #: 重みの作成
+    policy(np.zeros((1, *env.observation_space.shape), dtype=np.float32))
+
+    return policy
+
+
+class RolloutWorker:
+    """評価プロセスごとに1つだけ作る環境と方策のペア
+    """
+
+    def __init__(self, env_id, policy_fn):
+
+        self.env = gym.make(env_id)
+
+        self.policy = build_policy(self.env, policy_fn)
+
+        self.flat = FlatWeights(self.policy)
+
+    def rollout(self, x, seed, n_episodes, max_steps):
+
+        self.flat.set_flat(x)
+
+        self.env.seed(int(seed))
+
+        total_reward = 0
+
+        for _ in range(n_episodes):
+
+            state = self.env.reset()
+
+            for _ in range(max_steps):
+
+                action = self.policy.sample_action(state)
+
+                state, reward, done, _ = self.env.step(action)
+
+                total_reward += reward
+
+                if done:
+                    break
+
+        return total_reward / n_episodes
+
+
+#: (env_id, policy_fn) -> RolloutWorker, 評価プロセス内でのキャッシュ
+_workers = {}
+
+
+class RolloutFitness:
+    """Evaluator用の適合度関数: 個体の重みで方策を動かし、平均報酬の符号反転を返す
+
+        環境と方策は評価プロセス側で初回呼び出し時に作ってキャッシュするので、
+        pickleされて送られるのはenv_idなどの設定だけになる
+    """
+
+    def __init__(self, env_id, policy_fn, n_episodes=1, max_steps=1000):
+
+        self.env_id = env_id
+
+        self.policy_fn = policy_fn
+
+        self.n_episodes = n_episodes
+
+        self.max_steps = max_steps
+
+    def __call__(self, x, seed):
+
+        key = (self.env_id, self.policy_fn)
+
+        if key not in _workers:
+            _workers[key] = RolloutWorker(self.env_id, self.policy_fn)
+
+        #: CMA-ESは最小化なので報酬の符号を反転する
+        return -1 * _workers[key].rollout(x, seed, self.n_episodes, self.max_steps)
+
+
+class NeuroEvolution:
+    """CMA-ESで方策ネットワークの重みを直接最適化する
+
+        separable=Noneのときは次元数がSEP_THRESHOLDを超えたらsep-CMAを使う
+        (フルの共分散行列は dim^2 のメモリと dim^3 の固有値分解が必要なため)
+    """
+
+    SEP_THRESHOLD = 1000
+
+    def __init__(self, env_id, policy_fn=PolicyNetwork, sigma=0.1, lam=None,
+                 separable=None, n_episodes=1, max_steps=1000,
+                 backend="process", n_workers=4, timeout=None, seed=None):
+
+        self.env_id = env_id
+
+        self.env = gym.make(env_id)
+
+        self.policy = build_policy(self.env, policy_fn)
+
+        self.flat = FlatWeights(self.policy)
+
+        if separable is None:
+            separable = self.flat.size > self.SEP_THRESHOLD
+
+        ES = SepCMAES if separable else CMAES
+
+        self.es = ES(centroid=self.flat.get_flat(), sigma=sigma, lam=lam)
+
+        fitness_func = RolloutFitness(env_id, policy_fn, n_episodes, max_steps)
+
+        if backend == "process":
+            #: 親プロセスでTensorFlowを初期化済みなのでforkではなくspawnで起動する
+            self.evaluator = ProcessPoolEvaluator(
+                fitness_func, n_workers=n_workers, timeout=timeout, seed=seed,
+                mp_context=multiprocessing.get_context("spawn"))
+        elif backend == "ray":
+            self.evaluator = RayEvaluator(
+                fitness_func, n_workers=n_workers, timeout=timeout, seed=seed)
+        else:
+            self.evaluator = Evaluator(fitness_func, timeout=timeout, seed=seed)
+
+        self.best_x = self.flat.get_flat()
+
+        self.best_fitness = np.inf
+
+        self.history = []
+
+    def train(self, n_generations):
+
+        for gen in range(n_generations):
+
+            start = time.time()
+
+            X = self.es.sample_population()
+
+            fitnesses = self.evaluator.evaluate(X)
+
+            self.es.update(X, fitnesses, gen)
+
+            idx = np.argmin(fitnesses)
+
+            if fitnesses[idx] < self.best_fitness:
+                self.best_fitness = fitnesses[idx]
+                self.best_x = X[idx].copy()
+
+            self.history.append(-1 * fitnesses.mean())
+
+            print(f"Generation {gen}: mean reward {-1 * fitnesses.mean():.1f},",
+                  f"best reward {-1 * fitnesses[idx]:.1f},",
+                  f"sigma {self.es.sigma:.4f}, {time.time() - start:.1f}sec")
+
+        #: 最良個体の重みをdriver側の方策に書き戻す
+        self.flat.set_flat(self.best_x)
+
+    def save_model(self):
+
+        self.policy.save_weights("checkpoints/policy")
+
+    def close(self):
+
+        self.evaluator.close()
+
+
+def main(n_generations=100):
+
+    trainer = NeuroEvolution("Pendulum-v0", n_workers=4)
+
+    print("Number of parameters:", trainer.flat.size)
+
+    trainer.train(n_generations)
+
+    trainer.save_model()
+
+    trainer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import numpy as np
+
+from cmaes import CMAES, SepCMAES
+
+
+def termination_flags(instances, tolfun=1e-12, tolx=1e-12, max_condition=1e14):
+    """同じ次元数の複数インスタンスの停止条件を配列演算でまとめて判定する
+
+        tolfun: 直近の世代の最良適合度と現世代の適合度の幅がtolfun未満
+        tolx: 全次元で σ * max(|p_c|, √C_ii) < tolx
+        condition: Cの条件数 (D_max/D_min)^2 がmax_conditionを超えた
+        maxiter: 100 + 50(dim+3)^2/√λ 世代を超えた
+        nan: σが発散/消失した
+
+    Returns:
+        dict: 条件名 -> shape==(len(instances),)のbool配列
+    """
+    dim = instances[0].dim
+
+    sigma = np.array([es.sigma for es in instances])
+
+    lam = np.array([es.lam for es in instances])
+
+    gen = np.array([es.gen for es in instances])
+
+    p_c = np.stack([es.p_c for es in instances])
+
+    diagC = np.stack([es.C if es.C.ndim == 1 else np.diagonal(es.C) for es in instances])
+
+    D = np.stack([es.D for es in instances])
+
+    #: 履歴の長さはλで変わるのでNaNで埋めて (n_instances, max_len) に揃える
+    history_len = np.array([len(es.fitness_history) for es in instances])
+
+    history = np.full((len(instances), history_len.max()), np.nan)
+    for i, es in enumerate(instances):
+        history[i, :history_len[i]] = es.fitness_history
+
+    is_nan = np.isnan(history)
+    history_range = (np.where(is_nan, -np.inf, history).max(axis=1)
+                     - np.where(is_nan, np.inf, history).min(axis=1))
+
+    fitness_range = np.maximum(
+        history_range, np.array([es.fitness_range for es in instances]))
+
+    flags = {
+        "tolfun": (gen >= history_len) & (fitness_range < tolfun),
+        "tolx": np.all(sigma[:, None] * np.maximum(np.abs(p_c), np.sqrt(diagC)) < tolx, axis=1),
+        "condition": (D.max(axis=1) / D.min(axis=1)) ** 2 > max_condition,
+        "maxiter": gen > 100 + 50 * (dim + 3) ** 2 / np.sqrt(lam),
+        "nan": ~np.isfinite(sigma) | (sigma <= 0),
+    }
+
+    return flags
+
+
+class RestartCMAES:
+    """IPOP/BIPOP-CMA-ES
+
+        n_parallel個のCMA-ESインスタンスを同時に走らせ、全インスタンスの個体群を
+        1つに結合して1回のevaluator.evaluateで評価する
+        (evaluatorは空いたworkerから順に個体を割り当てるので、
+         λの小さいインスタンスの評価が先に終わっても他のインスタンスの個体でworkerが埋まる)
+        停止したインスタンスはstrategyに従ってλ, σ, 初期点を決め直して作り直す
+
+        ipop: 再スタートのたびにλをinc_popsize倍
+        bipop: λを倍々にするlarge regimeと、λ, σを小さめにランダムに選ぶsmall regimeを
+               両者の消費評価回数が釣り合うように交互に使う
+    """
+
+    def __init__(self, evaluator, lower, upper, sigma0, strategy="ipop",
+                 n_parallel=1, max_evals=100000, lam=None, inc_popsize=2,
+                 separable=False, ftarget=-np.inf, seed=None,
+                 tolfun=1e-12, tolx=1e-12, max_condition=1e14):
+
+        assert strategy in ["ipop", "bipop"]
+
+        self.evaluator = evaluator
+
+        self.lower = np.asarray(lower, dtype=np.float64)
+
+        self.upper = np.asarray(upper, dtype=np.float64)
+
+        self.dim = len(self.lower)
+
+        self.sigma0 = sigma0
+
+        self.strategy = strategy
+
+        self.n_parallel = n_parallel
+
+        self.max_evals = max_evals
+
+        self.lam_default = lam if lam else int(4 + 3*np.log(self.dim))
+
+        self.inc_popsize = inc_popsize
+
+        self.ES = SepCMAES if separable else CMAES
+
+        self.ftarget = ftarget
+
+        self.tolfun = tolfun
+
+        #: tolxは初期ステップサイズに対する相対値
+        self.tolx = tolx * sigma0
+
+        self.max_condition = max_condition
+
+        self.rng = np.random.RandomState(seed)
+
+        #: large regimeで何回λを増やしたか
+        self.n_large = 0
+
+        #: regimeごとの消費評価回数
+        self.evals = {"large": 0, "small": 0}
+
+        self.n_evals = 0
+
+        self.n_restarts = 0
+
+        self.best_x = None
+
+        self.best_fitness = np.inf
+
+        self.history = []
+
+    def new_instance(self, first=False):
+        """次に走らせるインスタンスとそのregimeを返す
+        """
+        x0 = self.rng.uniform(self.lower, self.upper)
+
+        if first:
+            return self.ES(x0, self.sigma0, lam=self.lam_default), "large"
+
+        if self.strategy == "bipop" and self.evals["small"] < self.evals["large"]:
+            u = self.rng.uniform()
+            lam_large = self.lam_default * self.inc_popsize ** self.n_large
+            lam = int(self.lam_default * (0.5 * lam_large / self.lam_default) ** (u ** 2))
+            sigma = self.sigma0 * 10 ** (-2 * u)
+            return self.ES(x0, sigma, lam=max(lam, 4)), "small"
+
+        self.n_large += 1
+        lam = self.lam_default * self.inc_popsize ** self.n_large
+
+        return self.ES(x0, self.sigma0, lam=lam), "large"
+
+    def run(self, verbose=True):
+
+        self.instances, self.regimes = map(list, zip(
+            *[self.new_instance(first=True) for _ in range(self.n_parallel)]))
+
+        while self.n_evals < self.max_evals and self.best_fitness > self.ftarget:
+
+            populations = [es.sample_population() for es in self.instances]
+
+            #: 全インスタンスぶんを1回で評価する
+            fitnesses = self.evaluator.evaluate(np.vstack(populations))
+
+            offsets = np.cumsum([len(X) for X in populations])[:-1]
+
+            for es, regime, X, f in zip(self.instances, self.regimes,
+                                        populations, np.split(fitnesses, offsets)):
+
+                es.update(X, f, es.gen)
+
+                self.evals[regime] += len(X)
+
+                idx = np.argmin(f)
+                if f[idx] < self.best_fitness:
+                    self.best_fitness = f[idx]
+                    self.best_x = X[idx].copy()
+
+            self.n_evals += len(fitnesses)
+
+            self.history.append((self.n_evals, self.best_fitness))
+
+            flags = termination_flags(self.instances, tolfun=self.tolfun,
+                                      tolx=self.tolx, max_condition=self.max_condition)
+
+            stopped = np.any(np.stack(list(flags.values())), axis=0)
+
+            for i in np.flatnonzero(stopped):
+
+                reasons = [name for name, flag in flags.items() if flag[i]]
+
+                self.instances[i], self.regimes[i] = self.new_instance()
+
+                self.n_restarts += 1
+
+                if verbose:
+                    print(f"Restart {self.n_restarts} ({', '.join(reasons)}):",
+                          f"evals {self.n_evals}, best {self.best_fitness:.3e},",
+                          f"next lam {self.instances[i].lam} ({self.regimes[i]})")
+
+        return self.best_x, self.best_fitness
+
+
+def main():
+
+    from evaluator import Evaluator
+    from main import levi_fitness
+
+    evaluator = Evaluator(levi_fitness)
+
+    optimizer = RestartCMAES(evaluator, lower=[-15, -15], upper=[8, 8], sigma0=2.0,
+                             strategy="bipop", n_parallel=2, max_evals=20000,
+                             ftarget=1e-10, seed=0)
+
+    best_x, best_fitness = optimizer.run()
+
+    print("best x:", best_x, "fitness:", best_fitness)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import glob
+import os
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.animation as animation
+from matplotlib.patches import Ellipse
+
+
+class TraceWriter:
+    """世代ごとのCMA-ESの状態をchunk_size世代ずつnpzへ追記していくログ
+
+        メモリに持つのは書き出し前の1chunkぶんだけなので、
+        何万世代まわしても使用メモリは増えず、実行中でも書き出し済みのchunkは読める
+        chunkは一時ファイルに書いてからos.replaceするので、読み手が書きかけのファイルを見ることはない
+
+        1世代あたりの記録:
+            gen, sigma, centroid (dim,), 共分散 (dim <= max_cov_dimなら(dim, dim), それ以外は対角(dim,))
+            適合度のmin/mean/median/max, 最良個体 (dim,)
+            save_population=Trueなら個体群 X (λ, dim) と適合度 (λ,) も
+
+        同じlogdirに前回の実行のchunkが残っていると読み出し時に混ざるので、初期化時に削除する
+    """
+
+    def __init__(self, logdir, chunk_size=100, max_cov_dim=100, save_population=False):
+
+        self.logdir = logdir
+
+        self.chunk_size = chunk_size
+
+        self.max_cov_dim = max_cov_dim
+
+        self.save_population = save_population
+
+        os.makedirs(logdir, exist_ok=True)
+
+        for path in glob.glob(os.path.join(logdir, "trace_*.npz*")):
+            os.remove(path)
+
+        self.buffer = []
+
+    def append(self, gen, cmaes, X, fitnesses):
+
+        fitnesses = np.asarray(fitnesses).flatten()
+
+        if cmaes.C.ndim == 2 and cmaes.dim > self.max_cov_dim:
+            cov = np.diag(cmaes.C)
+        else:
+            cov = cmaes.C
+
+        record = {"gen": gen,
+                  "sigma": cmaes.sigma,
+                  "centroid": cmaes.centroid.copy(),
+                  "cov": cov.copy(),
+                  "fitness_min": fitnesses.min(),
+                  "fitness_mean": fitnesses.mean(),
+                  "fitness_median": np.median(fitnesses),
+                  "fitness_max": fitnesses.max(),
+                  "best": X[np.argmin(fitnesses)].copy()}
+
+        if self.save_population:
+            record["X"] = X.copy()
+            record["fitnesses"] = fitnesses.copy()
+
+        self.buffer.append(record)
+
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+
+        if not self.buffer:
+            return
+
+        chunk = {key: np.stack([record[key] for record in self.buffer])
+                 for key in self.buffer[0]}
+
+        path = os.path.join(self.logdir, f"trace_{self.buffer[0]['gen']:08d}.npz")
+
+        with open(path + ".tmp", "wb") as f:
+            np.savez_compressed(f, **chunk)
+
+        os.replace(path + ".tmp", path)
+
+        self.buffer = []
+
+    def close(self):
+
+        self.flush()
+
+
+def iter_chunks(logdir):
+    """書き出し済みのchunkを世代順に読み、(path, chunk) を返す
+    """
+    for path in sorted(glob.glob(os.path.join(logdir, "trace_*.npz"))):
+
+        with np.load(path) as chunk:
+            chunk = {key: chunk[key] for key in chunk.files}
+
+        yield path, chunk
+
+
+def iter_trace(logdir, start_gen=0):
+    """書き出し済みのchunkを1つずつ読み、1世代ぶんのdictを順に返す
+    """
+    for _, chunk in iter_chunks(logdir):
+
+        if chunk["gen"][-1] < start_gen:
+            continue
+
+        for i in range(len(chunk["gen"])):
+            if chunk["gen"][i] >= start_gen:
+                yield {key: values[i] for key, values in chunk.items()}
+
+
+def draw_generation(ax, record):
+    """2次元の個体群と1σ, 2σ, 3σの楕円を描画し、追加したartistを返す
+        https://stackoverflow.com/questions/20126061/creating-a-confidence-ellipses-in-a-sccatterplot-using-matplotlib
+    """
+    artists = []
+
+    if "X" in record:
+        X = record["X"]
+        artists.append(ax.scatter(X[:, 0], X[:, 1], c="firebrick", ec="white"))
+
+    centroid, sigma, cov = record["centroid"], record["sigma"], record["cov"]
+
+    if cov.ndim == 1:
+        cov = np.diag(cov)
+
+    lambda_, v = np.linalg.eigh(cov[:2, :2])
+    lambda_ = np.sqrt(lambda_)
+
+    for j in range(1, 4):
+        ell = Ellipse(xy=(centroid[0], centroid[1]),
+                      width=lambda_[0]*j*2*sigma,
+                      height=lambda_[1]*j*2*sigma,
+                      angle=np.rad2deg(np.arctan2(v[1, 0], v[0, 0])),
+                      fc="none", ec="firebrick", ls="--")
+        artists.append(ax.add_patch(ell))
+
+    return artists
+
+
+def render_frames(logdir, framedir, background):
+    """1世代1枚のpngとして描画する
+
+        元のchunkより新しいフレームだけを描画済みとみなして飛ばすので、
+        学習中に繰り返し呼べば新しい世代だけが追加される
+        前回の実行のフレーム (chunkより古い、またはtraceにない世代) は描き直すか削除する
+        background: () -> (fig, ax)
+    """
+    os.makedirs(framedir, exist_ok=True)
+
+    fig, ax = background()
+
+    rendered = set()
+
+    for chunk_path, chunk in iter_chunks(logdir):
+
+        chunk_mtime = os.path.getmtime(chunk_path)
+
+        for i, gen in enumerate(chunk["gen"]):
+
+            path = os.path.join(framedir, f"{gen:08d}.png")
+
+            rendered.add(path)
+
+            if os.path.exists(path) and os.path.getmtime(path) >= chunk_mtime:
+                continue
+
+            artists = draw_generation(ax, {key: values[i] for key, values in chunk.items()})
+
+            ax.set_title(f"Generation {gen}")
+
+            fig.savefig(path)
+
+            for artist in artists:
+                artist.remove()
+
+    plt.close(fig)
+
+    for path in glob.glob(os.path.join(framedir, "*.png")):
+        if path not in rendered:
+            os.remove(path)
+
+
+def render_animation(logdir, savepath, background, fps=2.5):
+    """traceから1フレームずつ描いてはwriterに渡す
+
+        Figureにはそのフレームのartistしか載せないので描画側のメモリは一定
+        (gifのPillowWriterだけはフレーム画像を最後まで保持するので、長い実行にはmp4を使う)
+    """
+    fig, ax = background()
+
+    Writer = animation.PillowWriter if savepath.endswith(".gif") else animation.FFMpegWriter
+
+    writer = Writer(fps=fps)
+
+    with writer.saving(fig, savepath, dpi=fig.dpi):
+
+        for record in iter_trace(logdir):
+
+            artists = draw_generation(ax, record)
+
+            writer.grab_frame()
+
+            for artist in artists:
+                artist.remove()
+
+    plt.close(fig)
@@ -0,0 +1,113 @@
+import numpy as np
+import tensorflow as tf
+
+
+def epsilon_ladder(n_slots, base_epsilon=0.4, alpha=7.):
+    """Ape-X式のεのはしご: ε_i = base_epsilon^(1 + alpha * i / (N-1))
+    """
+    if n_slots == 1:
+        return np.array([base_epsilon], dtype=np.float32)
+
+    i = np.arange(n_slots)
+
+    return (base_epsilon ** (1 + alpha * i / (n_slots - 1))).astype(np.float32)
+
+
+@tf.function
+def epsilon_greedy(qvalues, epsilons):
+    """バッチ全体のε-greedyをグラフ内でまとめて行う
+
+        qvalues: (B, action_space), epsilons: (B,)
+        乱数はtf.randomでバッチぶん一度に生成するのでpythonの乱数は呼ばない
+    """
+    batch_size = tf.shape(qvalues)[0]
+    action_space = tf.shape(qvalues)[1]
+
+    greedy_actions = tf.argmax(qvalues, axis=1, output_type=tf.int32)
+
+    random_actions = tf.random.uniform(
+        (batch_size,), maxval=action_space, dtype=tf.int32)
+
+    is_random = tf.random.uniform((batch_size,)) < epsilons
+
+    actions = tf.where(is_random, random_actions, greedy_actions)
+
+    return actions, is_random
+
+
+class Exploration:
+    """actor/envスロットごとのεの割り当てと探索の統計
+
+        scheduler=None: スロットごとに固定のε (Ape-Xのはしご)
+        scheduler=callable: 全スロット共通のεを環境ステップ数から決める
+    """
+
+    def __init__(self, n_slots, action_space, scheduler=None,
+                 base_epsilon=0.4, alpha=7.):
+
+        self.n_slots = n_slots
+
+        self.action_space = action_space
+
+        self.scheduler = scheduler
+
+        self.ladder = epsilon_ladder(n_slots, base_epsilon, alpha)
+
+        self.reset_stats()
+
+    def epsilons(self, steps):
+
+        if self.scheduler is None:
+            self._epsilons = self.ladder
+        else:
+            self._epsilons = np.full(
+                self.n_slots, self.scheduler(steps), dtype=np.float32)
+
+        return self._epsilons
+
+    def reset_stats(self):
+
+        self.n_actions = 0
+
+        self.n_random_actions = np.zeros(self.n_slots, dtype=np.int64)
+
+        self.action_counts = np.zeros(self.action_space, dtype=np.int64)
+
+    def record(self, actions, is_random):
+
+        self.n_actions += 1
+
+        self.n_random_actions += is_random
+
+        self.action_counts += np.bincount(actions, minlength=self.action_space)
+
+    def log(self, summary_writer, step):
+        """前回のlog以降の探索の統計を書き出してリセットする
+        """
+        if self.n_actions == 0:
+            return
+
+        action_probs = self.action_counts / self.action_counts.sum()
+        action_entropy = -np.sum(action_probs * np.log(action_probs + 1e-8))
+
+        with summary_writer.as_default():
+            tf.summary.scalar("epsilon_mean", self._epsilons.mean(), step=step)
+            tf.summary.scalar("epsilon_min", self._epsilons.min(), step=step)
+            tf.summary.scalar("epsilon_max", self._epsilons.max(), step=step)
+            tf.summary.scalar("random_action_ratio",
+                              self.n_random_actions.sum() / (self.n_actions * self.n_slots),
+                              step=step)
+            tf.summary.scalar("action_entropy", action_entropy, step=step)
+            tf.summary.histogram("random_action_ratio_per_slot",
+                                 self.n_random_actions / self.n_actions, step=step)
+
+        self.reset_stats()
+
+
+if __name__ == "__main__":
+
+    print(epsilon_ladder(8))
+
+    qvalues = tf.constant(np.random.random((8, 4)), dtype=tf.float32)
+    actions, is_random = epsilon_greedy(qvalues, epsilon_ladder(8))
+    print(actions.numpy(), is_random.numpy())
@@ -8,7 +8,9 @@ import collections
 
 from model import CategoricalQNet
 from buffer import Experience, ReplayBuffer
-from util import frame_preprocess
+from util import frame_preprocess, loss_scale_optimizer, TargetNetworkUpdater
+from env import VecEnv, SubProcVecEnv
+from exploration import Exploration
 
 
 class CategoricalDQNAgent:
@@ -18,7 +20,8 @@ class CategoricalDQNAgent:
                  n_frames=4, batch_size=32, lr=0.00025,
                  init_epsilon=0.95,
                  update_period=8,
-                 target_update_period=10000):
+                 target_update_period=10000,
+                 mixed_precision=None):
 
         self.env_name = env_name
 
@@ -51,13 +54,22 @@ class CategoricalDQNAgent:
 
         self.action_space = env.action_space.n
 
+        #: None (float32), "float16", "bfloat16"
+        #: mixed precisionではフレームをuint8のまま扱い、ネットワーク内で正規化する
+        self.mixed_precision = mixed_precision
+
+        self.uint8_frames = mixed_precision is not None
+
         self.qnet = CategoricalQNet(
-            self.action_space, self.n_atoms, self.Z)
+            self.action_space, self.n_atoms, self.Z, mixed_precision)
 
         self.target_qnet = CategoricalQNet(
-            self.action_space, self.n_atoms, self.Z)
+            self.action_space, self.n_atoms, self.Z, mixed_precision)
 
-        self.optimizer = tf.keras.optimizers.Adam(lr=lr, epsilon=0.01/batch_size)
+        self.target_updater = TargetNetworkUpdater(self.target_qnet, self.qnet)
+
+        self.optimizer = loss_scale_optimizer(
+            tf.keras.optimizers.Adam(lr=lr, epsilon=0.01/batch_size), mixed_precision)
 
     def learn(self, n_episodes, buffer_size=800000, logdir="log"):
 
@@ -73,7 +85,7 @@ class CategoricalDQNAgent:
             env = gym.make(self.env_name)
 
             frames = collections.deque(maxlen=4)
-            frame = frame_preprocess(env.reset())
+            frame = frame_preprocess(env.reset(), self.uint8_frames)
             for _ in range(self.n_frames):
                 frames.append(frame)
 
@@ -81,7 +93,7 @@ class CategoricalDQNAgent:
             state = np.stack(frames, axis=2)[np.newaxis, ...]
             self.qnet(state)
             self.target_qnet(state)
-            self.target_qnet.set_weights(self.qnet.get_weights())
+            self.target_updater.hard_update()
 
             episode_rewards = 0
             episode_steps = 0
@@ -99,7 +111,7 @@ class CategoricalDQNAgent:
                 action = self.qnet.sample_action(state, epsilon=epsilon)
                 next_frame, reward, done, info = env.step(action)
                 episode_rewards += reward
-                frames.append(frame_preprocess(next_frame))
+                frames.append(frame_preprocess(next_frame, self.uint8_frames))
                 next_state = np.stack(frames, axis=2)[np.newaxis, ...]
 
                 if done:
@@ -127,7 +139,7 @@ class CategoricalDQNAgent:
 
                 #: Hard target update
                 if steps % self.target_update_period == 0:
-                    self.target_qnet.set_weights(self.qnet.get_weights())
+                    self.target_updater.hard_update()
 
             print(f"Episode: {episode}, score: {episode_rewards}, steps: {episode_steps}")
 
@@ -141,6 +153,104 @@ class CategoricalDQNAgent:
                 print("Model Saved")
                 self.qnet.save_weights("checkpoints/qnet")
 
+    def learn_vectorized(self, total_steps, n_envs=8, use_subprocess=True,
+                         use_epsilon_ladder=False, buffer_size=800000, logdir="log"):
+        """N個の環境を同時に進めるデータ収集モード
+
+            N環境の状態を1回のforwardで評価し、ε-greedyも環境ごとのεでまとめて適用する
+            use_epsilon_ladder=Trueなら環境ごとにApe-X式の固定εを割り当てる
+            N個の遷移は1回の呼び出しでbufferへ追加する
+            update_periodは環境ステップの総数に対して数える
+        """
+
+        logdir = Path(__file__).parent / logdir
+        if logdir.exists():
+            shutil.rmtree(logdir)
+        self.summary_writer = tf.summary.create_file_writer(str(logdir))
+
+        self.replay_buffer = ReplayBuffer(max_len=buffer_size)
+
+        if use_subprocess:
+            vecenv = SubProcVecEnv(self.env_name, n_envs, self.n_frames, self.uint8_frames)
+        else:
+            vecenv = VecEnv(self.env_name, n_envs, self.n_frames, self.uint8_frames)
+
+        if use_epsilon_ladder:
+            exploration = Exploration(n_envs, self.action_space)
+        else:
+            exploration = Exploration(n_envs, self.action_space,
+                                      scheduler=self.epsilon_scheduler)
+
+        states = vecenv.reset()
+
+        #: ネットワーク重みの初期化
+        self.qnet(states[:1])
+        self.target_qnet(states[:1])
+        self.target_updater.hard_update()
+
+        steps = 0
+        episode = 0
+        pending_updates = 0
+        while steps < total_steps:
+
+            epsilons = exploration.epsilons(steps)
+
+            actions, is_random = self.qnet.sample_actions_epsgreedy(states, epsilons)
+
+            exploration.record(actions, is_random)
+
+            results = vecenv.step(actions)
+
+            exps = [Experience(state[np.newaxis, ...], action, result.reward,
+                               result.next_state[np.newaxis, ...],
+                               result.done or result.life_lost)
+                    for state, action, result in zip(states, actions, results)]
+
+            self.replay_buffer.push_batch(exps)
+
+            states = np.stack([result.state for result in results])
+
+            steps += n_envs
+
+            if len(self.replay_buffer) > 20000:
+                pending_updates += n_envs / self.update_period
+                while pending_updates >= 1:
+                    loss = self.update_network()
+                    pending_updates -= 1
+
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar("loss", loss, step=steps)
+                        tf.summary.scalar("buffer_size", len(self.replay_buffer), step=steps)
+
+            #: Hard target update
+            if steps // self.target_update_period != (steps - n_envs) // self.target_update_period:
+                self.target_updater.hard_update()
+
+            for result in results:
+
+                if result.episode_rewards is None:
+                    continue
+
+                episode += 1
+
+                print(f"Episode: {episode}, score: {result.episode_rewards}, steps: {steps}")
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("train_score", result.episode_rewards, step=steps)
+
+                exploration.log(self.summary_writer, steps)
+
+                if episode % 20 == 0:
+                    test_scores, test_steps = self.test_play(n_testplay=1)
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar("test_score", test_scores[0], step=steps)
+                        tf.summary.scalar("test_step", test_steps[0], step=steps)
+
+                if episode % 1000 == 0:
+                    print("Model Saved")
+                    self.qnet.save_weights("checkpoints/qnet")
+
+        vecenv.close()
+
     def update_network(self):
 
         #: ミニバッチの作成
@@ -168,7 +278,15 @@ class CategoricalDQNAgent:
                 -1 * target_dists * tf.math.log(dists), axis=1, keepdims=True)
             loss = tf.reduce_mean(loss)
 
-        grads = tape.gradient(loss, self.qnet.trainable_variables)
+            if self.mixed_precision == "float16":
+                scaled_loss = self.optimizer.get_scaled_loss(loss)
+
+        if self.mixed_precision == "float16":
+            grads = self.optimizer.get_unscaled_gradients(
+                tape.gradient(scaled_loss, self.qnet.trainable_variables))
+        else:
+            grads = tape.gradient(loss, self.qnet.trainable_variables)
+
         self.optimizer.apply_gradients(
             zip(grads, self.qnet.trainable_variables))
 
@@ -241,7 +359,7 @@ class CategoricalDQNAgent:
         if checkpoint_path:
             env = gym.make(self.env_name)
             frames = collections.deque(maxlen=4)
-            frame = frame_preprocess(env.reset())
+            frame = frame_preprocess(env.reset(), self.uint8_frames)
             for _ in range(self.n_frames):
                 frames.append(frame)
             state = np.stack(frames, axis=2)[np.newaxis, ...]
@@ -265,7 +383,7 @@ class CategoricalDQNAgent:
 
             frames = collections.deque(maxlen=4)
 
-            frame = frame_preprocess(env.reset())
+            frame = frame_preprocess(env.reset(), self.uint8_frames)
             for _ in range(self.n_frames):
                 frames.append(frame)
 
@@ -277,7 +395,7 @@ class CategoricalDQNAgent:
                 state = np.stack(frames, axis=2)[np.newaxis, ...]
                 action = self.qnet.sample_action(state, epsilon=0.1)
                 next_frame, reward, done, info = env.step(action)
-                frames.append(frame_preprocess(next_frame))
+                frames.append(frame_preprocess(next_frame, self.uint8_frames))
 
                 episode_rewards += reward
                 episode_steps += 1
@@ -2,10 +2,13 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras.layers as kl
 
+from exploration import epsilon_greedy
+from util import mixed_precision_policy, normalize_frames
+
 
 class CategoricalQNet(tf.keras.Model):
 
-    def __init__(self, actions_space, n_atoms, Z):
+    def __init__(self, actions_space, n_atoms, Z, mixed_precision=None):
 
         super(CategoricalQNet, self).__init__()
 
@@ -15,24 +18,29 @@ class CategoricalQNet(tf.keras.Model):
 
         self.Z = Z  #: 各ビンのしきい値(support)
 
+        #: mixed precisionでは中間層をfloat16/bfloat16で計算し、logits (softmax) だけfloat32に戻す
+        dtype = mixed_precision_policy(mixed_precision)
+
         self.conv1 = kl.Conv2D(32, 8, strides=4, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.conv2 = kl.Conv2D(64, 4, strides=2, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.conv3 = kl.Conv2D(64, 3, strides=1, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
 
-        self.flatten1 = kl.Flatten()
+        self.flatten1 = kl.Flatten(dtype=dtype)
         self.dense1 = kl.Dense(512, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.logits = kl.Dense(self.action_space * self.n_atoms,
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype="float32")
 
     @tf.function
     def call(self, x):
 
         batch_size = x.shape[0]
 
+        x = normalize_frames(x)
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -48,13 +56,21 @@ class CategoricalQNet(tf.keras.Model):
 
     def sample_action(self, x, epsilon=None):
 
-        if (epsilon is None) or (np.random.random() > epsilon):
-            selected_actions, _ = self.sample_actions(x)
-            selected_action = selected_actions[0][0].numpy()
-        else:
-            selected_action = np.random.choice(self.action_space)
+        epsilon = 0. if epsilon is None else epsilon
+
+        selected_actions, _ = self.sample_actions_epsgreedy(
+            x, np.full(x.shape[0], epsilon, dtype=np.float32))
+
+        return selected_actions[0]
+
+    def sample_actions_epsgreedy(self, x, epsilons):
+        """N環境ぶんの状態を1回のforwardで評価し、環境ごとのεでε-greedy
+        """
+        probs = self(x)
+        q_means = tf.reduce_sum(probs * self.Z, axis=2)
+        selected_actions, is_random = epsilon_greedy(q_means, epsilons)
 
-        return selected_action
+        return selected_actions.numpy(), is_random.numpy()
 
     def sample_actions(self, x):
         probs = self(x)
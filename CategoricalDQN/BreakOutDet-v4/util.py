@@ -1,7 +1,11 @@
 import tensorflow as tf
 
 
-def frame_preprocess(frame):
+def frame_preprocess(frame, uint8=False):
+    """
+        uint8=Trueなら0-255のuint8のまま返し、[0, 1]への正規化はネットワーク内で行う
+        (replay bufferのメモリも1/4になる)
+    """
 
     def _frame_preprocess(frame):
         """Breakout向けの切り取りであることに注意
@@ -10,9 +14,127 @@ def frame_preprocess(frame):
         image_gray = tf.image.rgb_to_grayscale(image)
         image_crop = tf.image.crop_to_bounding_box(image_gray, 34, 0, 160, 160)
         image_resize = tf.image.resize(image_crop, [84, 84])
+        if uint8:
+            return tf.cast(tf.round(image_resize), tf.uint8)
         image_scaled = tf.divide(image_resize, 255)
         return image_scaled
 
     frame = _frame_preprocess(frame).numpy()[:, :, 0]
 
     return frame
+
+
+def normalize_frames(x):
+    """uint8で渡されたフレームをグラフ内で[0, 1]のfloat32に変換する (floatの入力はそのまま)
+    """
+    if x.dtype == tf.uint8:
+        x = tf.cast(x, tf.float32) / 255.
+
+    return x
+
+
+def mixed_precision_policy(mixed_precision):
+    """
+        mixed_precision: None (float32), "float16", "bfloat16"
+        変数はfloat32のまま、演算をfloat16/bfloat16で行うpolicyを返す
+    """
+    if mixed_precision is None:
+        return None
+
+    assert mixed_precision in ["float16", "bfloat16"]
+
+    if mixed_precision == "bfloat16" and not is_bfloat16_supported():
+        print("bfloat16 conv is not supported on this device, fall back to float32")
+        return None
+
+    return tf.keras.mixed_precision.experimental.Policy(f"mixed_{mixed_precision}")
+
+
+def is_bfloat16_supported():
+    """このデバイス (CPUなど) にbfloat16の畳み込みカーネルがあるか
+    """
+    try:
+        tf.nn.conv2d(tf.zeros((1, 8, 8, 1), dtype=tf.bfloat16),
+                     tf.zeros((3, 3, 1, 1), dtype=tf.bfloat16), 1, "VALID")
+        return True
+    except (tf.errors.NotFoundError, tf.errors.InvalidArgumentError):
+        return False
+
+
+def loss_scale_optimizer(optimizer, mixed_precision):
+    """float16は勾配がアンダーフローしやすいので動的loss scalingを掛ける
+        bfloat16は指数部がfloat32と同じ幅なのでloss scalingは不要
+    """
+    if mixed_precision == "float16":
+        return tf.keras.mixed_precision.experimental.LossScaleOptimizer(
+            optimizer, loss_scale="dynamic")
+
+    return optimizer
+
+
+class TargetNetworkUpdater:
+    """targetネットワークの変数をonlineネットワークの変数と対応づけて保持し、
+       target = (1 - tau) * target + tau * online をグラフ内のassignで行う
+
+        重みをnumpyに書き出さないのでhostとの往復コピーが発生しない
+        fused=Trueなら全変数を1本のベクトルに連結して1回の演算でまとめて計算する
+        tf.functionの中から呼ぶとそのグラフに埋め込まれる
+        両ネットワークはbuild済みであること
+    """
+
+    def __init__(self, target_network, online_network, tau=1.0, fused=False):
+
+        self.target_network = target_network
+
+        self.online_network = online_network
+
+        self.tau = tau
+
+        self.fused = fused
+
+    def _variables(self):
+
+        target_vars = self.target_network.weights
+
+        online_vars = self.online_network.weights
+
+        assert len(target_vars) == len(online_vars) > 0
+
+        return target_vars, online_vars
+
+    def soft_update(self, tau=None):
+
+        tau = self.tau if tau is None else tau
+
+        return self._soft_update(tf.constant(tau, dtype=tf.float32))
+
+    def hard_update(self):
+
+        return self._hard_update()
+
+    @tf.function
+    def _soft_update(self, tau):
+
+        target_vars, online_vars = self._variables()
+
+        if self.fused:
+            sizes = [tf.size(var) for var in target_vars]
+
+            flat_target = tf.concat([tf.reshape(var, [-1]) for var in target_vars], 0)
+            flat_online = tf.concat([tf.reshape(var, [-1]) for var in online_vars], 0)
+
+            flat_new = (1 - tau) * flat_target + tau * flat_online
+
+            for var, value in zip(target_vars, tf.split(flat_new, sizes)):
+                var.assign(tf.reshape(value, var.shape))
+        else:
+            for target_var, online_var in zip(target_vars, online_vars):
+                target_var.assign((1 - tau) * target_var + tau * online_var)
+
+    @tf.function
+    def _hard_update(self):
+
+        target_vars, online_vars = self._variables()
+
+        for target_var, online_var in zip(target_vars, online_vars):
+            target_var.assign(online_var)
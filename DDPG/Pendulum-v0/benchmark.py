@@ -0,0 +1,162 @@
+import time
+
+import gym
+import numpy as np
+import tensorflow as tf
+
+from main import DDPGAgent
+
+
+def legacy_update_network(agent, batch_size):
+    """tf.function化する前の実装 (比較用)
+    """
+
+    (states, actions, rewards,
+     next_states, dones) = agent.buffer.get_minibatch(batch_size)
+
+    next_actions = agent.target_actor_network(next_states)
+
+    next_qvalues = agent.target_critic_network(next_states, next_actions).numpy()
+
+    target_values = np.vstack(
+        [reward + agent.GAMMA * next_qvalue if not done else reward
+         for reward, done, next_qvalue
+         in zip(rewards.flatten(), dones.flatten(), next_qvalues.flatten())]).astype(np.float32)
+
+    with tf.GradientTape() as tape:
+        qvalues = agent.critic_network(states, actions)
+        loss = tf.reduce_mean(tf.square(target_values - qvalues))
+
+    variables = agent.critic_network.trainable_variables
+    gradients = tape.gradient(loss, variables)
+    agent.critic_network.optimizer.apply_gradients(zip(gradients, variables))
+
+    with tf.GradientTape() as tape:
+        J = -1 * tf.reduce_mean(agent.critic_network(states, agent.actor_network(states)))
+
+    variables = agent.actor_network.trainable_variables
+    gradients = tape.gradient(J, variables)
+    agent.actor_network.optimizer.apply_gradients(zip(gradients, variables))
+
+    agent.target_actor_network.set_weights(
+        [(1 - agent.TAU) * w_target + agent.TAU * w for w_target, w
+         in zip(agent.target_actor_network.get_weights(), agent.actor_network.get_weights())])
+
+    agent.target_critic_network.set_weights(
+        [(1 - agent.TAU) * w_target + agent.TAU * w for w_target, w
+         in zip(agent.target_critic_network.get_weights(), agent.critic_network.get_weights())])
+
+
+def legacy_collect(agent, n_steps):
+    """単一環境 + 4ステップごとのeager更新 (比較用)
+    """
+
+    env = gym.make(agent.ENV_ID)
+
+    state = env.reset()
+
+    for step in range(1, n_steps+1):
+
+        action = agent.actor_network.sample_action(state, noise=agent.stdev)
+
+        next_state, reward, done, _ = env.step(action)
+
+        agent.buffer.push(state, action, reward, next_state, done)
+
+        state = env.reset() if done else next_state
+
+        if step % agent.UPDATE_PERIOD == 0:
+            legacy_update_network(agent, agent.BATCH_SIZE)
+
+
+def fill_buffer(agent, n):
+
+    obs_shape = agent.env.observation_space.shape
+
+    agent.buffer.push_batch(
+        np.random.normal(size=(n, *obs_shape)),
+        np.random.uniform(-2, 2, size=(n, agent.ACTION_SPACE)),
+        np.random.normal(size=n),
+        np.random.normal(size=(n, *obs_shape)),
+        np.random.random(n) < 0.01)
+
+
+def measure(update_func, n_steps, steps_per_call=1):
+    """勾配ステップ数/秒
+    """
+
+    #: 初回のtraceは計測から除く
+    update_func()
+
+    n_calls = n_steps // steps_per_call
+
+    start = time.time()
+
+    for _ in range(n_calls):
+        update_func()
+
+    return n_calls * steps_per_call / (time.time() - start)
+
+
+def benchmark_update(n_steps=1000, steps_per_call=(1, 10)):
+
+    results = {}
+
+    agent = DDPGAgent()
+    fill_buffer(agent, agent.MIN_EXPERIENCES)
+    results["legacy"] = measure(
+        lambda: legacy_update_network(agent, agent.BATCH_SIZE), n_steps)
+
+    for jit_compile in [False, True]:
+        for k in steps_per_call:
+            agent = DDPGAgent(jit_compile=jit_compile, updates_per_call=k)
+            fill_buffer(agent, agent.MIN_EXPERIENCES)
+            results[f"compiled(jit={jit_compile}, K={k})"] = measure(
+                lambda: agent.update_network(agent.BATCH_SIZE, k), n_steps, steps_per_call=k)
+
+    for name, steps_per_sec in results.items():
+        print(f"{name}: {steps_per_sec:.1f} updates/sec,",
+              f"{steps_per_sec / results['legacy']:.2f}x")
+
+    return results
+
+
+def benchmark_collection(n_steps=4000, n_envs=8, updates_per_call=10):
+    """更新込みの環境ステップ数/秒 (どちらもUPDATE_PERIOD環境ステップあたり1勾配ステップ)
+    """
+
+    results = {}
+
+    agent = DDPGAgent()
+    fill_buffer(agent, agent.MIN_EXPERIENCES)
+    legacy_collect(agent, agent.UPDATE_PERIOD)
+    start = time.time()
+    legacy_collect(agent, n_steps)
+    results["legacy"] = n_steps / (time.time() - start)
+
+    for use_subprocess in [False, True]:
+        agent = DDPGAgent(updates_per_call=updates_per_call)
+        agent.START_EPISODES = 0
+        fill_buffer(agent, agent.MIN_EXPERIENCES)
+        agent.update_network(agent.BATCH_SIZE, updates_per_call)
+        start = time.time()
+        agent.learn_vectorized(n_steps, n_envs=n_envs, use_subprocess=use_subprocess)
+        name = "SubProcVecEnv" if use_subprocess else "VecEnv"
+        results[f"{name} x{n_envs}, K={updates_per_call}"] = n_steps / (time.time() - start)
+
+    for name, steps_per_sec in results.items():
+        print(f"{name}: {steps_per_sec:.1f} env steps/sec,",
+              f"{steps_per_sec / results['legacy']:.2f}x")
+
+    return results
+
+
+def main():
+
+    benchmark_update()
+
+    benchmark_collection()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
-from dataclasses import dataclass
 import collections
 import os
+import time
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import numpy as np
@@ -12,20 +12,8 @@ import matplotlib.pyplot as plt
 
 from buffer import ReplayBuffer
 from models import ActorNetwork, CriticNetwork
-
-
-@dataclass
-class Experience:
-
-    state: np.ndarray
-
-    action: int
-
-    reward: float
-
-    next_state: np.ndarray
-
-    done: bool
+from util import TargetNetworkUpdater
+from env import VecEnv, SubProcVecEnv
 
 
 class DDPGAgent:
@@ -50,7 +38,11 @@ class DDPGAgent:
 
     BATCH_SIZE = 32
 
-    def __init__(self):
+    def __init__(self, jit_compile=False, updates_per_call=1):
+        """
+            jit_compile: 学習ステップをXLAでコンパイルする
+            updates_per_call: 1回の呼び出しで行う勾配ステップ数
+        """
 
         self.env = gym.make(self.ENV_ID)
 
@@ -64,14 +56,27 @@ class DDPGAgent:
 
         self.target_critic_network = CriticNetwork()
 
+        self.target_actor_updater = TargetNetworkUpdater(
+            self.target_actor_network, self.actor_network, tau=self.TAU)
+
+        self.target_critic_updater = TargetNetworkUpdater(
+            self.target_critic_network, self.critic_network, tau=self.TAU)
+
         self.stdev = 0.2
 
-        self.buffer = ReplayBuffer(max_experiences=self.MAX_EXPERIENCES)
+        self.buffer = ReplayBuffer(self.env.observation_space,
+                                   self.env.action_space,
+                                   max_len=self.MAX_EXPERIENCES)
 
         self.global_steps = 0
 
         self.hiscore = None
 
+        self.updates_per_call = updates_per_call
+
+        self._train_steps = tf.function(
+            self._train_steps_impl, experimental_compile=jit_compile)
+
         self._build_networks()
 
     def _build_networks(self):
@@ -86,11 +91,11 @@ class DDPGAgent:
 
         self.actor_network.call(dummy_state)
         self.target_actor_network.call(dummy_state)
-        self.target_actor_network.set_weights(self.actor_network.get_weights())
+        self.target_actor_updater.hard_update()
 
         self.critic_network.call(dummy_state, dummy_action, training=False)
         self.target_critic_network.call(dummy_state, dummy_action, training=False)
-        self.target_critic_network.set_weights(self.critic_network.get_weights())
+        self.target_critic_updater.hard_update()
 
     def play(self, n_episodes):
 
@@ -146,9 +151,7 @@ class DDPGAgent:
 
             next_state, reward, done, _ = self.env.step(action)
 
-            exp = Experience(state, action, reward, next_state, done)
-
-            self.buffer.add_experience(exp)
+            self.buffer.push(state, action, reward, next_state, done)
 
             state = next_state
 
@@ -158,29 +161,124 @@ class DDPGAgent:
 
             self.global_steps += 1
 
-            if self.global_steps % self.UPDATE_PERIOD == 0:
-                self.update_network(self.BATCH_SIZE)
-                self.update_target_network()
+            #: updates_per_call回ぶんの更新をまとめて行うので呼び出し間隔もその倍
+            if self.global_steps % (self.UPDATE_PERIOD * self.updates_per_call) == 0:
+                self.update_network(self.BATCH_SIZE, self.updates_per_call)
 
         return total_reward, steps
 
-    def update_network(self, batch_size):
+    def learn_vectorized(self, total_steps, n_envs=8, use_subprocess=True,
+                         logging_period=10000):
+        """N個の環境を同時に進めるデータ収集モード
+
+            N環境の行動を1回のforwardで計算し、探索ノイズも環境ぶんまとめて加える
+            最初のSTART_EPISODESエピソードはランダム行動
+            UPDATE_PERIOD環境ステップあたり1勾配ステップの比率を保ち、
+            updates_per_call回ぶん溜まるごとに1回の呼び出しで更新する
+        """
+
+        if use_subprocess:
+            vecenv = SubProcVecEnv(self.ENV_ID, n_envs)
+        else:
+            vecenv = VecEnv(self.ENV_ID, n_envs)
+
+        episode_rewards = []
+
+        states = vecenv.reset()
+
+        env_steps, grad_steps, pending_updates = 0, 0, 0
+
+        start = last_log = time.time()
+        last_env_steps, last_grad_steps = 0, 0
+
+        while env_steps < total_steps:
+
+            if len(episode_rewards) < self.START_EPISODES:
+                actions = np.random.uniform(-2, 2, size=(n_envs, self.ACTION_SPACE))
+            else:
+                actions = self.actor_network.sample_actions(states, noise=self.stdev)
+
+            results = vecenv.step(actions)
+
+            self.buffer.push_batch(
+                states, actions,
+                np.array([result.reward for result in results]),
+                np.stack([result.next_state for result in results]),
+                np.array([result.done for result in results]))
+
+            states = np.stack([result.state for result in results])
+
+            env_steps += n_envs
+
+            self.global_steps += n_envs
+
+            for result in results:
+                if result.episode_reward is not None:
+                    episode_rewards.append(result.episode_reward)
+
+            if len(self.buffer) >= self.MIN_EXPERIENCES:
+                pending_updates += n_envs / self.UPDATE_PERIOD
+                while pending_updates >= self.updates_per_call:
+                    self.update_network(self.BATCH_SIZE, self.updates_per_call)
+                    pending_updates -= self.updates_per_call
+                    grad_steps += self.updates_per_call
+
+            if env_steps - last_env_steps >= logging_period:
+
+                now = time.time()
+
+                print(f"Env steps {env_steps}, grad steps {grad_steps}:",
+                      f"{(env_steps - last_env_steps) / (now - last_log):.1f} env steps/sec,",
+                      f"{(grad_steps - last_grad_steps) / (now - last_log):.1f} grad steps/sec,",
+                      f"recent score {np.mean(episode_rewards[-n_envs:]) if episode_rewards else None}")
+
+                last_log = now
+                last_env_steps, last_grad_steps = env_steps, grad_steps
+
+        vecenv.close()
+
+        elapsed = time.time() - start
+
+        print(f"Finished: {env_steps / elapsed:.1f} env steps/sec,",
+              f"{grad_steps / elapsed:.1f} grad steps/sec")
+
+        return episode_rewards
+
+    def update_network(self, batch_size, n_steps=1):
+        """n_steps回ぶんのミニバッチをまとめて渡し、1回の呼び出しでn_steps回更新する
+        """
 
         if len(self.buffer) < self.MIN_EXPERIENCES:
             return
 
+        minibatches = [self.buffer.get_minibatch(batch_size) for _ in range(n_steps)]
+
         (states, actions, rewards,
-         next_states, dones) = self.buffer.get_minibatch(batch_size)
+         next_states, dones) = [np.stack(x) for x in zip(*minibatches)]
+
+        return self._train_steps(states, actions, rewards, next_states, dones)
+
+    def _train_steps_impl(self, states, actions, rewards, next_states, dones):
+        """
+            入力は (n_steps, batch_size, ...)
+            n_stepsはtrace時に決まるのでpythonのループで展開する
+        """
+        for i in range(states.shape[0]):
+            loss = self._train_step(
+                states[i], actions[i], rewards[i], next_states[i], dones[i])
+
+        return loss
+
+    def _train_step(self, states, actions, rewards, next_states, dones):
+        """critic, actorの更新とsoft target updateを1ステップ分
+        """
 
         next_actions = self.target_actor_network(next_states)
 
-        next_qvalues = self.target_critic_network(next_states, next_actions).numpy().flatten()
+        next_qvalues = self.target_critic_network(next_states, next_actions)
 
         #: Compute taeget values and update CriticNetwork
-        target_values = np.vstack(
-            [reward + self.GAMMA * next_qvalue if not done else reward
-             for reward, done, next_qvalue
-             in zip(rewards, dones, next_qvalues)]).astype(np.float32)
+        target_values = rewards + self.GAMMA * (1 - dones) * next_qvalues
 
         with tf.GradientTape() as tape:
             qvalues = self.critic_network(states, actions)
@@ -198,27 +296,15 @@ class DDPGAgent:
         gradients = tape.gradient(J, variables)
         self.actor_network.optimizer.apply_gradients(zip(gradients, variables))
 
-    def update_target_network(self):
-
-        # soft-target update Actor
-        target_actor_weights = self.target_actor_network.get_weights()
-        actor_weights = self.actor_network.get_weights()
-
-        assert len(target_actor_weights) == len(actor_weights)
+        self.update_target_network()
 
-        self.target_actor_network.set_weights(
-            (1 - self.TAU) * np.array(target_actor_weights)
-            + (self.TAU) * np.array(actor_weights))
+        return loss
 
-        # soft-target update Critic
-        target_critic_weights = self.target_critic_network.get_weights()
-        critic_weights = self.critic_network.get_weights()
+    def update_target_network(self):
 
-        assert len(target_critic_weights) == len(critic_weights)
+        self.target_actor_updater.soft_update()
 
-        self.target_critic_network.set_weights(
-            (1 - self.TAU) * np.array(target_critic_weights)
-            + (self.TAU) * np.array(critic_weights))
+        self.target_critic_updater.soft_update()
 
     def save_model(self):
 
@@ -58,6 +58,22 @@ class ActorNetwork(tf.keras.Model):
 
         return action
 
+    def sample_actions(self, states, noise=None):
+        """ベクトル化環境用: N個の状態の行動を1回のforwardで計算し、ノイズもまとめて加える
+
+            noise: 全環境共通のstdev (float) または環境ごとのstdev (N,)
+        """
+        states = np.atleast_2d(states).astype(np.float32)
+
+        actions = self(states, training=False).numpy()
+
+        if noise is not None:
+            stdevs = np.reshape(noise, (-1, 1)) * self.ACTION_RANGE
+            actions += stdevs * np.random.normal(size=actions.shape)
+            actions = np.clip(actions, -self.ACTION_RANGE, self.ACTION_RANGE)
+
+        return actions
+
 
 class CriticNetwork(tf.keras.Model):
 
@@ -0,0 +1,109 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from main import DQNAgent
+from buffer import ReplayBuffer
+
+
+#: CPUにはfloat16の畳み込みカーネルがなく極端に遅くなるので、float16はGPUがあるときだけ計測する
+MIXED_PRECISIONS = [None, "bfloat16"] + (
+    ["float16"] if tf.config.experimental.list_physical_devices("GPU") else [])
+
+
+def random_frames(n, uint8):
+
+    frames = np.random.randint(0, 256, size=(n, 84, 84, 4)).astype(np.uint8)
+
+    return frames if uint8 else (frames / 255).astype(np.float32)
+
+
+def fill_buffer(agent, n):
+    """圧縮なしのbufferにランダムな遷移を入れる (pickle/zlibのコストを計測から除く)
+    """
+    agent.replay_buffer = ReplayBuffer(max_len=n, compress=False)
+
+    states = random_frames(n + 1, agent.uint8_frames)
+
+    agent.replay_buffer.push_batch(
+        [(states[i][np.newaxis, ...], np.random.randint(agent.action_space),
+          np.random.normal(), states[i+1][np.newaxis, ...], np.random.random() < 0.01)
+         for i in range(n)])
+
+
+def measure(func, n_iters):
+
+    #: 初回のtraceは計測から除く
+    func()
+
+    start = time.time()
+
+    for _ in range(n_iters):
+        func()
+
+    return n_iters / (time.time() - start)
+
+
+def benchmark_update(n_iters=50):
+    """float32と mixed precision (uint8入力) で1回の勾配ステップのスループットを比べる
+    """
+    results = {}
+
+    for mixed_precision in MIXED_PRECISIONS:
+
+        agent = DQNAgent(mixed_precision=mixed_precision)
+
+        fill_buffer(agent, 1000)
+
+        results[mixed_precision] = measure(agent.update_network, n_iters)
+
+    for mixed_precision, updates_per_sec in results.items():
+        print(f"update {mixed_precision or 'float32':<10}{updates_per_sec:>8.1f} updates/sec,",
+              f"{updates_per_sec / results[None]:.2f}x")
+
+    return results
+
+
+def benchmark_inference(n_iters=50, batch_size=256):
+    """同じ重みでのforwardのスループットと、float32に対するQ値の誤差
+    """
+    frames = random_frames(batch_size, uint8=True)
+
+    base = DQNAgent()
+
+    base_qvalues = base.qnet(frames / np.float32(255)).numpy()
+
+    results = {}
+
+    for mixed_precision in MIXED_PRECISIONS:
+
+        agent = DQNAgent(mixed_precision=mixed_precision)
+
+        inputs = frames if agent.uint8_frames else frames / np.float32(255)
+
+        agent.qnet(inputs)
+        agent.qnet.set_weights(base.qnet.get_weights())
+
+        qvalues = agent.qnet(inputs).numpy()
+
+        results[mixed_precision] = measure(lambda: agent.qnet(inputs).numpy(), n_iters)
+
+        print(f"forward {mixed_precision or 'float32':<10}"
+              f"{results[mixed_precision] * batch_size:>10.0f} states/sec,",
+              f"{results[mixed_precision] / results[None]:.2f}x,",
+              f"max |ΔQ| {np.abs(qvalues - base_qvalues).max():.2e},",
+              f"argmax agreement {np.mean(qvalues.argmax(1) == base_qvalues.argmax(1)):.3f}")
+
+    return results
+
+
+def main():
+
+    benchmark_inference()
+
+    benchmark_update()
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,13 @@ class ReplayBuffer:
 
         self.count += 1
 
+    def push_batch(self, transitions):
+        """
+            transitions : list of tuple(state, action, reward, next_state, done)
+        """
+        for transition in transitions:
+            self.push(transition)
+
     def get_minibatch(self, batch_size):
 
         N = len(self.buffer)
@@ -67,8 +74,9 @@ class ReplayBuffer:
         else:
             selected_experiences = [self.buffer[idx] for idx in indices]
 
+        #: mixed precision時のuint8フレームはuint8のまま (正規化はネットワーク内)
         states = np.vstack(
-            [exp.state for exp in selected_experiences]).astype(np.float32)
+            [exp.state for exp in selected_experiences])
 
         actions = np.vstack(
             [exp.action for exp in selected_experiences]).astype(np.float32)
@@ -77,8 +85,7 @@ class ReplayBuffer:
             [exp.reward for exp in selected_experiences]).reshape(-1, 1)
 
         next_states = np.vstack(
-            [exp.next_state for exp in selected_experiences]
-            ).astype(np.float32)
+            [exp.next_state for exp in selected_experiences])
 
         dones = np.array(
             [exp.done for exp in selected_experiences]).reshape(-1, 1)
@@ -9,7 +9,9 @@ import collections
 
 from model import QNetwork
 from buffer import Experience, ReplayBuffer
-from util import preprocess_frame
+from util import preprocess_frame, loss_scale_optimizer, TargetNetworkUpdater
+from env import VecEnv, SubProcVecEnv
+from exploration import Exploration
 
 
 class DQNAgent:
@@ -20,7 +22,8 @@ class DQNAgent:
                  lr=0.00025,
                  update_period=4,
                  target_update_period=10000,
-                 n_frames=4):
+                 n_frames=4,
+                 mixed_precision=None):
 
         self.env_name = env_name
 
@@ -39,11 +42,20 @@ class DQNAgent:
 
         self.action_space = env.action_space.n
 
-        self.qnet = QNetwork(self.action_space)
+        #: None (float32), "float16", "bfloat16"
+        #: mixed precisionではフレームをuint8のまま扱い、ネットワーク内で正規化する
+        self.mixed_precision = mixed_precision
 
-        self.target_qnet = QNetwork(self.action_space)
+        self.uint8_frames = mixed_precision is not None
 
-        self.optimizer = Adam(lr=lr, epsilon=0.01/self.batch_size)
+        self.qnet = QNetwork(self.action_space, mixed_precision)
+
+        self.target_qnet = QNetwork(self.action_space, mixed_precision)
+
+        self.target_updater = TargetNetworkUpdater(self.target_qnet, self.qnet)
+
+        self.optimizer = loss_scale_optimizer(
+            Adam(lr=lr, epsilon=0.01/self.batch_size), mixed_precision)
 
         self.n_frames = n_frames
 
@@ -64,7 +76,7 @@ class DQNAgent:
         for episode in range(1, n_episodes+1):
             env = gym.make(self.env_name)
 
-            frame = preprocess_frame(env.reset())
+            frame = preprocess_frame(env.reset(), self.uint8_frames)
             frames = collections.deque(
                 [frame] * self.n_frames, maxlen=self.n_frames)
 
@@ -87,7 +99,7 @@ class DQNAgent:
 
                 episode_rewards += reward
 
-                frames.append(preprocess_frame(next_frame))
+                frames.append(preprocess_frame(next_frame, self.uint8_frames))
 
                 next_state = np.stack(frames, axis=2)[np.newaxis, ...]
 
@@ -110,7 +122,7 @@ class DQNAgent:
                             tf.summary.scalar("train_steps", episode_steps, step=steps)
 
                     if steps % self.target_update_period == 0:
-                        self.target_qnet.set_weights(self.qnet.get_weights())
+                        self.target_updater.hard_update()
 
                 if done:
                     break
@@ -125,6 +137,99 @@ class DQNAgent:
             if episode % 1000 == 0:
                 self.qnet.save_weights("checkpoints/qnet")
 
+    def learn_vectorized(self, total_steps, n_envs=8, use_subprocess=True,
+                         use_epsilon_ladder=False, buffer_size=1000000, logdir="log"):
+        """N個の環境を同時に進めるデータ収集モード
+
+            N環境の状態を1回のforwardで評価し、ε-greedyも環境ごとのεでまとめて適用する
+            use_epsilon_ladder=Trueなら環境ごとにApe-X式の固定εを割り当てる
+            N個の遷移は1回の呼び出しでbufferへ追加する
+            update_periodは環境ステップの総数に対して数える
+        """
+
+        logdir = Path(__file__).parent / logdir
+        if logdir.exists():
+            shutil.rmtree(logdir)
+        self.summary_writer = tf.summary.create_file_writer(str(logdir))
+
+        self.replay_buffer = ReplayBuffer(max_len=buffer_size)
+
+        if use_subprocess:
+            vecenv = SubProcVecEnv(self.env_name, n_envs, self.n_frames, self.uint8_frames)
+        else:
+            vecenv = VecEnv(self.env_name, n_envs, self.n_frames, self.uint8_frames)
+
+        if use_epsilon_ladder:
+            exploration = Exploration(n_envs, self.action_space)
+        else:
+            exploration = Exploration(n_envs, self.action_space,
+                                      scheduler=self.epsilon_scheduler)
+
+        states = vecenv.reset()
+
+        steps = 0
+        episode = 0
+        n_updates = 0
+        pending_updates = 0
+        while steps < total_steps:
+
+            epsilons = exploration.epsilons(steps)
+
+            actions, is_random = self.qnet.sample_actions_epsgreedy(states, epsilons)
+
+            exploration.record(actions, is_random)
+
+            results = vecenv.step(actions)
+
+            transitions = [(state[np.newaxis, ...], action, result.reward,
+                            result.next_state[np.newaxis, ...],
+                            result.done or result.life_lost)
+                           for state, action, result in zip(states, actions, results)]
+
+            self.replay_buffer.push_batch(transitions)
+
+            states = np.stack([result.state for result in results])
+
+            steps += n_envs
+
+            if len(self.replay_buffer) > 50000:
+                pending_updates += n_envs / self.update_period
+                while pending_updates >= 1:
+                    loss = self.update_network()
+                    pending_updates -= 1
+                    n_updates += 1
+
+                    if n_updates % (self.target_update_period // self.update_period) == 0:
+                        self.target_updater.hard_update()
+
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar("loss", loss, step=steps)
+                        tf.summary.scalar("buffer_size", len(self.replay_buffer), step=steps)
+
+            for result in results:
+
+                if result.episode_rewards is None:
+                    continue
+
+                episode += 1
+
+                print(f"Episode: {episode}, score: {result.episode_rewards}, steps: {steps}")
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("train_score", result.episode_rewards, step=steps)
+
+                exploration.log(self.summary_writer, steps)
+
+                if episode % 20 == 0:
+                    test_scores, test_steps = self.test_play(n_testplay=1)
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar("test_score", test_scores[0], step=steps)
+                        tf.summary.scalar("test_step", test_steps[0], step=steps)
+
+                if episode % 1000 == 0:
+                    self.qnet.save_weights("checkpoints/qnet")
+
+        vecenv.close()
+
     def update_network(self):
 
         #: ミニバッチの作成
@@ -150,7 +255,15 @@ class DQNAgent:
                 qvalues * actions_onehot, axis=1, keepdims=True)
             loss = self.huber_loss(target_q, q)
 
-        grads = tape.gradient(loss, self.qnet.trainable_variables)
+            if self.mixed_precision == "float16":
+                scaled_loss = self.optimizer.get_scaled_loss(loss)
+
+        if self.mixed_precision == "float16":
+            grads = self.optimizer.get_unscaled_gradients(
+                tape.gradient(scaled_loss, self.qnet.trainable_variables))
+        else:
+            grads = tape.gradient(loss, self.qnet.trainable_variables)
+
         self.optimizer.apply_gradients(
             zip(grads, self.qnet.trainable_variables))
 
@@ -161,7 +274,7 @@ class DQNAgent:
 
         if checkpoint_path:
             env = gym.make(self.env_name)
-            frame = preprocess_frame(env.reset())
+            frame = preprocess_frame(env.reset(), self.uint8_frames)
             frames = collections.deque(
                 [frame] * self.n_frames, maxlen=self.n_frames)
 
@@ -184,7 +297,7 @@ class DQNAgent:
         steps = []
         for _ in range(n_testplay):
 
-            frame = preprocess_frame(env.reset())
+            frame = preprocess_frame(env.reset(), self.uint8_frames)
             frames = collections.deque(
                 [frame] * self.n_frames, maxlen=self.n_frames)
 
@@ -196,7 +309,7 @@ class DQNAgent:
                 state = np.stack(frames, axis=2)[np.newaxis, ...]
                 action = self.qnet.sample_action(state, epsilon=0.05)
                 next_frame, reward, done, _ = env.step(action)
-                frames.append(preprocess_frame(next_frame))
+                frames.append(preprocess_frame(next_frame, self.uint8_frames))
 
                 episode_rewards += reward
                 episode_steps += 1
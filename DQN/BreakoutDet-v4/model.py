@@ -2,30 +2,38 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras.layers as kl
 
+from exploration import epsilon_greedy
+from util import mixed_precision_policy, normalize_frames
+
 
 class QNetwork(tf.keras.Model):
 
-    def __init__(self, actions_space):
+    def __init__(self, actions_space, mixed_precision=None):
 
         super(QNetwork, self).__init__()
 
         self.action_space = actions_space
 
+        #: mixed precisionでは中間層をfloat16/bfloat16で計算し、Q値の出力層だけfloat32に戻す
+        dtype = mixed_precision_policy(mixed_precision)
+
         self.conv1 = kl.Conv2D(32, 8, strides=4, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.conv2 = kl.Conv2D(64, 4, strides=2, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.conv3 = kl.Conv2D(64, 3, strides=1, activation="relu",
-                               kernel_initializer="he_normal")
-        self.flatten1 = kl.Flatten()
+                               kernel_initializer="he_normal", dtype=dtype)
+        self.flatten1 = kl.Flatten(dtype=dtype)
         self.dense1 = kl.Dense(512, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.qvalues = kl.Dense(self.action_space,
-                                kernel_initializer="he_normal")
+                                kernel_initializer="he_normal", dtype="float32")
 
     @tf.function
     def call(self, x):
 
+        x = normalize_frames(x)
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -37,13 +45,20 @@ class QNetwork(tf.keras.Model):
 
     def sample_action(self, x, epsilon=None):
 
-        if (epsilon is None) or (np.random.random() > epsilon):
-            selected_actions, _ = self.sample_actions(x)
-            selected_action = selected_actions.numpy()[0]
-        else:
-            selected_action = np.random.choice(self.action_space)
+        epsilon = 0. if epsilon is None else epsilon
+
+        selected_actions, _ = self.sample_actions_epsgreedy(
+            x, np.full(x.shape[0], epsilon, dtype=np.float32))
+
+        return selected_actions[0]
+
+    def sample_actions_epsgreedy(self, x, epsilons):
+        """N環境ぶんの状態を1回のforwardで評価し、環境ごとのεでε-greedy
+        """
+        qvalues = self(x)
+        selected_actions, is_random = epsilon_greedy(qvalues, epsilons)
 
-        return selected_action
+        return selected_actions.numpy(), is_random.numpy()
 
     def sample_actions(self, x):
         qvalues = self(x)
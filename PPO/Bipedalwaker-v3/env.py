@@ -62,6 +62,15 @@ class Agent:
         trajectory["s2"] = np.array(trajectory["s2"], dtype=np.float32)
         trajectory["done"] = np.array(trajectory["done"], dtype=np.float32).reshape(-1, 1)
 
+        #: 正規化用の統計はworker側で計算し、driverではマージだけ行う
+        trajectory["s_moments"] = (trajectory["s"].mean(axis=0),
+                                   trajectory["s"].var(axis=0),
+                                   trajectory["s"].shape[0])
+
+        trajectory["r_moments"] = (trajectory["r"].mean(axis=0),
+                                   trajectory["r"].var(axis=0),
+                                   trajectory["r"].shape[0])
+
         self.trajectory = {"s": [], "a": [], "r": [], "s2": [], "done": []}
 
         return trajectory
@@ -0,0 +1,166 @@
+import numpy as np
+import ray
+import tensorflow as tf
+
+from models import PolicyNetwork, CriticNetwork
+import util
+
+
+@ray.remote(num_cpus=1)
+class LearnerReplica:
+    """データ並列学習用のレプリカ
+
+        ロールアウトのうち自分の担当ぶん (shard) のtrajectoryを保持し、
+        GAEの計算と勾配の計算だけを行う (optimizerは持たない)
+        勾配の平均と適用はdriver側 (PPOAgent) で行い、
+        毎ステップ最新の重みを受け取ってから勾配を計算する
+    """
+
+    def __init__(self, action_space, gamma, gae_lambda, cliprange):
+
+        self.policy = PolicyNetwork(action_space=action_space)
+
+        self.critic = CriticNetwork()
+
+        self.gamma = gamma
+
+        self.gae_lambda = gae_lambda
+
+        self.cliprange = cliprange
+
+        self.built = False
+
+    def load_rollout(self, trajectories):
+        """担当shardのtrajectoryを受け取る
+
+            報酬と観測の統計はdriverがworker側のモーメントから統合済みで、
+            報酬スケールはprepareで、観測の統計は重みに含めて配られる
+        """
+        self.trajectories = trajectories
+
+    def prepare(self, weights, reward_var):
+        """更新前の重みでGAE, old logp, old vpredを計算して保持する
+        """
+        trajectories = self.trajectories
+
+        if not self.built:
+            self.policy(trajectories[0]["s"][:1])
+            self.critic(trajectories[0]["s"][:1])
+            self.built = True
+
+        self.set_weights(weights)
+
+        n_envs, T = len(trajectories), len(trajectories[0]["r"])
+
+        states = np.vstack([traj["s"] for traj in trajectories])
+
+        next_states = np.vstack([traj["s2"] for traj in trajectories])
+
+        values = self.critic(np.vstack([states, next_states])).numpy().reshape(2, n_envs, T)
+
+        rewards = np.stack([traj["r"].flatten() for traj in trajectories])
+
+        dones = np.stack([traj["done"].flatten() for traj in trajectories])
+
+        normed_rewards = rewards / (np.sqrt(reward_var) + 1e-4)
+
+        advantages, returns = util.compute_gae(
+            normed_rewards, values[0], values[1], dones,
+            self.gamma, self.gae_lambda)
+
+        actions = np.vstack([traj["a"] for traj in trajectories])
+
+        means, stdevs = self.policy(states)
+
+        self.batch = (states, actions,
+                      advantages.reshape(-1, 1), returns.reshape(-1, 1),
+                      compute_logprob(means, stdevs, actions).numpy(),
+                      values[0].reshape(-1, 1))
+
+        return len(states)
+
+    def set_weights(self, weights):
+
+        policy_weights, critic_weights = weights
+
+        self.policy.set_weights(policy_weights)
+
+        self.critic.set_weights(critic_weights)
+
+    def compute_gradients(self, weights, minibatch_idx, batch_size):
+        """minibatch_idx == 0 のときにshard内のindexをシャッフルする (エポックの区切り)
+        """
+        if minibatch_idx == 0:
+            self.indices = np.random.permutation(len(self.batch[0]))
+
+        self.set_weights(weights)
+
+        idx = self.indices[minibatch_idx * batch_size:(minibatch_idx + 1) * batch_size]
+
+        minibatch = [arr[idx] for arr in self.batch]
+
+        policy_grads, critic_grads, vloss = self._compute_gradients(*minibatch)
+
+        return ([g.numpy() for g in policy_grads],
+                [g.numpy() for g in critic_grads],
+                vloss.numpy())
+
+    @tf.function
+    def _compute_gradients(self, states, actions, advantages,
+                           v_targs, old_logprobs, old_vpreds):
+
+        with tf.GradientTape() as tape:
+
+            new_means, new_stdevs = self.policy(states)
+
+            new_logprob = compute_logprob(new_means, new_stdevs, actions)
+
+            ratio = tf.exp(new_logprob - old_logprobs)
+
+            ratio_clipped = tf.clip_by_value(
+                ratio, 1 - self.cliprange, 1 + self.cliprange)
+
+            loss = tf.minimum(ratio * advantages, ratio_clipped * advantages)
+
+            loss = -1 * tf.reduce_mean(loss)
+
+        #: 出力に使われない変数 (pi_sigmaなど) は0勾配として全レプリカで形を揃える
+        policy_grads = tape.gradient(
+            loss, self.policy.trainable_variables,
+            unconnected_gradients=tf.UnconnectedGradients.ZERO)
+
+        with tf.GradientTape() as tape:
+
+            vpred = self.critic(states)
+
+            vpred_clipped = old_vpreds + tf.clip_by_value(
+                vpred - old_vpreds, -self.cliprange, self.cliprange)
+
+            vloss = tf.maximum(
+                tf.square(v_targs - vpred),
+                tf.square(v_targs - vpred_clipped))
+
+            vloss = tf.reduce_mean(vloss)
+
+        critic_grads = tape.gradient(
+            vloss, self.critic.trainable_variables,
+            unconnected_gradients=tf.UnconnectedGradients.ZERO)
+
+        return policy_grads, critic_grads, vloss
+
+
+def compute_logprob(means, stdevs, actions):
+    """ガウス分布の確率密度関数よりlogp(x)を計算
+        logp(x) = -0.5 log(2π) - log(std)  -0.5 * ((x - mean) / std )^2
+    """
+    logprob = - 0.5 * np.log(2*np.pi)
+    logprob += - tf.math.log(stdevs)
+    logprob += - 0.5 * tf.square((actions - means) / stdevs)
+    logprob = tf.reduce_sum(logprob, axis=1, keepdims=True)
+    return logprob
+
+
+def allreduce_mean(grads_list):
+    """レプリカごとの勾配リストを変数ごとに平均する
+    """
+    return [np.mean(grads, axis=0) for grads in zip(*grads_list)]
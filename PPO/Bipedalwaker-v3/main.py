@@ -6,6 +6,7 @@ import collections
 
 import gym
 from gym import wrappers
+import ray
 import numpy as np
 import tensorflow as tf
 import numpy as np
@@ -13,6 +14,7 @@ import matplotlib.pyplot as plt
 
 from env import VecEnv
 from models import PolicyNetwork, CriticNetwork
+from learner import LearnerReplica, allreduce_mean
 import util
 
 
@@ -29,7 +31,7 @@ class PPOAgent:
     BATCH_SIZE = 2048
 
     def __init__(self, env_id, action_space, trajectory_size=256,
-                 n_envs=1, max_timesteps=1500):
+                 n_envs=1, max_timesteps=1500, n_learners=1, normalize_obs=False):
 
         self.env_id = env_id
 
@@ -42,11 +44,18 @@ class PPOAgent:
 
         self.policy = PolicyNetwork(action_space=action_space)
 
-        self.old_policy = PolicyNetwork(action_space=action_space)
-
         self.critic = CriticNetwork()
 
-        self.r_running_stats = util.RunningStats(shape=(action_space,))
+        self.r_running_stats = util.RunningStats(shape=(1,))
+
+        self.normalize_obs = normalize_obs
+
+        #: n_learners > 1 ならロールアウトを分割して複数プロセスで勾配を計算する
+        assert n_learners <= n_envs
+
+        self.learners = [
+            LearnerReplica.remote(action_space, self.GAMMA, self.GAE_LAMBDA, self.CLIPRANGE)
+            for _ in range(n_learners)] if n_learners > 1 else []
 
         self._init_network()
 
@@ -54,11 +63,13 @@ class PPOAgent:
 
         env = gym.make(self.env_id)
 
+        self.obs_running_stats = util.RunningStats(shape=env.observation_space.shape)
+
         state = np.atleast_2d(env.reset())
 
         self.policy(state)
 
-        self.old_policy(state)
+        self.critic(state)
 
     def run(self, n_updates, logdir):
 
@@ -82,16 +93,19 @@ class PPOAgent:
 
             trajectories = self.vecenv.get_trajectories()
 
-            for trajectory in trajectories:
-                self.r_running_stats.update(trajectory["r"])
+            self.update_stats(trajectories)
 
-            trajectories = self.compute_advantage(trajectories)
+            if self.learners:
+                vloss = self.update_data_parallel(trajectories)
 
-            states, actions, advantages, vtargs = self.create_minibatch(trajectories)
+            else:
+                trajectories = self.compute_advantage(trajectories)
 
-            vloss = self.update_critic(states, vtargs)
+                (states, actions, advantages, vtargs,
+                 old_logprobs, old_vpreds) = self.create_minibatch(trajectories)
 
-            self.update_policy(states, actions, advantages)
+                vloss = self.update_networks(
+                    states, actions, advantages, vtargs, old_logprobs, old_vpreds)
 
             global_steps = (epoch+1) * self.trajectory_size * self.n_envs
             train_scores = np.array([traj["r"].sum() for traj in trajectories])
@@ -118,111 +132,198 @@ class PPOAgent:
 
         return history
 
+    def update_stats(self, trajectories):
+        """worker側で計算済みのモーメントを統合し、観測の統計をネットワークへ同期する
+
+            driverではtrajectoryごとのモーメントのマージのみ行い、
+            観測の正規化自体はpolicy/criticのグラフ内で行われる
+        """
+        self.r_running_stats.merge([traj["r_moments"] for traj in trajectories])
+
+        if self.normalize_obs:
+
+            self.obs_running_stats.merge([traj["s_moments"] for traj in trajectories])
+
+            self.policy.normalizer.sync(self.obs_running_stats)
+
+            self.critic.normalizer.sync(self.obs_running_stats)
+
     def compute_advantage(self, trajectories):
         """
             Generalized Advantage Estimation (GAE, 2016)
+            全環境のs, s2をまとめて1回のforwardで評価し、(n_envs, T)のままGAEを計算する
         """
 
-        for trajectory in trajectories:
+        n_envs, T = len(trajectories), len(trajectories[0]["r"])
 
-            trajectory["v_pred"] = self.critic(trajectory["s"]).numpy()
+        states = np.vstack([traj["s"] for traj in trajectories]
+                           + [traj["s2"] for traj in trajectories])
 
-            trajectory["v_pred_next"] = self.critic(trajectory["s2"]).numpy()
+        values = self.critic(states).numpy().reshape(2, n_envs, T)
 
-            is_nonterminals = 1 - trajectory["done"]
+        v_preds, v_preds_next = values[0], values[1]
 
-            normed_rewards = (trajectory["r"] / (np.sqrt(self.r_running_stats.var) + 1e-4))
+        rewards = np.stack([traj["r"].flatten() for traj in trajectories])
 
-            deltas = normed_rewards + self.GAMMA * is_nonterminals * trajectory["v_pred_next"] - trajectory["v_pred"]
+        dones = np.stack([traj["done"].flatten() for traj in trajectories])
 
-            advantages = np.zeros_like(deltas, dtype=np.float32)
+        normed_rewards = rewards / (np.sqrt(self.r_running_stats.var) + 1e-4)
 
-            lastgae = 0
-            for i in reversed(range(len(deltas))):
-                lastgae = deltas[i] + self.GAMMA * self.GAE_LAMBDA * is_nonterminals[i] * lastgae
-                advantages[i] = lastgae
+        advantages, returns = util.compute_gae(
+            normed_rewards, v_preds, v_preds_next, dones,
+            self.GAMMA, self.GAE_LAMBDA)
 
-            trajectory["advantage"] = advantages
+        for i, trajectory in enumerate(trajectories):
 
-            trajectory["R"] = advantages + trajectory["v_pred"]
+            trajectory["v_pred"] = v_preds[i].reshape(-1, 1)
+
+            trajectory["v_pred_next"] = v_preds_next[i].reshape(-1, 1)
+
+            trajectory["advantage"] = advantages[i].reshape(-1, 1)
+
+            trajectory["R"] = returns[i].reshape(-1, 1)
 
         return trajectories
 
-    def update_policy(self, states, actions, advantages):
+    @tf.function
+    def update_networks(self, states, actions, advantages,
+                        v_targs, old_logprobs, old_vpreds):
+        """ロールアウト1回分のデータでOPT_ITERエポックの更新をグラフ内で行う
+
+            old_logprobs, old_vpredsはロールアウト時点の値をcreate_minibatchで計算済み
+            エポックごとにindexをシャッフルし、重複なしのミニバッチに分割する
+        """
+        n_samples = tf.shape(states)[0]
+
+        batch_size = tf.minimum(self.BATCH_SIZE, n_samples)
+
+        n_minibatches = n_samples // batch_size
+
+        total_vloss = 0.
 
-        self.old_policy.set_weights(self.policy.get_weights())
+        for _ in tf.range(self.OPT_ITER):
 
-        indices = np.random.choice(
-            range(states.shape[0]), (self.OPT_ITER, self.BATCH_SIZE))
+            indices = tf.random.shuffle(tf.range(n_samples))
 
-        for i in range(self.OPT_ITER):
+            for i in tf.range(n_minibatches):
 
-            idx = indices[i]
+                idx = indices[i * batch_size:(i + 1) * batch_size]
 
-            old_means, old_stdevs = self.old_policy(states[idx])
+                self.update_policy(
+                    tf.gather(states, idx), tf.gather(actions, idx),
+                    tf.gather(advantages, idx), tf.gather(old_logprobs, idx))
 
-            old_logprob = self.compute_logprob(
-                old_means, old_stdevs, actions[idx])
+                vloss = self.update_critic(
+                    tf.gather(states, idx), tf.gather(v_targs, idx),
+                    tf.gather(old_vpreds, idx))
 
-            with tf.GradientTape() as tape:
+                total_vloss += vloss
 
-                new_means, new_stdevs = self.policy(states[idx])
+        return total_vloss / tf.cast(self.OPT_ITER * n_minibatches, tf.float32)
+
+    def update_data_parallel(self, trajectories):
+        """データ並列での更新
+
+            trajectoryをレプリカ数で分割して配り、同期済みの報酬スケールと
+            観測の統計を含む重みを渡して各レプリカでGAEを計算する
+            各ミニバッチでは全レプリカの勾配を平均 (all-reduce) してから
+            driverのoptimizerで1回だけ適用し、次のステップで新しい重みを配る
+        """
+        n_learners = len(self.learners)
 
-                new_logprob = self.compute_logprob(
-                    new_means, new_stdevs, actions[idx])
+        shards = [trajectories[i::n_learners] for i in range(n_learners)]
 
-                ratio = tf.exp(new_logprob - old_logprob)
+        ray.get([learner.load_rollout.remote(shard)
+                 for learner, shard in zip(self.learners, shards)])
 
-                ratio_clipped = tf.clip_by_value(
-                    ratio, 1 - self.CLIPRANGE, 1 + self.CLIPRANGE)
+        weights = ray.put((self.policy.get_weights(), self.critic.get_weights()))
 
-                loss_unclipped = ratio * advantages[idx]
+        n_samples = min(ray.get(
+            [learner.prepare.remote(weights, self.r_running_stats.var)
+             for learner in self.learners]))
 
-                loss_clipped = ratio_clipped * advantages[idx]
+        #: 全レプリカ合計でBATCH_SIZEになるようにshard内のミニバッチを切る
+        batch_size = min(self.BATCH_SIZE // n_learners, n_samples)
 
-                loss = tf.minimum(loss_unclipped, loss_clipped)
+        n_minibatches = n_samples // batch_size
 
-                loss = -1 * tf.reduce_mean(loss)
+        vlosses = []
 
-            grads = tape.gradient(loss, self.policy.trainable_variables)
-            grads, _ = tf.clip_by_global_norm(grads, 0.5)
-            self.policy.optimizer.apply_gradients(
-                zip(grads, self.policy.trainable_variables))
+        for _ in range(self.OPT_ITER):
 
-    def update_critic(self, states, v_targs):
+            for i in range(n_minibatches):
 
-        losses = []
+                weights = ray.put((self.policy.get_weights(), self.critic.get_weights()))
 
-        indices = np.random.choice(
-            range(states.shape[0]), (self.OPT_ITER, self.BATCH_SIZE))
+                results = ray.get([learner.compute_gradients.remote(weights, i, batch_size)
+                                   for learner in self.learners])
 
-        for i in range(self.OPT_ITER):
+                policy_grads, critic_grads, losses = zip(*results)
 
-            idx = indices[i]
+                self.apply_gradients(self.policy, allreduce_mean(policy_grads))
 
-            old_vpred = self.critic(states[idx])
+                self.apply_gradients(self.critic, allreduce_mean(critic_grads))
 
-            with tf.GradientTape() as tape:
+                vlosses.append(np.mean(losses))
 
-                vpred = self.critic(states[idx])
+        return np.mean(vlosses)
 
-                vpred_clipped = old_vpred + tf.clip_by_value(
-                    vpred - old_vpred, -self.CLIPRANGE, self.CLIPRANGE)
+    def apply_gradients(self, network, grads):
 
-                loss = tf.maximum(
-                    tf.square(v_targs[idx] - vpred),
-                    tf.square(v_targs[idx] - vpred_clipped))
+        grads, _ = tf.clip_by_global_norm(grads, 0.5)
 
-                loss = tf.reduce_mean(loss)
+        network.optimizer.apply_gradients(
+            zip(grads, network.trainable_variables))
 
-            grads = tape.gradient(loss, self.critic.trainable_variables)
-            grads, _ = tf.clip_by_global_norm(grads, 0.5)
-            self.critic.optimizer.apply_gradients(
-                zip(grads, self.critic.trainable_variables))
+    def update_policy(self, states, actions, advantages, old_logprobs):
 
-            losses.append(loss)
+        with tf.GradientTape() as tape:
 
-        return np.array(losses).mean()
+            new_means, new_stdevs = self.policy(states)
+
+            new_logprob = self.compute_logprob(new_means, new_stdevs, actions)
+
+            ratio = tf.exp(new_logprob - old_logprobs)
+
+            ratio_clipped = tf.clip_by_value(
+                ratio, 1 - self.CLIPRANGE, 1 + self.CLIPRANGE)
+
+            loss_unclipped = ratio * advantages
+
+            loss_clipped = ratio_clipped * advantages
+
+            loss = tf.minimum(loss_unclipped, loss_clipped)
+
+            loss = -1 * tf.reduce_mean(loss)
+
+        grads = tape.gradient(loss, self.policy.trainable_variables)
+        grads, _ = tf.clip_by_global_norm(grads, 0.5)
+        self.policy.optimizer.apply_gradients(
+            zip(grads, self.policy.trainable_variables))
+
+        return loss
+
+    def update_critic(self, states, v_targs, old_vpreds):
+
+        with tf.GradientTape() as tape:
+
+            vpred = self.critic(states)
+
+            vpred_clipped = old_vpreds + tf.clip_by_value(
+                vpred - old_vpreds, -self.CLIPRANGE, self.CLIPRANGE)
+
+            loss = tf.maximum(
+                tf.square(v_targs - vpred),
+                tf.square(v_targs - vpred_clipped))
+
+            loss = tf.reduce_mean(loss)
+
+        grads = tape.gradient(loss, self.critic.trainable_variables)
+        grads, _ = tf.clip_by_global_norm(grads, 0.5)
+        self.critic.optimizer.apply_gradients(
+            zip(grads, self.critic.trainable_variables))
+
+        return loss
 
     @tf.function
     def compute_logprob(self, means, stdevs, actions):
@@ -244,7 +345,13 @@ class PPOAgent:
 
         v_targs = np.vstack([traj["R"] for traj in trajectories])
 
-        return states, actions, advantages, v_targs
+        #: 更新前の方策のlogpと価値はロールアウトごとに1回だけ計算する
+        means, stdevs = self.policy(states)
+        old_logprobs = self.compute_logprob(means, stdevs, actions)
+
+        old_vpreds = np.vstack([traj["v_pred"] for traj in trajectories])
+
+        return states, actions, advantages, v_targs, old_logprobs, old_vpreds
 
     def save_model(self):
 
@@ -252,12 +359,20 @@ class PPOAgent:
 
         self.critic.save_weights("checkpoints/critic")
 
+        self.r_running_stats.save("checkpoints/r_stats.npz")
+
+        self.obs_running_stats.save("checkpoints/obs_stats.npz")
+
     def load_model(self):
 
         self.policy.load_weights("checkpoints/policy")
 
         self.critic.load_weights("checkpoints/critic")
 
+        self.r_running_stats.load("checkpoints/r_stats.npz")
+
+        self.obs_running_stats.load("checkpoints/obs_stats.npz")
+
     def play(self, n=1, monitordir=None, verbose=False):
 
         if monitordir:
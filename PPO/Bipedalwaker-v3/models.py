@@ -7,6 +7,41 @@ import tensorflow_probability as tfp
 import numpy as np
 
 
+class ObservationNormalizer(kl.Layer):
+    """RunningStatsの平均と分散を保持し、観測の正規化をグラフ内で行う
+
+        統計は学習せず、driverのRunningStatsからsyncで同期する
+        重みとして持つのでsave_weights/get_weightsに統計も含まれる
+        初期値 (mean=0, var=1) のままなら恒等変換 (clip範囲内)
+    """
+
+    def __init__(self, clip=10.):
+
+        super(ObservationNormalizer, self).__init__()
+
+        self.clip = clip
+
+    def build(self, input_shape):
+
+        self.mean = self.add_weight(name="mean", shape=(input_shape[-1],),
+                                    initializer="zeros", trainable=False)
+
+        self.var = self.add_weight(name="var", shape=(input_shape[-1],),
+                                   initializer="ones", trainable=False)
+
+    def call(self, x):
+
+        x = (x - self.mean) / tf.sqrt(self.var + 1e-8)
+
+        return tf.clip_by_value(x, -self.clip, self.clip)
+
+    def sync(self, stats):
+
+        self.mean.assign(stats.mean.astype(np.float32))
+
+        self.var.assign(stats.var.astype(np.float32))
+
+
 class PolicyNetwork(tf.keras.Model):
 
     def __init__(self, action_space, lr=0.00005):
@@ -15,6 +50,8 @@ class PolicyNetwork(tf.keras.Model):
 
         self.action_space = action_space
 
+        self.normalizer = ObservationNormalizer()
+
         self.dense1 = kl.Dense(128, activation="tanh",
                                kernel_initializer="Orthogonal")
 
@@ -32,6 +69,8 @@ class PolicyNetwork(tf.keras.Model):
     @tf.function
     def call(self, x):
 
+        x = self.normalizer(x)
+
         x = self.dense1(x)
 
         x = self.dense2(x)
@@ -64,6 +103,8 @@ class CriticNetwork(tf.keras.Model):
 
         super(CriticNetwork, self).__init__()
 
+        self.normalizer = ObservationNormalizer()
+
         self.dense1 = kl.Dense(128, activation="relu")
 
         self.dense2 = kl.Dense(64, activation="relu")
@@ -74,6 +115,8 @@ class CriticNetwork(tf.keras.Model):
 
     def call(self, x):
 
+        x = self.normalizer(x)
+
         x = self.dense1(x)
         x = self.dense2(x)
         out = self.out(x)
@@ -26,8 +26,10 @@ class PPOAgent:
 
     OPT_ITER = 10
 
+    BATCH_SIZE = 64
+
     def __init__(self, env_id, action_space,
-                 n_envs=1, trajectory_size=200):
+                 n_envs=1, trajectory_size=200, normalize_obs=False):
 
         self.env_id = env_id
 
@@ -41,7 +43,23 @@ class PPOAgent:
 
         self.critic = CriticNetwork()
 
-        self.r_running_stats = util.RunningStats(shape=(action_space,))
+        self.r_running_stats = util.RunningStats(shape=(1,))
+
+        self.normalize_obs = normalize_obs
+
+        self._init_network()
+
+    def _init_network(self):
+
+        env = gym.make(self.env_id)
+
+        self.obs_running_stats = util.RunningStats(shape=env.observation_space.shape)
+
+        state = np.atleast_2d(env.reset())
+
+        self.policy(state)
+
+        self.critic(state)
 
     def run(self, n_updates, logdir):
 
@@ -65,16 +83,15 @@ class PPOAgent:
 
             trajectories = self.vecenv.get_trajectories()
 
-            for trajectory in trajectories:
-                self.r_running_stats.update(trajectory["r"])
+            self.update_stats(trajectories)
 
             trajectories = self.compute_advantage(trajectories)
 
-            states, actions, advantages, vtargs = self.create_minibatch(trajectories)
+            (states, actions, advantages, vtargs,
+             old_logprobs, old_vpreds) = self.create_minibatch(trajectories)
 
-            vloss = self.update_critic(states, vtargs)
-
-            self.update_policy(states, actions, advantages)
+            vloss = self.update_networks(
+                states, actions, advantages, vtargs, old_logprobs, old_vpreds)
 
             global_steps = (epoch+1) * self.trajectory_size * self.n_envs
             train_scores = np.array([traj["r"].sum() for traj in trajectories])
@@ -99,97 +116,144 @@ class PPOAgent:
 
         return history
 
+    def update_stats(self, trajectories):
+        """worker側で計算済みのモーメントを統合し、観測の統計をネットワークへ同期する
+
+            driverではtrajectoryごとのモーメントのマージのみ行い、
+            観測の正規化自体はpolicy/criticのグラフ内で行われる
+        """
+        self.r_running_stats.merge([traj["r_moments"] for traj in trajectories])
+
+        if self.normalize_obs:
+
+            self.obs_running_stats.merge([traj["s_moments"] for traj in trajectories])
+
+            self.policy.normalizer.sync(self.obs_running_stats)
+
+            self.critic.normalizer.sync(self.obs_running_stats)
+
     def compute_advantage(self, trajectories):
         """
             Generalized Advantage Estimation (GAE, 2016)
+            全環境のs, s2をまとめて1回のforwardで評価し、(n_envs, T)のままGAEを計算する
         """
 
-        for trajectory in trajectories:
+        n_envs, T = len(trajectories), len(trajectories[0]["r"])
+
+        states = np.vstack([traj["s"] for traj in trajectories]
+                           + [traj["s2"] for traj in trajectories])
+
+        values = self.critic(states).numpy().reshape(2, n_envs, T)
 
-            trajectory["v_pred"] = self.critic(trajectory["s"]).numpy()
+        v_preds, v_preds_next = values[0], values[1]
 
-            trajectory["v_pred_next"] = self.critic(trajectory["s2"]).numpy()
+        rewards = np.stack([traj["r"].flatten() for traj in trajectories])
 
-            is_nonterminals = 1 - trajectory["done"]
+        dones = np.stack([traj["done"].flatten() for traj in trajectories])
 
-            #normed_rewards = ((trajectory["r"] - self.r_running_stats.mean) / (np.sqrt(self.r_running_stats.var) + 1e-4))
-            normed_rewards = (trajectory["r"] / (np.sqrt(self.r_running_stats.var) + 1e-4))
+        normed_rewards = rewards / (np.sqrt(self.r_running_stats.var) + 1e-4)
 
-            deltas = normed_rewards + self.GAMMA * is_nonterminals * trajectory["v_pred_next"] - trajectory["v_pred"]
+        advantages, returns = util.compute_gae(
+            normed_rewards, v_preds, v_preds_next, dones,
+            self.GAMMA, self.GAE_LAMBDA)
 
-            advantages = np.zeros_like(deltas, dtype=np.float32)
+        for i, trajectory in enumerate(trajectories):
 
-            lastgae = 0
-            for i in reversed(range(len(deltas))):
-                lastgae = deltas[i] + self.GAMMA * self.GAE_LAMBDA * is_nonterminals[i] * lastgae
-                advantages[i] = lastgae
+            trajectory["v_pred"] = v_preds[i].reshape(-1, 1)
 
-            trajectory["advantage"] = advantages
+            trajectory["v_pred_next"] = v_preds_next[i].reshape(-1, 1)
 
-            trajectory["R"] = advantages + trajectory["v_pred"]
+            trajectory["advantage"] = advantages[i].reshape(-1, 1)
 
-            """経験的return
-            trajectory["R"] = np.zeros_like(trajectory["r"])
-            R = (1 - trajectory["done"][-1]) * trajectory["v_pred_next"][-1]
-            for i in reversed(range(trajectory["r"].shape[0])):
-                R = trajectory["r"][i] / reward_std + (1 - trajectory["done"][i]) * self.GAMMA * R
-                trajectory["R"][i] = R
-            """
+            trajectory["R"] = returns[i].reshape(-1, 1)
 
         return trajectories
 
-    def update_policy(self, states, actions, advantages):
+    @tf.function
+    def update_networks(self, states, actions, advantages,
+                        v_targs, old_logprobs, old_vpreds):
+        """ロールアウト1回分のデータでOPT_ITERエポックの更新をグラフ内で行う
 
-        for _ in range(self.OPT_ITER):
+            old_logprobs, old_vpredsはロールアウト時点の値をcreate_minibatchで計算済み
+            エポックごとにindexをシャッフルし、重複なしのミニバッチに分割する
+        """
+        n_samples = tf.shape(states)[0]
 
-            old_means, old_stdevs = self.policy(states)
+        batch_size = tf.minimum(self.BATCH_SIZE, n_samples)
 
-            old_logprob = self.compute_logprob(old_means, old_stdevs, actions)
+        n_minibatches = n_samples // batch_size
 
-            with tf.GradientTape() as tape:
+        total_vloss = 0.
 
-                new_means, new_stdevs = self.policy(states)
+        for _ in tf.range(self.OPT_ITER):
 
-                new_logprob = self.compute_logprob(new_means, new_stdevs, actions)
+            indices = tf.random.shuffle(tf.range(n_samples))
 
-                ratio = tf.exp(new_logprob - old_logprob)
+            for i in tf.range(n_minibatches):
 
-                ratio_clipped = tf.clip_by_value(
-                    ratio, 1 - self.CLIPRANGE, 1 + self.CLIPRANGE)
+                idx = indices[i * batch_size:(i + 1) * batch_size]
 
-                loss_unclipped = ratio * advantages
-                loss_clipped = ratio_clipped * advantages
+                self.update_policy(
+                    tf.gather(states, idx), tf.gather(actions, idx),
+                    tf.gather(advantages, idx), tf.gather(old_logprobs, idx))
 
-                loss = tf.minimum(loss_unclipped, loss_clipped)
-                loss = -1 * tf.reduce_mean(loss)
+                vloss = self.update_critic(
+                    tf.gather(states, idx), tf.gather(v_targs, idx),
+                    tf.gather(old_vpreds, idx))
 
-            grads = tape.gradient(loss, self.policy.trainable_variables)
-            grads, _ = tf.clip_by_global_norm(grads, 0.5)
-            self.policy.optimizer.apply_gradients(
-                zip(grads, self.policy.trainable_variables))
+                total_vloss += vloss
 
-    def update_critic(self, states, v_targs):
+        return total_vloss / tf.cast(self.OPT_ITER * n_minibatches, tf.float32)
 
-        losses = []
+    def update_policy(self, states, actions, advantages, old_logprobs):
 
-        for _ in range(self.OPT_ITER):
+        with tf.GradientTape() as tape:
 
-            old_vpred = self.critic(states)
-            with tf.GradientTape() as tape:
-                vpred = self.critic(states)
-                vpred_clipped = old_vpred + tf.clip_by_value(
-                    vpred - old_vpred, -self.CLIPRANGE, self.CLIPRANGE)
-                loss = tf.maximum(tf.square(v_targs - vpred), tf.square(v_targs - vpred_clipped))
-                loss = tf.reduce_mean(loss)
+            new_means, new_stdevs = self.policy(states)
 
-            grads = tape.gradient(loss, self.critic.trainable_variables)
-            grads, _ = tf.clip_by_global_norm(grads, 0.5)
-            self.critic.optimizer.apply_gradients(
-                zip(grads, self.critic.trainable_variables))
+            new_logprob = self.compute_logprob(new_means, new_stdevs, actions)
 
-            losses.append(loss)
+            ratio = tf.exp(new_logprob - old_logprobs)
 
-        return np.array(losses).mean()
+            ratio_clipped = tf.clip_by_value(
+                ratio, 1 - self.CLIPRANGE, 1 + self.CLIPRANGE)
+
+            loss_unclipped = ratio * advantages
+
+            loss_clipped = ratio_clipped * advantages
+
+            loss = tf.minimum(loss_unclipped, loss_clipped)
+
+            loss = -1 * tf.reduce_mean(loss)
+
+        grads = tape.gradient(loss, self.policy.trainable_variables)
+        grads, _ = tf.clip_by_global_norm(grads, 0.5)
+        self.policy.optimizer.apply_gradients(
+            zip(grads, self.policy.trainable_variables))
+
+        return loss
+
+    def update_critic(self, states, v_targs, old_vpreds):
+
+        with tf.GradientTape() as tape:
+
+            vpred = self.critic(states)
+
+            vpred_clipped = old_vpreds + tf.clip_by_value(
+                vpred - old_vpreds, -self.CLIPRANGE, self.CLIPRANGE)
+
+            loss = tf.maximum(
+                tf.square(v_targs - vpred),
+                tf.square(v_targs - vpred_clipped))
+
+            loss = tf.reduce_mean(loss)
+
+        grads = tape.gradient(loss, self.critic.trainable_variables)
+        grads, _ = tf.clip_by_global_norm(grads, 0.5)
+        self.critic.optimizer.apply_gradients(
+            zip(grads, self.critic.trainable_variables))
+
+        return loss
 
     @tf.function
     def compute_logprob(self, means, stdevs, actions):
@@ -211,7 +275,13 @@ class PPOAgent:
 
         v_targs = np.vstack([traj["R"] for traj in trajectories])
 
-        return states, actions, advantages, v_targs
+        #: 更新前の方策のlogpと価値はロールアウトごとに1回だけ計算する
+        means, stdevs = self.policy(states)
+        old_logprobs = self.compute_logprob(means, stdevs, actions)
+
+        old_vpreds = np.vstack([traj["v_pred"] for traj in trajectories])
+
+        return states, actions, advantages, v_targs, old_logprobs, old_vpreds
 
     def save_model(self):
 
@@ -219,12 +289,20 @@ class PPOAgent:
 
         self.critic.save_weights("checkpoints/critic")
 
+        self.r_running_stats.save("checkpoints/r_stats.npz")
+
+        self.obs_running_stats.save("checkpoints/obs_stats.npz")
+
     def load_model(self):
 
         self.policy.load_weights("checkpoints/policy")
 
         self.critic.load_weights("checkpoints/critic")
 
+        self.r_running_stats.load("checkpoints/r_stats.npz")
+
+        self.obs_running_stats.load("checkpoints/obs_stats.npz")
+
     def play(self, n=1, monitordir=None, verbose=False):
 
         if monitordir:
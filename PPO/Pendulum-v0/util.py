@@ -1,4 +1,5 @@
 import numpy as np
+import tensorflow as tf
 
 
 class RunningStats:
@@ -22,6 +23,25 @@ class RunningStats:
         self.mean, self.var, self.count = self.update_mean_var_count_from_moments(
             self.mean, self.var, self.count, batch_mean, batch_var, batch_count)
 
+    def merge(self, moments_list):
+        """worker側で計算した (mean, var, count) をまとめて統合する
+
+            Chanの並列アルゴリズムなので統合順によらず
+            全サンプルでupdateした場合と同じ結果になる
+        """
+        for batch_mean, batch_var, batch_count in moments_list:
+            self.update_from_moments(batch_mean, batch_var, batch_count)
+
+    def save(self, path):
+
+        np.savez(path, mean=self.mean, var=self.var, count=self.count)
+
+    def load(self, path):
+
+        data = np.load(path)
+
+        self.mean, self.var, self.count = data["mean"], data["var"], float(data["count"])
+
     @staticmethod
     def update_mean_var_count_from_moments(mean, var, count, batch_mean, batch_var, batch_count):
 
@@ -38,6 +58,87 @@ class RunningStats:
         return new_mean, new_var, new_count
 
 
+def discounted_cumsum(x, discounts, initial=None):
+    """y[:, t] = x[:, t] + discounts[:, t] * y[:, t+1] を時間方向に逆順で計算する (pure NumPy)
+
+        x, discounts: (n_envs, T)
+        initial: (n_envs,) y[:, T]に相当するbootstrap値, Noneなら0
+        pythonのループは時間方向のみで、env方向はまとめて計算する
+    """
+    n_envs, T = x.shape
+
+    y = np.zeros((n_envs, T), dtype=np.float32)
+
+    last = np.zeros(n_envs, dtype=np.float32) if initial is None else initial
+
+    for t in reversed(range(T)):
+        last = x[:, t] + discounts[:, t] * last
+        y[:, t] = last
+
+    return y
+
+
+@tf.function
+def discounted_cumsum_tf(x, discounts, initial):
+    """discounted_cumsumのtf.scan版 (グラフ内で完結させたいとき用)
+    """
+    #: (n_envs, T) -> (T, n_envs)
+    elems = (tf.transpose(x), tf.transpose(discounts))
+
+    y = tf.scan(lambda acc, elem: elem[0] + elem[1] * acc,
+                elems, initializer=initial, reverse=True)
+
+    return tf.transpose(y)
+
+
+def _discounted_cumsum(x, discounts, initial, use_tf):
+
+    x = x.astype(np.float32)
+
+    discounts = discounts.astype(np.float32)
+
+    if initial is None:
+        initial = np.zeros(x.shape[0], dtype=np.float32)
+    else:
+        initial = np.asarray(initial, dtype=np.float32).reshape(x.shape[0])
+
+    if use_tf:
+        return discounted_cumsum_tf(x, discounts, initial).numpy()
+    else:
+        return discounted_cumsum(x, discounts, initial)
+
+
+def compute_gae(rewards, values, next_values, dones, gamma, lam, use_tf=False):
+    """Generalized Advantage Estimation (GAE, 2016)
+
+        入力はすべて (n_envs, T)
+        戻り値はadvantageと価値関数のターゲット (advantage + value)
+    """
+    is_nonterminals = 1 - np.asarray(dones, dtype=np.float32)
+
+    deltas = rewards + gamma * is_nonterminals * next_values - values
+
+    advantages = _discounted_cumsum(
+        deltas, gamma * lam * is_nonterminals, None, use_tf)
+
+    return advantages, advantages + values
+
+
+def compute_returns(rewards, dones, gamma, last_values=None, use_tf=False):
+    """doneで打ち切る割引報酬和
+
+        rewards, dones: (n_envs, T)
+        last_values: (n_envs,) 最終ステップの次状態の価値でbootstrapする
+    """
+    is_nonterminals = 1 - np.asarray(dones, dtype=np.float32)
+
+    if last_values is not None:
+        last_values = np.asarray(last_values).reshape(-1)
+
+    return _discounted_cumsum(
+        rewards, gamma * is_nonterminals, last_values, use_tf)
+
+
 if __name__ == "__main__":
     stats = RunningStats(shape=(1,))
     x = np.arange(10).reshape(-1, 1)
@@ -46,3 +147,7 @@ if __name__ == "__main__":
     x = np.arange(10).reshape(-1, 1)
     stats.update(x)
     print(stats.mean, stats.var, stats.count)
+
+    merged = RunningStats(shape=(1,))
+    merged.merge([(x.mean(axis=0), x.var(axis=0), x.shape[0]) for _ in range(2)])
+    print(merged.mean, merged.var, merged.count)
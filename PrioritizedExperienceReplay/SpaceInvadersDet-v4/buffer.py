@@ -36,6 +36,11 @@ class PrioritizedReplayBuffer:
         else:
             self.count += 1
 
+    def add_experiences(self, exps):
+
+        for exp in exps:
+            self.add_experience(exp)
+
     def get_minibatch(self, batch_size, beta):
 
         N = len(self.experiences)
@@ -0,0 +1,171 @@
+import collections
+import random
+from dataclasses import dataclass
+from multiprocessing import Pipe, Process
+
+import gym
+import numpy as np
+
+from util import preprocess
+
+
+@dataclass
+class Step:
+
+    reward: float
+
+    next_state: np.ndarray
+
+    done: bool
+
+    life_lost: bool
+
+    #: 次に行動を選ぶ状態 (done時はreset後の状態)
+    state: np.ndarray
+
+    #: done時のみエピソードの総報酬, それ以外はNone
+    episode_rewards: float
+
+
+class FrameStackEnv:
+    """前処理とフレームスタック、ライフ管理を行う単一環境
+    """
+
+    def __init__(self, env_name, n_frames=4):
+
+        self.env = gym.make(env_name)
+
+        self.n_frames = n_frames
+
+    def reset(self):
+
+        frame = preprocess(self.env.reset())
+        self.frames = collections.deque(
+            [frame] * self.n_frames, maxlen=self.n_frames)
+
+        for _ in range(random.randint(45, 55)):
+            frame, _, _, info = self.env.step(1)
+            self.frames.append(preprocess(frame))
+
+        self.lives = info["ale.lives"]
+
+        self.episode_rewards = 0
+
+        return np.stack(self.frames, axis=2)
+
+    def step(self, action):
+
+        next_frame, reward, done, info = self.env.step(action)
+
+        self.episode_rewards += reward
+
+        self.frames.append(preprocess(next_frame))
+
+        next_state = np.stack(self.frames, axis=2)
+
+        life_lost = info["ale.lives"] != self.lives
+        self.lives = info["ale.lives"]
+
+        if done:
+            episode_rewards = self.episode_rewards
+            state = self.reset()
+        else:
+            episode_rewards = None
+            state = next_state
+
+        return Step(reward, next_state, done, life_lost, state, episode_rewards)
+
+
+class VecEnv:
+    """同一プロセス内でN個の環境をまとめて進める
+    """
+
+    def __init__(self, env_name, n_envs, n_frames=4):
+
+        self.n_envs = n_envs
+
+        self.envs = [FrameStackEnv(env_name, n_frames) for _ in range(n_envs)]
+
+    def reset(self):
+
+        return np.stack([env.reset() for env in self.envs])
+
+    def step(self, actions):
+
+        return [env.step(action) for env, action in zip(self.envs, actions)]
+
+    def close(self):
+        pass
+
+
+def workerfunc(conn, env_name, n_frames):
+
+    env = FrameStackEnv(env_name, n_frames)
+
+    while True:
+
+        cmd, action = conn.recv()
+
+        if cmd == 'step':
+            conn.send(env.step(action))
+
+        elif cmd == 'reset':
+            conn.send(env.reset())
+
+        elif cmd == 'close':
+            conn.close()
+            break
+
+        else:
+            raise NotImplementedError()
+
+
+class SubProcVecEnv:
+    """N個の環境をそれぞれ別プロセスで並列に進める
+    """
+
+    def __init__(self, env_name, n_envs, n_frames=4):
+
+        self.closed = False
+
+        self.n_envs = n_envs
+
+        pipes = [Pipe() for _ in range(self.n_envs)]
+
+        self.conns = [pipe[0] for pipe in pipes]
+
+        self.worker_conns = [pipe[1] for pipe in pipes]
+
+        self.workers = [Process(target=workerfunc,
+                                args=(worker_conn, env_name, n_frames))
+                        for worker_conn in self.worker_conns]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def reset(self):
+
+        for conn in self.conns:
+            conn.send(('reset', None))
+
+        return np.stack([conn.recv() for conn in self.conns])
+
+    def step(self, actions):
+
+        for conn, action in zip(self.conns, actions):
+            conn.send(('step', action))
+
+        return [conn.recv() for conn in self.conns]
+
+    def close(self):
+        if self.closed:
+            return
+
+        for conn in self.conns:
+            conn.send(('close', None))
+
+        for worker in self.workers:
+            worker.join()
+
+        self.closed = True
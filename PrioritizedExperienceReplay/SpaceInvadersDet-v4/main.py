@@ -9,7 +9,6 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 import tensorflow as tf
-from PIL import Image
 import tensorflow.keras.layers as kl
 import matplotlib.pyplot as plt
 import gym
@@ -17,6 +16,8 @@ from gym import wrappers
 
 from models import QNetwork
 from buffer import PrioritizedReplayBuffer
+from util import preprocess, TargetNetworkUpdater
+from env import VecEnv, SubProcVecEnv
 
 
 @dataclass
@@ -33,24 +34,6 @@ class Experience:
     done: bool
 
 
-def preprocess(frame):
-
-    frame = Image.fromarray(frame)
-    frame = frame.convert("L")
-
-    # スコア表示を消せるがUFOを打てなくなる
-    frame = frame.crop((0, 20, 160, 200))
-
-    # スコア表示あるがUFOを打てる
-    #frame = frame.crop((0, 0, 160, 200))
-
-    frame = frame.resize((84, 84))
-    frame = np.array(frame, dtype=np.float32)
-    frame = frame / 255
-
-    return frame
-
-
 class DQNAgent:
 
     MAX_EXPERIENCES = 350000
@@ -95,6 +78,9 @@ class DQNAgent:
 
         self.target_network.build(input_shape=self.INPUT_SHAPE)
 
+        self.target_updater = TargetNetworkUpdater(
+            self.target_network, self.q_network)
+
         self.replay_buffer = PrioritizedReplayBuffer(
             max_experiences=self.MAX_EXPERIENCES)
 
@@ -137,6 +123,89 @@ class DQNAgent:
 
         return total_rewards
 
+    def play_vectorized(self, total_steps, n_envs=8, use_subprocess=True):
+        """N個の環境を同時に進めるデータ収集モード
+
+            N環境の状態を1回のforwardで評価し、ε-greedyも環境ごとのεでまとめて適用する
+            N個の遷移は1回の呼び出しでbufferへ追加する
+            ε, βはエピソード数ではなく環境ステップの総数で決める
+        """
+
+        if use_subprocess:
+            vecenv = SubProcVecEnv(self.ENV_ID, n_envs, self.NUM_FRAMES)
+        else:
+            vecenv = VecEnv(self.ENV_ID, n_envs, self.NUM_FRAMES)
+
+        total_rewards = []
+
+        recent_scores = collections.deque(maxlen=5)
+
+        states = vecenv.reset()
+
+        pending_updates = 0
+
+        while self.global_steps < total_steps:
+
+            self.beta = self.BETA_INIT + (1-self.BETA_INIT) * (self.global_steps / total_steps)
+
+            self.epsilon = 1.0 - min(0.95, self.global_steps * 0.95 / 500000)
+
+            epsilons = np.full(n_envs, self.epsilon)
+
+            actions = self.q_network.sample_actions_epsgreedy(states, epsilons)
+
+            results = vecenv.step(actions)
+
+            #: reward clipping
+            exps = [Experience(state[np.newaxis, ...], action,
+                               1 if result.reward else 0,
+                               result.next_state[np.newaxis, ...],
+                               result.done or result.life_lost)
+                    for state, action, result in zip(states, actions, results)]
+
+            self.replay_buffer.add_experiences(exps)
+
+            states = np.stack([result.state for result in results])
+
+            prev_steps, self.global_steps = self.global_steps, self.global_steps + n_envs
+
+            pending_updates += n_envs / self.UPDATE_PERIOD
+            while pending_updates >= 1:
+                self.update_qnetwork()
+                pending_updates -= 1
+
+            if self.global_steps // self.COPY_PERIOD != prev_steps // self.COPY_PERIOD:
+                print("==Update target newwork==")
+                self.target_updater.hard_update()
+
+            for result in results:
+
+                if result.episode_rewards is None:
+                    continue
+
+                total_rewards.append(result.episode_rewards)
+
+                recent_scores.append(result.episode_rewards)
+
+                recent_average_score = sum(recent_scores) / len(recent_scores)
+
+                print(f"Episode {len(total_rewards)}: {result.episode_rewards}")
+                print(f"Experiences {len(self.replay_buffer)}")
+                print(f"Current epsilon {self.epsilon}")
+                print(f"Current beta {self.beta}")
+                print(f"Global step {self.global_steps}")
+                print(f"recent average score {recent_average_score}")
+                print()
+
+                if recent_average_score > self.hiscore:
+                    self.hiscore = recent_average_score
+                    print(f"HISCORE Updated: {self.hiscore}")
+                    self.save_model()
+
+        vecenv.close()
+
+        return total_rewards
+
     def play_episode(self):
 
         total_reward = 0
@@ -193,7 +262,7 @@ class DQNAgent:
 
             if self.global_steps % self.COPY_PERIOD == 0:
                 print("==Update target newwork==")
-                self.target_network.set_weights(self.q_network.get_weights())
+                self.target_updater.hard_update()
 
         return total_reward, steps
 
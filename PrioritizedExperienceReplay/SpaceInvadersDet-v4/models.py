@@ -72,6 +72,17 @@ class QNetwork(tf.keras.Model):
             states = states[np.newaxis, ...]
         return self(states).numpy()
 
+    def sample_actions_epsgreedy(self, states, epsilons):
+        """N環境ぶんの状態を1回のforwardで評価し、環境ごとのεでε-greedy
+        """
+        selected_actions = np.argmax(self.predict(states), axis=1)
+
+        n = len(selected_actions)
+        random_actions = np.random.randint(self.action_space, size=n)
+        is_random = np.random.random(n) < epsilons
+
+        return np.where(is_random, random_actions, selected_actions)
+
     def update(self, states, selected_actions, target_values, weights):
 
         selected_actions_onehot = tf.one_hot(selected_actions,
@@ -2,40 +2,47 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras.layers as kl
 
+from util import mixed_precision_policy, normalize_frames
+
 
 class DuelingQNetwork(tf.keras.Model):
 
-    def __init__(self, actions_space):
+    def __init__(self, actions_space, mixed_precision=None):
 
         super(DuelingQNetwork, self).__init__()
 
         self.action_space = actions_space
 
+        #: mixed precisionでは中間層をfloat16/bfloat16で計算し、value/advantageの出力層だけfloat32に戻す
+        dtype = mixed_precision_policy(mixed_precision)
+
         self.conv1 = kl.Conv2D(32, 8, strides=4, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.conv2 = kl.Conv2D(64, 4, strides=2, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.conv3 = kl.Conv2D(64, 3, strides=1, activation="relu",
-                               kernel_initializer="he_normal")
-        self.flatten1 = kl.Flatten()
+                               kernel_initializer="he_normal", dtype=dtype)
+        self.flatten1 = kl.Flatten(dtype=dtype)
 
         self.dense1 = kl.Dense(512, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
         self.value = kl.Dense(1, activation="relu",
-                              kernel_initializer="he_normal")
+                              kernel_initializer="he_normal", dtype="float32")
 
         self.dense2 = kl.Dense(512, activation="relu",
-                               kernel_initializer="he_normal")
+                               kernel_initializer="he_normal", dtype=dtype)
 
-        self.advanteges = kl.Dense(self.action_space, activation="relu",
-                                   kernel_initializer="he_normal")
+        self.advantages = kl.Dense(self.action_space, activation="relu",
+                                  kernel_initializer="he_normal", dtype="float32")
 
         self.qvalues = kl.Dense(self.action_space,
-                                kernel_initializer="he_normal")
+                                kernel_initializer="he_normal", dtype="float32")
 
     @tf.function
     def call(self, x):
 
+        x = normalize_frames(x)
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -62,6 +69,18 @@ class DuelingQNetwork(tf.keras.Model):
 
         return selected_action
 
+    def sample_actions_epsgreedy(self, x, epsilons):
+        """N環境ぶんの状態を1回のforwardで評価し、環境ごとのεでε-greedy
+        """
+        selected_actions, _ = self.sample_actions(x)
+        selected_actions = selected_actions.numpy()
+
+        n = len(selected_actions)
+        random_actions = np.random.randint(self.action_space, size=n)
+        is_random = np.random.random(n) < epsilons
+
+        return np.where(is_random, random_actions, selected_actions)
+
     def sample_actions(self, x):
         qvalues = self(x)
         selected_actions = tf.cast(tf.argmax(qvalues, axis=1), tf.int32)
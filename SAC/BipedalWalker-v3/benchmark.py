@@ -0,0 +1,118 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from main import SAC
+
+
+ENV_ID, ACTION_SPACE, ACTION_BOUND = "BipedalWalker-v3", 4, 1
+
+
+def legacy_update_networks(agent):
+    """1つのグラフにまとめる前の実装 (比較用)
+    """
+
+    (states, actions, rewards,
+     next_states, dones) = agent.replay_buffer.get_minibatch(agent.BATCH_SIZE)
+
+    alpha = tf.math.exp(agent.log_alpha)
+
+    next_actions, next_logprobs = agent.policy.sample_action(next_states)
+
+    target_q1, target_q2 = agent.target_dualqnet(next_states, next_actions)
+
+    target = rewards + (1 - dones) * agent.GAMMA * (
+        tf.minimum(target_q1, target_q2) + -1 * alpha * next_logprobs
+        )
+
+    with tf.GradientTape() as tape:
+        q1, q2 = agent.duqlqnet(states, actions)
+        loss_1 = tf.reduce_mean(tf.square(target - q1))
+        loss_2 = tf.reduce_mean(tf.square(target - q2))
+        loss = 0.5 * loss_1 + 0.5 * loss_2
+
+    variables = agent.duqlqnet.trainable_variables
+    grads = tape.gradient(loss, variables)
+    agent.duqlqnet.optimizer.apply_gradients(zip(grads, variables))
+
+    with tf.GradientTape() as tape:
+        selected_actions, logprobs = agent.policy.sample_action(states)
+        q1, q2 = agent.duqlqnet(states, selected_actions)
+        q_min = tf.minimum(q1, q2)
+        loss = -1 * tf.reduce_mean(q_min + -1 * alpha * logprobs)
+
+    variables = agent.policy.trainable_variables
+    grads = tape.gradient(loss, variables)
+    agent.policy.optimizer.apply_gradients(zip(grads, variables))
+
+    entropy_diff = -logprobs - agent.target_entropy
+    with tf.GradientTape() as tape:
+        tape.watch(agent.log_alpha)
+        selected_actions, logprobs = agent.policy.sample_action(states)
+        alpha_loss = tf.reduce_mean(tf.exp(agent.log_alpha) * entropy_diff)
+
+    grad = tape.gradient(alpha_loss, agent.log_alpha)
+    agent.alpha_optimizer.apply_gradients([(grad, agent.log_alpha)])
+
+    agent.target_dualqnet.set_weights(
+       (1 - agent.TAU) * np.array(agent.target_dualqnet.get_weights(), dtype=object)
+       + agent.TAU * np.array(agent.duqlqnet.get_weights(), dtype=object)
+       )
+
+
+def fill_buffer(agent, n):
+
+    obs_shape = agent.env.observation_space.shape
+
+    agent.replay_buffer.push_batch(
+        np.random.normal(size=(n, *obs_shape)),
+        np.random.uniform(-agent.action_bound, agent.action_bound,
+                          size=(n, agent.action_space)),
+        np.random.normal(size=n),
+        np.random.normal(size=(n, *obs_shape)),
+        np.random.random(n) < 0.01)
+
+
+def measure(update_func, n_steps, steps_per_call=1):
+    """勾配ステップ数/秒
+    """
+
+    #: 初回のtraceは計測から除く
+    update_func()
+
+    n_calls = n_steps // steps_per_call
+
+    start = time.time()
+
+    for _ in range(n_calls):
+        update_func()
+
+    return n_calls * steps_per_call / (time.time() - start)
+
+
+def main(n_steps=1000, steps_per_call=(1, 10)):
+
+    results = {}
+
+    agent = SAC(env_id=ENV_ID, action_space=ACTION_SPACE, action_bound=ACTION_BOUND)
+    fill_buffer(agent, agent.MIN_EXPERIENCES)
+    results["legacy"] = measure(lambda: legacy_update_networks(agent), n_steps)
+
+    for jit_compile in [False, True]:
+        for k in steps_per_call:
+            agent = SAC(env_id=ENV_ID, action_space=ACTION_SPACE, action_bound=ACTION_BOUND,
+                        jit_compile=jit_compile, updates_per_call=k)
+            fill_buffer(agent, agent.MIN_EXPERIENCES)
+            results[f"compiled(jit={jit_compile}, K={k})"] = measure(
+                lambda: agent.update_networks(k), n_steps, steps_per_call=k)
+
+    for name, steps_per_sec in results.items():
+        print(f"{name}: {steps_per_sec:.1f} grad steps/sec,",
+              f"{steps_per_sec / results['legacy']:.2f}x")
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,112 @@
-from dataclasses import dataclass
-
 import numpy as np
 
 
-@dataclass
-class Experience:
+class ReplayBuffer:
+    """要素ごとに事前確保したnumpy配列へ格納するリプレイ (structure of arrays)
 
-    state: np.ndarray
+        observation_space, action_spaceはgymのspace (Box) を想定
+        pushは書き込み位置への代入のみでO(1)、
+        ミニバッチはindex配列による各配列1回ずつのgatherで作る
+    """
 
-    action: np.ndarray
+    def __init__(self, observation_space, action_space, max_len=1000000):
 
-    reward: float
+        self.max_len = max_len
 
-    next_state: np.ndarray
+        obs_shape = observation_space.shape
 
-    done: bool
+        action_shape = action_space.shape
 
+        self.states = np.zeros((max_len, *obs_shape), dtype=np.float32)
 
-class ReplayBuffer:
+        self.actions = np.zeros((max_len, *action_shape), dtype=np.float32)
 
-    def __init__(self, max_len=1000000):
+        self.rewards = np.zeros((max_len, 1), dtype=np.float32)
 
-        self.max_len = max_len
+        self.next_states = np.zeros((max_len, *obs_shape), dtype=np.float32)
 
-        self.buffer = []
+        self.dones = np.zeros((max_len, 1), dtype=np.float32)
 
         self.count = 0
 
+        self.size = 0
+
     def __len__(self):
-        return len(self.buffer)
+        return self.size
+
+    def push(self, state, action, reward, next_state, done):
+
+        idx = self.count
+
+        self.states[idx] = state
+        self.actions[idx] = action
+        self.rewards[idx] = reward
+        self.next_states[idx] = next_state
+        self.dones[idx] = done
 
-    def push(self, exp):
+        self.count = (self.count + 1) % self.max_len
 
-        if self.count == self.max_len:
-            self.count = 0
+        self.size = min(self.size + 1, self.max_len)
 
-        try:
-            self.buffer[self.count] = exp
-        except IndexError:
-            self.buffer.append(exp)
+    def push_batch(self, states, actions, rewards, next_states, dones):
+        """ベクトル化環境用: N個の遷移をまとめて書き込む
+        """
+        n = len(states)
 
-        self.count += 1
+        indices = (self.count + np.arange(n)) % self.max_len
 
-    def get_minibatch(self, batch_size):
+        self.states[indices] = states
+        self.actions[indices] = actions
+        self.rewards[indices] = np.reshape(rewards, (-1, 1))
+        self.next_states[indices] = next_states
+        self.dones[indices] = np.reshape(dones, (-1, 1))
 
-        N = len(self.buffer)
+        self.count = (self.count + n) % self.max_len
 
-        indices = np.random.choice(
-            np.arange(N), replace=False, size=batch_size)
+        self.size = min(self.size + n, self.max_len)
 
-        selected_experiences = [self.buffer[idx] for idx in indices]
+    def sample_indices(self, batch_size):
 
-        states = np.vstack(
-            [exp.state for exp in selected_experiences]).astype(np.float32)
+        return np.random.randint(self.size, size=batch_size)
 
-        actions = np.vstack(
-            [exp.action for exp in selected_experiences]).astype(np.float32)
+    def ages(self, indices):
+        """各indexの遷移が書き込まれてから後に追加された遷移の数
+        """
+        return (self.count - 1 - indices) % self.max_len
 
-        rewards = np.array(
-            [exp.reward for exp in selected_experiences]).reshape(-1, 1)
+    def get_minibatch(self, batch_size, indices=None):
 
-        next_states = np.vstack(
-            [exp.next_state for exp in selected_experiences]
-            ).astype(np.float32)
+        if indices is None:
+            indices = self.sample_indices(batch_size)
 
-        dones = np.array(
-            [exp.done for exp in selected_experiences]).reshape(-1, 1)
+        states = self.states[indices]
+
+        actions = self.actions[indices]
+
+        rewards = self.rewards[indices]
+
+        next_states = self.next_states[indices]
+
+        dones = self.dones[indices]
 
         return (states, actions, rewards, next_states, dones)
 
 
 if __name__ == "__main__":
-    replaybuffer = ReplayBuffer(max_len=3)
+    import gym
+
+    env = gym.make("Pendulum-v0")
+
+    replaybuffer = ReplayBuffer(env.observation_space, env.action_space, max_len=3)
     for i in range(7):
-        replaybuffer.push((i, i, i))
+        replaybuffer.push(np.full(3, i), np.full(1, i), i, np.full(3, i + 1), False)
+
+    print(len(replaybuffer), replaybuffer.rewards.flatten())
+
+    replaybuffer.push_batch(np.zeros((2, 3)), np.zeros((2, 1)),
+                            np.array([10, 11]), np.zeros((2, 3)), np.array([True, False]))
+
+    print(len(replaybuffer), replaybuffer.rewards.flatten())
 
-    print(replaybuffer.buffer)
+    states, actions, rewards, next_states, dones = replaybuffer.get_minibatch(4)
+    print(states.shape, actions.shape, rewards.shape, dones.shape)
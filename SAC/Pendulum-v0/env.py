@@ -0,0 +1,145 @@
+from dataclasses import dataclass
+from multiprocessing import Pipe, Process
+
+import gym
+import numpy as np
+
+
+@dataclass
+class Step:
+
+    reward: float
+
+    next_state: np.ndarray
+
+    done: bool
+
+    #: 次に行動を選ぶ状態 (done時はreset後の状態)
+    state: np.ndarray
+
+    #: done時のみエピソードの総報酬, それ以外はNone
+    episode_reward: float
+
+
+class AutoResetEnv:
+    """done時に自動でresetし、エピソードの総報酬を返す単一環境
+    """
+
+    def __init__(self, env_id):
+
+        self.env = gym.make(env_id)
+
+    def reset(self):
+
+        self.episode_reward = 0
+
+        return self.env.reset()
+
+    def step(self, action):
+
+        next_state, reward, done, _ = self.env.step(action)
+
+        self.episode_reward += reward
+
+        if done:
+            episode_reward = self.episode_reward
+            state = self.reset()
+        else:
+            episode_reward = None
+            state = next_state
+
+        return Step(reward, next_state, done, state, episode_reward)
+
+
+class VecEnv:
+    """同一プロセス内でN個の環境をまとめて進める
+    """
+
+    def __init__(self, env_id, n_envs):
+
+        self.n_envs = n_envs
+
+        self.envs = [AutoResetEnv(env_id) for _ in range(n_envs)]
+
+    def reset(self):
+
+        return np.stack([env.reset() for env in self.envs])
+
+    def step(self, actions):
+
+        return [env.step(action) for env, action in zip(self.envs, actions)]
+
+    def close(self):
+        pass
+
+
+def workerfunc(conn, env_id):
+
+    env = AutoResetEnv(env_id)
+
+    while True:
+
+        cmd, action = conn.recv()
+
+        if cmd == 'step':
+            conn.send(env.step(action))
+
+        elif cmd == 'reset':
+            conn.send(env.reset())
+
+        elif cmd == 'close':
+            conn.close()
+            break
+
+        else:
+            raise NotImplementedError()
+
+
+class SubProcVecEnv:
+    """N個の環境をそれぞれ別プロセスで並列に進める
+    """
+
+    def __init__(self, env_id, n_envs):
+
+        self.closed = False
+
+        self.n_envs = n_envs
+
+        pipes = [Pipe() for _ in range(self.n_envs)]
+
+        self.conns = [pipe[0] for pipe in pipes]
+
+        self.worker_conns = [pipe[1] for pipe in pipes]
+
+        self.workers = [Process(target=workerfunc, args=(worker_conn, env_id))
+                        for worker_conn in self.worker_conns]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def reset(self):
+
+        for conn in self.conns:
+            conn.send(('reset', None))
+
+        return np.stack([conn.recv() for conn in self.conns])
+
+    def step(self, actions):
+
+        for conn, action in zip(self.conns, actions):
+            conn.send(('step', action))
+
+        return [conn.recv() for conn in self.conns]
+
+    def close(self):
+        if self.closed:
+            return
+
+        for conn in self.conns:
+            conn.send(('close', None))
+
+        for worker in self.workers:
+            worker.join()
+
+        self.closed = True
@@ -1,5 +1,7 @@
 from pathlib import Path
 import shutil
+import threading
+import time
 
 import numpy as np
 import tensorflow as tf
@@ -7,7 +9,9 @@ import gym
 from gym import wrappers
 
 from models import GaussianPolicy, DualQNetwork
-from buffer import ReplayBuffer, Experience
+from buffer import ReplayBuffer
+from util import TargetNetworkUpdater
+from env import VecEnv, SubProcVecEnv
 
 
 class SAC:
@@ -24,7 +28,12 @@ class SAC:
 
     BATCH_SIZE = 256
 
-    def __init__(self, env_id, action_space, action_bound):
+    def __init__(self, env_id, action_space, action_bound,
+                 jit_compile=False, updates_per_call=1):
+        """
+            jit_compile: 学習ステップをXLAでコンパイルする
+            updates_per_call: 1回の呼び出しで行う勾配ステップ数
+        """
 
         self.env_id = env_id
 
@@ -34,7 +43,9 @@ class SAC:
 
         self.env = gym.make(self.env_id)
 
-        self.replay_buffer = ReplayBuffer(max_len=self.MAX_EXPERIENCES)
+        self.replay_buffer = ReplayBuffer(self.env.observation_space,
+                                          self.env.action_space,
+                                          max_len=self.MAX_EXPERIENCES)
 
         self.policy = GaussianPolicy(action_space=self.action_space,
                                      action_bound=self.action_bound)
@@ -43,6 +54,9 @@ class SAC:
 
         self.target_dualqnet = DualQNetwork()
 
+        self.target_updater = TargetNetworkUpdater(
+            self.target_dualqnet, self.duqlqnet, tau=self.TAU)
+
         self.log_alpha = tf.Variable(0.)  #: alpha=1
 
         self.alpha_optimizer = tf.keras.optimizers.Adam(3e-4)
@@ -51,6 +65,11 @@ class SAC:
 
         self.global_steps = 0
 
+        self.updates_per_call = updates_per_call
+
+        self._train_steps = tf.function(
+            self._train_steps_impl, experimental_compile=jit_compile)
+
         self._initialize_weights()
 
     def _initialize_weights(self):
@@ -69,7 +88,7 @@ class SAC:
 
         self.duqlqnet(dummy_state, dummy_action)
         self.target_dualqnet(dummy_state, dummy_action)
-        self.target_dualqnet.set_weights(self.duqlqnet.get_weights())
+        self.target_updater.hard_update()
 
     def play_episode(self):
 
@@ -89,9 +108,7 @@ class SAC:
 
             next_state, reward, done, _ = self.env.step(action)
 
-            exp = Experience(state, action, reward, next_state, done)
-
-            self.replay_buffer.push(exp)
+            self.replay_buffer.push(state, action, reward, next_state, done)
 
             state = next_state
 
@@ -101,17 +118,195 @@ class SAC:
 
             self.global_steps += 1
 
+            #: updates_per_call回ぶんの更新をまとめて行うので呼び出し間隔もその倍
             if (len(self.replay_buffer) >= self.MIN_EXPERIENCES
-               and self.global_steps % self.UPDATE_PERIOD == 0):
+               and self.global_steps % (self.UPDATE_PERIOD * self.updates_per_call) == 0):
 
-                self.update_networks()
+                self.update_networks(self.updates_per_call)
 
         return episode_reward, local_steps, tf.exp(self.log_alpha)
 
-    def update_networks(self):
+    def learn_vectorized(self, total_steps, n_envs=8, use_subprocess=True,
+                         update_to_data_ratio=None, max_lag=1000,
+                         summary_writer=None, logging_period=10000):
+        """N個の環境で集めたデータをbufferへ送りつつ、別スレッドのlearnerで学習する
+
+            update_to_data_ratio: 環境1ステップあたりの勾配ステップ数 (既定は1/UPDATE_PERIOD)
+            learnerが目標よりmax_lag勾配ステップ以上遅れたらactorを待たせる
+            TFの演算中はGILが外れるのでactorの環境ステップと学習は並行して進む
+            learnerで例外が起きたらactorを止めて呼び出し元へ投げ直す
+        """
+
+        if update_to_data_ratio is None:
+            update_to_data_ratio = 1 / self.UPDATE_PERIOD
+
+        #: learnerはupdates_per_call単位でしか進まないので、max_lagがそれより小さいと
+        #: learnerは目標を超えるので更新せず、actorは遅れすぎなので待つ、というデッドロックになる
+        assert max_lag >= self.updates_per_call, \
+            f"max_lag ({max_lag}) must be >= updates_per_call ({self.updates_per_call})"
+
+        if use_subprocess:
+            vecenv = SubProcVecEnv(self.env_id, n_envs)
+        else:
+            vecenv = VecEnv(self.env_id, n_envs)
+
+        lock = threading.Lock()
+
+        stop_event = threading.Event()
+
+        stats = {"env_steps": 0, "grad_steps": 0, "staleness": [], "error": None}
+
+        learner = threading.Thread(
+            target=self._learner_loop,
+            args=(lock, stop_event, stats, update_to_data_ratio))
+        learner.start()
+
+        episode_rewards = []
+
+        states = vecenv.reset()
+
+        start = last_log = time.time()
+        last_env_steps, last_grad_steps = 0, 0
+
+        while stats["env_steps"] < total_steps:
+
+            #: learnerが遅れすぎているときは追いつくまで待つ
+            while (learner.is_alive()
+                   and len(self.replay_buffer) >= self.MIN_EXPERIENCES
+                   and stats["grad_steps"] < update_to_data_ratio * stats["env_steps"] - max_lag):
+                time.sleep(0.001)
+
+            if stats["error"] is not None:
+                vecenv.close()
+                raise stats["error"]
+
+            actions, _ = self.policy.sample_action(states.astype(np.float32))
+            actions = actions.numpy()
+
+            results = vecenv.step(actions)
+
+            with lock:
+                self.replay_buffer.push_batch(
+                    states, actions,
+                    np.array([result.reward for result in results]),
+                    np.stack([result.next_state for result in results]),
+                    np.array([result.done for result in results]))
+
+            states = np.stack([result.state for result in results])
+
+            stats["env_steps"] += n_envs
+
+            self.global_steps += n_envs
+
+            for result in results:
+                if result.episode_reward is not None:
+                    episode_rewards.append(result.episode_reward)
+
+            if stats["env_steps"] - last_env_steps >= logging_period:
+
+                now = time.time()
+
+                env_steps_per_sec = (stats["env_steps"] - last_env_steps) / (now - last_log)
+                grad_steps_per_sec = (stats["grad_steps"] - last_grad_steps) / (now - last_log)
+                staleness = np.mean(stats["staleness"]) if stats["staleness"] else 0.
+                stats["staleness"] = []
+
+                print(f"Env steps {stats['env_steps']}, grad steps {stats['grad_steps']}:",
+                      f"{env_steps_per_sec:.1f} env steps/sec,",
+                      f"{grad_steps_per_sec:.1f} grad steps/sec,",
+                      f"staleness {staleness:.1f}")
+
+                if summary_writer is not None:
+                    with summary_writer.as_default():
+                        step = stats["env_steps"]
+                        tf.summary.scalar("env_steps_per_sec", env_steps_per_sec, step=step)
+                        tf.summary.scalar("grad_steps_per_sec", grad_steps_per_sec, step=step)
+                        tf.summary.scalar("sample_staleness", staleness, step=step)
+                        tf.summary.scalar("alpha", tf.exp(self.log_alpha), step=step)
+                        if episode_rewards:
+                            tf.summary.scalar("episode_reward",
+                                              np.mean(episode_rewards[-n_envs:]), step=step)
+
+                last_log = now
+                last_env_steps, last_grad_steps = stats["env_steps"], stats["grad_steps"]
+
+        stop_event.set()
+        learner.join()
+        vecenv.close()
+
+        if stats["error"] is not None:
+            raise stats["error"]
+
+        elapsed = time.time() - start
+
+        print(f"Finished: {stats['env_steps'] / elapsed:.1f} env steps/sec,",
+              f"{stats['grad_steps'] / elapsed:.1f} grad steps/sec")
+
+        return episode_rewards
+
+    def _learner_loop(self, lock, stop_event, stats, update_to_data_ratio):
+        """目標のupdate-to-data比を超えない範囲で更新し続ける
+
+            staleness: サンプルした遷移が書き込まれてから何遷移経っているか
+            例外はstats["error"]に入れて終了し、actor側で投げ直す
+        """
+
+        n_steps = self.updates_per_call
+
+        try:
+            while not stop_event.is_set():
+
+                if (len(self.replay_buffer) < self.MIN_EXPERIENCES
+                   or stats["grad_steps"] + n_steps > update_to_data_ratio * stats["env_steps"]):
+                    time.sleep(0.001)
+                    continue
+
+                with lock:
+                    indices = [self.replay_buffer.sample_indices(self.BATCH_SIZE)
+                               for _ in range(n_steps)]
+                    minibatches = [self.replay_buffer.get_minibatch(self.BATCH_SIZE, idx)
+                                   for idx in indices]
+                    ages = self.replay_buffer.ages(np.concatenate(indices))
+
+                self._train_minibatches(minibatches)
+
+                stats["grad_steps"] += n_steps
+
+                stats["staleness"].append(ages.mean())
+
+        except Exception as e:
+            stats["error"] = e
+
+    def update_networks(self, n_steps=1):
+        """n_steps回ぶんのミニバッチをまとめて渡し、1回の呼び出しでn_steps回更新する
+        """
+
+        minibatches = [self.replay_buffer.get_minibatch(self.BATCH_SIZE)
+                       for _ in range(n_steps)]
+
+        return self._train_minibatches(minibatches)
+
+    def _train_minibatches(self, minibatches):
 
         (states, actions, rewards,
-         next_states, dones) = self.replay_buffer.get_minibatch(self.BATCH_SIZE)
+         next_states, dones) = [np.stack(x) for x in zip(*minibatches)]
+
+        return self._train_steps(states, actions, rewards, next_states, dones)
+
+    def _train_steps_impl(self, states, actions, rewards, next_states, dones):
+        """
+            入力は (n_steps, batch_size, ...)
+            n_stepsはtrace時に決まるのでpythonのループで展開する
+        """
+        for i in range(states.shape[0]):
+            info = self._train_step(
+                states[i], actions[i], rewards[i], next_states[i], dones[i])
+
+        return info
+
+    def _train_step(self, states, actions, rewards, next_states, dones):
+        """critic, actor, alphaの更新とsoft target updateを1ステップ分
+        """
 
         alpha = tf.math.exp(self.log_alpha)
 
@@ -128,10 +323,10 @@ class SAC:
             q1, q2 = self.duqlqnet(states, actions)
             loss_1 = tf.reduce_mean(tf.square(target - q1))
             loss_2 = tf.reduce_mean(tf.square(target - q2))
-            loss = 0.5 * loss_1 + 0.5 * loss_2
+            q_loss = 0.5 * loss_1 + 0.5 * loss_2
 
         variables = self.duqlqnet.trainable_variables
-        grads = tape.gradient(loss, variables)
+        grads = tape.gradient(q_loss, variables)
         self.duqlqnet.optimizer.apply_gradients(zip(grads, variables))
 
         #: Update policy
@@ -139,27 +334,27 @@ class SAC:
             selected_actions, logprobs = self.policy.sample_action(states)
             q1, q2 = self.duqlqnet(states, selected_actions)
             q_min = tf.minimum(q1, q2)
-            loss = -1 * tf.reduce_mean(q_min + -1 * alpha * logprobs)
+            policy_loss = -1 * tf.reduce_mean(q_min + -1 * alpha * logprobs)
 
         variables = self.policy.trainable_variables
-        grads = tape.gradient(loss, variables)
+        grads = tape.gradient(policy_loss, variables)
         self.policy.optimizer.apply_gradients(zip(grads, variables))
 
         #: Adjust alpha
-        entropy_diff = -1 * logprobs - self.target_entropy
+        entropy_diff = tf.stop_gradient(-1 * logprobs - self.target_entropy)
         with tf.GradientTape() as tape:
-            tape.watch(self.log_alpha)
-            selected_actions, logprobs = self.policy.sample_action(states)
             alpha_loss = tf.reduce_mean(tf.exp(self.log_alpha) * entropy_diff)
 
         grad = tape.gradient(alpha_loss, self.log_alpha)
         self.alpha_optimizer.apply_gradients([(grad, self.log_alpha)])
 
         #: Soft target update
-        self.target_dualqnet.set_weights(
-           (1 - self.TAU) * np.array(self.target_dualqnet.get_weights())
-           + self.TAU * np.array(self.duqlqnet.get_weights())
-           )
+        self.target_updater.soft_update()
+
+        info = {"q_loss": q_loss, "policy_loss": policy_loss,
+                "alpha_loss": alpha_loss}
+
+        return info
 
     def save_model(self):
 
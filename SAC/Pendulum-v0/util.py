@@ -1,4 +1,5 @@
 import numpy as np
+import tensorflow as tf
 
 
 class RunningStats:
@@ -38,6 +39,74 @@ class RunningStats:
         return new_mean, new_var, new_count
 
 
+class TargetNetworkUpdater:
+    """targetネットワークの変数をonlineネットワークの変数と対応づけて保持し、
+       target = (1 - tau) * target + tau * online をグラフ内のassignで行う
+
+        重みをnumpyに書き出さないのでhostとの往復コピーが発生しない
+        fused=Trueなら全変数を1本のベクトルに連結して1回の演算でまとめて計算する
+        tf.functionの中から呼ぶとそのグラフに埋め込まれる
+        両ネットワークはbuild済みであること
+    """
+
+    def __init__(self, target_network, online_network, tau=1.0, fused=False):
+
+        self.target_network = target_network
+
+        self.online_network = online_network
+
+        self.tau = tau
+
+        self.fused = fused
+
+    def _variables(self):
+
+        target_vars = self.target_network.weights
+
+        online_vars = self.online_network.weights
+
+        assert len(target_vars) == len(online_vars) > 0
+
+        return target_vars, online_vars
+
+    def soft_update(self, tau=None):
+
+        tau = self.tau if tau is None else tau
+
+        return self._soft_update(tf.constant(tau, dtype=tf.float32))
+
+    def hard_update(self):
+
+        return self._hard_update()
+
+    @tf.function
+    def _soft_update(self, tau):
+
+        target_vars, online_vars = self._variables()
+
+        if self.fused:
+            sizes = [tf.size(var) for var in target_vars]
+
+            flat_target = tf.concat([tf.reshape(var, [-1]) for var in target_vars], 0)
+            flat_online = tf.concat([tf.reshape(var, [-1]) for var in online_vars], 0)
+
+            flat_new = (1 - tau) * flat_target + tau * flat_online
+
+            for var, value in zip(target_vars, tf.split(flat_new, sizes)):
+                var.assign(tf.reshape(value, var.shape))
+        else:
+            for target_var, online_var in zip(target_vars, online_vars):
+                target_var.assign((1 - tau) * target_var + tau * online_var)
+
+    @tf.function
+    def _hard_update(self):
+
+        target_vars, online_vars = self._variables()
+
+        for target_var, online_var in zip(target_vars, online_vars):
+            target_var.assign(online_var)
+
+
 if __name__ == "__main__":
     stats = RunningStats(shape=(1,))
     x = np.arange(10).reshape(-1, 1)
@@ -0,0 +1,110 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from main import TD3Agent
+
+
+def legacy_update_network(agent, batch_size, update_policy=False):
+    """tf.function化する前の実装 (比較用)
+    """
+
+    (states, actions, rewards,
+     next_states, dones) = agent.buffer.get_minibatch(batch_size)
+
+    clipped_noise = np.clip(
+        np.random.normal(0, agent.POLICY_NOISE, agent.ACTION_SPACE), -0.5, 0.5)
+
+    next_actions = agent.target_actor(next_states) + clipped_noise * agent.MAX_ACTION
+
+    q1, q2 = agent.target_critic(next_states, next_actions)
+
+    next_qvalues = [min(q1, q2) for q1, q2
+                    in zip(q1.numpy().flatten(), q2.numpy().flatten())]
+
+    target_values = np.vstack(
+        [reward + agent.GAMMA * next_qvalue if not done else reward
+         for reward, done, next_qvalue
+         in zip(rewards.flatten(), dones.flatten(), next_qvalues)]).astype(np.float32)
+
+    with tf.GradientTape() as tape:
+        q1, q2 = agent.critic(states, actions)
+        loss1 = tf.reduce_mean(tf.square(target_values - q1))
+        loss2 = tf.reduce_mean(tf.square(target_values - q2))
+        loss = loss1 + loss2
+
+    variables = agent.critic.trainable_variables
+    gradients = tape.gradient(loss, variables)
+    agent.critic.optimizer.apply_gradients(zip(gradients, variables))
+
+    if update_policy:
+
+        with tf.GradientTape() as tape:
+            q1, _ = agent.critic(states, agent.actor(states))
+            J = -1 * tf.reduce_mean(q1)
+
+        variables = agent.actor.trainable_variables
+        gradients = tape.gradient(J, variables)
+        agent.actor.optimizer.apply_gradients(zip(gradients, variables))
+
+        agent.target_actor.set_weights(
+            [(1 - agent.TAU) * w_target + agent.TAU * w for w_target, w
+             in zip(agent.target_actor.get_weights(), agent.actor.get_weights())])
+
+        agent.target_critic.set_weights(
+            [(1 - agent.TAU) * w_target + agent.TAU * w for w_target, w
+             in zip(agent.target_critic.get_weights(), agent.critic.get_weights())])
+
+
+def fill_buffer(agent, n):
+
+    obs_shape = agent.env.observation_space.shape
+
+    agent.buffer.push_batch(
+        np.random.normal(size=(n, *obs_shape)),
+        np.random.uniform(-agent.MAX_ACTION, agent.MAX_ACTION, size=(n, agent.ACTION_SPACE)),
+        np.random.normal(size=n),
+        np.random.normal(size=(n, *obs_shape)),
+        np.random.random(n) < 0.01)
+
+
+def measure(update_func, n_steps, policy_update_ratio):
+    """critic更新n_steps回 (うちpolicy更新はpolicy_update_ratio回に1回) の更新回数/秒
+    """
+
+    #: 初回のtrace/optimizer変数の作成は計測から除く
+    update_func(update_policy=False)
+    update_func(update_policy=True)
+
+    start = time.time()
+
+    for n in range(1, n_steps+1):
+        update_func(update_policy=(n % policy_update_ratio == 0))
+
+    return n_steps / (time.time() - start)
+
+
+def main(n_steps=2000):
+
+    agent = TD3Agent()
+
+    fill_buffer(agent, agent.MIN_EXPERIENCES)
+
+    policy_update_ratio = agent.POLICY_UPDATE_PERIOD // agent.CRITIC_UPDATE_PERIOD
+
+    legacy = measure(
+        lambda update_policy: legacy_update_network(agent, agent.BATCH_SIZE, update_policy),
+        n_steps, policy_update_ratio)
+
+    compiled = measure(
+        lambda update_policy: agent.update_network(agent.BATCH_SIZE, update_policy),
+        n_steps, policy_update_ratio)
+
+    print(f"legacy:   {legacy:.1f} updates/sec")
+    print(f"compiled: {compiled:.1f} updates/sec")
+    print(f"speedup:  {compiled / legacy:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
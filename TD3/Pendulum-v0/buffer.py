@@ -1,51 +1,112 @@
-import collections
-from dataclasses import dataclass
-
 import numpy as np
 
 
 class ReplayBuffer:
+    """要素ごとに事前確保したnumpy配列へ格納するリプレイ (structure of arrays)
+
+        observation_space, action_spaceはgymのspace (Box) を想定
+        pushは書き込み位置への代入のみでO(1)、
+        ミニバッチはindex配列による各配列1回ずつのgatherで作る
+    """
+
+    def __init__(self, observation_space, action_space, max_len=1000000):
+
+        self.max_len = max_len
+
+        obs_shape = observation_space.shape
+
+        action_shape = action_space.shape
+
+        self.states = np.zeros((max_len, *obs_shape), dtype=np.float32)
 
-    def __init__(self, max_experiences):
+        self.actions = np.zeros((max_len, *action_shape), dtype=np.float32)
 
-        self.max_experiences = max_experiences
+        self.rewards = np.zeros((max_len, 1), dtype=np.float32)
+
+        self.next_states = np.zeros((max_len, *obs_shape), dtype=np.float32)
+
+        self.dones = np.zeros((max_len, 1), dtype=np.float32)
 
         self.count = 0
 
-        self.experiences = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, state, action, reward, next_state, done):
+
+        idx = self.count
+
+        self.states[idx] = state
+        self.actions[idx] = action
+        self.rewards[idx] = reward
+        self.next_states[idx] = next_state
+        self.dones[idx] = done
 
-    def add_experience(self, exp):
+        self.count = (self.count + 1) % self.max_len
 
-        if len(self.experiences) == self.max_experiences:
-            self.experiences[self.count] = exp
-        else:
-            self.experiences.append(exp)
+        self.size = min(self.size + 1, self.max_len)
 
-        if self.count == self.max_experiences-1:
-            self.count = 0
-        else:
-            self.count += 1
+    def push_batch(self, states, actions, rewards, next_states, dones):
+        """ベクトル化環境用: N個の遷移をまとめて書き込む
+        """
+        n = len(states)
 
-    def get_minibatch(self, batch_size):
+        indices = (self.count + np.arange(n)) % self.max_len
 
-        N = len(self.experiences)
+        self.states[indices] = states
+        self.actions[indices] = actions
+        self.rewards[indices] = np.reshape(rewards, (-1, 1))
+        self.next_states[indices] = next_states
+        self.dones[indices] = np.reshape(dones, (-1, 1))
 
-        indices = np.random.choice(np.arange(N), replace=False,
-                                   size=batch_size)
+        self.count = (self.count + n) % self.max_len
 
-        selected_experiences = [self.experiences[idx] for idx in indices]
+        self.size = min(self.size + n, self.max_len)
 
-        states = np.vstack([exp.state for exp in selected_experiences]).astype(np.float32)
+    def sample_indices(self, batch_size):
 
-        actions = [exp.action for exp in selected_experiences]
+        return np.random.randint(self.size, size=batch_size)
 
-        rewards = [exp.reward for exp in selected_experiences]
+    def ages(self, indices):
+        """各indexの遷移が書き込まれてから後に追加された遷移の数
+        """
+        return (self.count - 1 - indices) % self.max_len
 
-        next_states = np.vstack([exp.next_state for exp in selected_experiences]).astype(np.float32)
+    def get_minibatch(self, batch_size, indices=None):
 
-        dones = [exp.done for exp in selected_experiences]
+        if indices is None:
+            indices = self.sample_indices(batch_size)
+
+        states = self.states[indices]
+
+        actions = self.actions[indices]
+
+        rewards = self.rewards[indices]
+
+        next_states = self.next_states[indices]
+
+        dones = self.dones[indices]
 
         return (states, actions, rewards, next_states, dones)
 
-    def __len__(self):
-        return len(self.experiences)
+
+if __name__ == "__main__":
+    import gym
+
+    env = gym.make("Pendulum-v0")
+
+    replaybuffer = ReplayBuffer(env.observation_space, env.action_space, max_len=3)
+    for i in range(7):
+        replaybuffer.push(np.full(3, i), np.full(1, i), i, np.full(3, i + 1), False)
+
+    print(len(replaybuffer), replaybuffer.rewards.flatten())
+
+    replaybuffer.push_batch(np.zeros((2, 3)), np.zeros((2, 1)),
+                            np.array([10, 11]), np.zeros((2, 3)), np.array([True, False]))
+
+    print(len(replaybuffer), replaybuffer.rewards.flatten())
+
+    states, actions, rewards, next_states, dones = replaybuffer.get_minibatch(4)
+    print(states.shape, actions.shape, rewards.shape, dones.shape)
@@ -1,4 +1,3 @@
-from dataclasses import dataclass
 import collections
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -12,20 +11,7 @@ import matplotlib.pyplot as plt
 
 from buffer import ReplayBuffer
 from models import ActorNetwork, CriticNetwork
-
-
-@dataclass
-class Experience:
-
-    state: np.ndarray
-
-    action: int
-
-    reward: float
-
-    next_state: np.ndarray
-
-    done: bool
+from util import TargetNetworkUpdater
 
 
 class TD3Agent:
@@ -54,6 +40,10 @@ class TD3Agent:
 
     NOISE_STDDEV = 0.2
 
+    POLICY_NOISE = 0.2
+
+    NOISE_CLIP = 0.5
+
     def __init__(self):
 
         self.env = gym.make(self.ENV_ID)
@@ -70,7 +60,15 @@ class TD3Agent:
 
         self.target_critic = CriticNetwork()
 
-        self.buffer = ReplayBuffer(max_experiences=self.MAX_EXPERIENCES)
+        self.target_actor_updater = TargetNetworkUpdater(
+            self.target_actor, self.actor, tau=self.TAU)
+
+        self.target_critic_updater = TargetNetworkUpdater(
+            self.target_critic, self.critic, tau=self.TAU)
+
+        self.buffer = ReplayBuffer(self.env.observation_space,
+                                   self.env.action_space,
+                                   max_len=self.MAX_EXPERIENCES)
 
         self.global_steps = 0
 
@@ -90,11 +88,11 @@ class TD3Agent:
 
         self.actor.call(dummy_state)
         self.target_actor.call(dummy_state)
-        self.target_actor.set_weights(self.actor.get_weights())
+        self.target_actor_updater.hard_update()
 
         self.critic.call(dummy_state, dummy_action, training=False)
         self.target_critic.call(dummy_state, dummy_action, training=False)
-        self.target_critic.set_weights(self.critic.get_weights())
+        self.target_critic_updater.hard_update()
 
     def play(self, n_episodes):
 
@@ -143,9 +141,7 @@ class TD3Agent:
 
             next_state, reward, done, _ = self.env.step(action)
 
-            exp = Experience(state, action, reward, next_state, done)
-
-            self.buffer.add_experience(exp)
+            self.buffer.push(state, action, reward, next_state, done)
 
             state = next_state
 
@@ -159,7 +155,6 @@ class TD3Agent:
             if self.global_steps % self.CRITIC_UPDATE_PERIOD == 0:
                 if self.global_steps % self.POLICY_UPDATE_PERIOD == 0:
                     self.update_network(self.BATCH_SIZE, update_policy=True)
-                    self.update_target_network()
                 else:
                     self.update_network(self.BATCH_SIZE)
 
@@ -173,21 +168,45 @@ class TD3Agent:
         (states, actions, rewards,
          next_states, dones) = self.buffer.get_minibatch(batch_size)
 
-        clipped_noise = np.clip(
-            np.random.normal(0, 0.2, self.ACTION_SPACE), -0.5, 0.5)
+        if update_policy:
+            self._update_critic_and_policy(
+                states, actions, rewards, next_states, dones)
+        else:
+            self._update_critic(
+                states, actions, rewards, next_states, dones)
+
+    @tf.function
+    def _update_critic(self, states, actions, rewards, next_states, dones):
+        return self._train_step(states, actions, rewards, next_states, dones,
+                                update_policy=False)
+
+    @tf.function
+    def _update_critic_and_policy(self, states, actions, rewards, next_states, dones):
+        """
+            update_policyごとにtf.functionを分けているのは、
+            actorのoptimizerの変数をこちらの初回trace時に作らせるため
+        """
+        return self._train_step(states, actions, rewards, next_states, dones,
+                                update_policy=True)
+
+    def _train_step(self, states, actions, rewards, next_states, dones,
+                    update_policy):
+        """critic更新, 遅延actor更新, soft target updateを1つのグラフで行う
+        """
+
+        #: Target policy smoothing: ノイズはサンプルごとに独立
+        noise = tf.random.normal(tf.shape(actions), stddev=self.POLICY_NOISE)
+        clipped_noise = tf.clip_by_value(noise, -self.NOISE_CLIP, self.NOISE_CLIP)
 
         next_actions = self.target_actor(next_states) + clipped_noise * self.MAX_ACTION
+        next_actions = tf.clip_by_value(next_actions, -self.MAX_ACTION, self.MAX_ACTION)
 
         q1, q2 = self.target_critic(next_states, next_actions)
 
-        next_qvalues = [min(q1, q2) for q1, q2
-                        in zip(q1.numpy().flatten(), q2.numpy().flatten())]
+        next_qvalues = tf.minimum(q1, q2)
 
         #: Compute taeget values and update CriticNetwork
-        target_values = np.vstack(
-            [reward + self.GAMMA * next_qvalue if not done else reward
-             for reward, done, next_qvalue
-             in zip(rewards, dones, next_qvalues)]).astype(np.float32)
+        target_values = rewards + self.GAMMA * (1 - dones) * next_qvalues
 
         #: Update Critic
         with tf.GradientTape() as tape:
@@ -211,27 +230,11 @@ class TD3Agent:
             gradients = tape.gradient(J, variables)
             self.actor.optimizer.apply_gradients(zip(gradients, variables))
 
-    def update_target_network(self):
-
-        # soft-target update Actor
-        target_actor_weights = self.target_actor.get_weights()
-        actor_weights = self.actor.get_weights()
-
-        assert len(target_actor_weights) == len(actor_weights)
-
-        self.target_actor.set_weights(
-            (1 - self.TAU) * np.array(target_actor_weights)
-            + (self.TAU) * np.array(actor_weights))
-
-        # soft-target update Critic
-        target_critic_weights = self.target_critic.get_weights()
-        critic_weights = self.critic.get_weights()
-
-        assert len(target_critic_weights) == len(critic_weights)
+            #: soft-target update
+            self.target_actor_updater.soft_update()
+            self.target_critic_updater.soft_update()
 
-        self.target_critic.set_weights(
-            (1 - self.TAU) * np.array(target_critic_weights)
-            + (self.TAU) * np.array(critic_weights))
+        return loss
 
     def save_model(self):
 
@@ -0,0 +1,232 @@
+import time
+
+import gym
+import numpy as np
+import tensorflow as tf
+
+from main import TRPOAgent
+from util import compute_logprob, compute_kl
+
+
+def legacy_cg(hvp_func, g, iters=25):
+    """フラット化前の共役勾配法 (比較用)
+    """
+
+    x = tf.zeros_like(g)
+    r = tf.identity(g)
+    p = tf.identity(r)
+    r_dot_r = tf.reduce_sum(r*r)
+
+    for _ in range(iters):
+        Ap = hvp_func(p)
+        v = r_dot_r / (tf.matmul(tf.transpose(p), Ap))
+        x += v*p
+        r -= v*Ap
+        new_r_dot_r = tf.reduce_sum(r*r)
+        mu = new_r_dot_r / r_dot_r
+        p = r + mu * p
+        r_dot_r = new_r_dot_r
+        if r_dot_r < 1e-10:
+            break
+
+    return x
+
+
+def legacy_restore_shape(flatvars, target_variables):
+    n = 0
+    weights = []
+    for var in target_variables:
+        size = var.shape[0] * var.shape[1] if len(var.shape) == 2 else var.shape[0]
+        tmp = flatvars[n:n+size].numpy().reshape(var.shape)
+        weights.append(tmp)
+        n += size
+
+    assert n == flatvars.shape[0]
+    return weights
+
+
+def legacy_fullstep(agent, states, actions, advantages):
+    """入れ子のGradientTapeによるHVPでのフルステップ計算 (比較用)
+    """
+
+    def flattengrads(grads):
+        flatgrads_list = [tf.reshape(grad, shape=[1, -1]) for grad in grads]
+        flatgrads = tf.concat(flatgrads_list, axis=1)
+        return flatgrads
+
+    old_means, old_stdevs = agent.policy(states)
+    old_logp = compute_logprob(old_means, old_stdevs, actions)
+
+    with tf.GradientTape() as tape:
+        new_means, new_stdevs = agent.policy(states)
+        new_logp = compute_logprob(new_means, new_stdevs, actions)
+
+        loss = tf.exp(new_logp - old_logp) * advantages
+        loss = tf.reduce_mean(loss)
+
+    g = tape.gradient(loss, agent.policy.trainable_variables)
+    g = tf.transpose(flattengrads(g))
+
+    @tf.function
+    def hvp_func(vector):
+        with tf.GradientTape() as t2:
+            with tf.GradientTape() as t1:
+                new_means, new_stdevs = agent.policy(states)
+                kl = compute_kl(old_means, old_stdevs, new_means, new_stdevs)
+                meankl = tf.reduce_mean(kl)
+
+            kl_grads = t1.gradient(meankl, agent.policy.trainable_variables)
+            kl_grads = flattengrads(kl_grads)
+            grads_vector_product = tf.matmul(kl_grads, vector)
+
+        hvp = t2.gradient(grads_vector_product, agent.policy.trainable_variables)
+        hvp = tf.transpose(flattengrads(hvp))
+
+        return hvp + vector * 1e-2
+
+    step_direction = legacy_cg(hvp_func, g)
+
+    shs = tf.matmul(tf.transpose(step_direction), hvp_func(step_direction))
+    lm = tf.sqrt(2 * agent.MAX_KL / shs)
+    fullstep = lm * step_direction
+
+    legacy_restore_shape(fullstep, agent.policy.trainable_variables)
+
+    return tf.reshape(fullstep, [-1])
+
+
+def legacy_line_search(agent, states, actions, advantages, fullstep,
+                       old_loss, old_means, old_stdevs, old_logp):
+    """numpyの重みをset_weightsしながら1候補ずつ評価する直線探索 (比較用)
+    """
+
+    fullstep = legacy_restore_shape(
+        tf.reshape(fullstep, [-1, 1]), agent.policy.trainable_variables)
+
+    params_old = [var.numpy() for var in agent.policy.trainable_variables]
+
+    for stepsize in [0.5 ** i for i in range(agent.BACKTRACK_STEPS)]:
+        params_new = [p + step * stepsize for p, step in zip(params_old, fullstep)]
+        agent.policy.set_weights(params_new)
+
+        new_means, new_stdevs = agent.policy(states)
+        new_logp = compute_logprob(new_means, new_stdevs, actions)
+
+        new_loss = tf.reduce_mean(tf.exp(new_logp - old_logp) * advantages)
+        improve = new_loss - old_loss
+
+        kl = compute_kl(old_means, old_stdevs, new_means, new_stdevs)
+        mean_kl = tf.reduce_mean(kl)
+
+        if mean_kl <= agent.MAX_KL * 1.5 and improve >= 0:
+            break
+    else:
+        agent.policy.set_weights(params_old)
+
+
+def legacy_collect(agent, env, n_steps):
+    """単一環境を1ステップずつ進める収集 (比較用)
+    """
+
+    state = env.reset()
+
+    for _ in range(n_steps):
+
+        action = agent.policy.sample_action(state)
+
+        next_state, reward, done, _ = env.step(action)
+
+        state = env.reset() if done else next_state
+
+
+def measure(func, n_iters):
+
+    #: 初回のtraceは計測から除く
+    func()
+
+    start = time.time()
+
+    for _ in range(n_iters):
+        result = func()
+
+    return (time.time() - start) / n_iters, result
+
+
+def benchmark_update(n_iters=20):
+
+    agent = TRPOAgent()
+
+    n = agent.TRAJECTORY_SIZE
+
+    states = tf.random.normal((n, agent.OBS_SPACE))
+    actions = tf.random.normal((n, agent.ACTION_SPACE))
+    advantages = tf.random.normal((n, 1))
+
+    legacy_time, legacy_step = measure(
+        lambda: legacy_fullstep(agent, states, actions, advantages), n_iters)
+
+    compiled_time, (fullstep, *_) = measure(
+        lambda: agent.compute_fullstep(states, actions, advantages), n_iters)
+
+    cosine = np.dot(legacy_step, fullstep) / (
+        np.linalg.norm(legacy_step) * np.linalg.norm(fullstep))
+
+    print("fullstep (gradient + CG)")
+    print(f"legacy:   {legacy_time * 1000:.1f} ms/iter")
+    print(f"compiled: {compiled_time * 1000:.1f} ms/iter")
+    print(f"speedup:  {legacy_time / compiled_time:.2f}x")
+    print(f"cosine similarity of fullsteps: {cosine:.4f}")
+
+    #: 全候補が棄却される最悪ケース (10候補すべてを評価) を比べるため逆向きのステップを使う
+    (fullstep, _, old_loss,
+     old_means, old_stdevs, old_logp) = agent.compute_fullstep(states, actions, advantages)
+
+    args = (states, actions, advantages, -fullstep,
+            old_loss, old_means, old_stdevs, old_logp)
+
+    legacy_time, _ = measure(lambda: legacy_line_search(agent, *args), n_iters)
+
+    batched_time, _ = measure(lambda: [t.numpy() for t in agent.line_search(*args)], n_iters)
+
+    print("line search (all candidates rejected)")
+    print(f"legacy:   {legacy_time * 1000:.1f} ms/iter")
+    print(f"batched:  {batched_time * 1000:.1f} ms/iter")
+    print(f"speedup:  {legacy_time / batched_time:.2f}x")
+
+
+def benchmark_collection(n_iters=3, n_envs=8):
+
+    n_steps = TRPOAgent.TRAJECTORY_SIZE
+
+    agent = TRPOAgent(n_envs=1)
+
+    env = gym.make(agent.ENV_ID)
+
+    legacy_time, _ = measure(lambda: legacy_collect(agent, env, n_steps), n_iters)
+
+    print(f"collection of {n_steps} steps")
+    print(f"{'single env':<20}{n_steps / legacy_time:.0f} steps/sec")
+
+    for use_subprocess in [False, True]:
+
+        agent = TRPOAgent(n_envs=n_envs, use_subprocess=use_subprocess)
+
+        agent.states = agent.vecenv.reset()
+
+        elapsed, _ = measure(agent.generate_trajectory, n_iters)
+
+        agent.vecenv.close()
+
+        name = f"{'SubProcVecEnv' if use_subprocess else 'VecEnv'} x{n_envs}"
+        print(f"{name:<20}{n_steps / elapsed:.0f} steps/sec ({legacy_time / elapsed:.2f}x)")
+
+
+def main():
+
+    benchmark_update()
+
+    benchmark_collection()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 import collections
 import os
+import time
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 
@@ -13,7 +14,8 @@ import matplotlib.pyplot as plt
 
 from buffer import ReplayBuffer
 from models import PolicyNetwork, ValueNetwork
-from util import compute_logprob, compute_kl, cg, restore_shape
+from env import VecEnv, SubProcVecEnv
+from util import compute_logprob, compute_kl, cg, compute_gae, FlatParams, gaussian_fvp
 
 
 class TRPOAgent:
@@ -24,6 +26,8 @@ class TRPOAgent:
 
     MAX_KL = 0.01
 
+    BACKTRACK_STEPS = 10
+
     GAMMA = 0.99
 
     GAE_LAMBDA = 0.98
@@ -34,13 +38,23 @@ class TRPOAgent:
 
     ACTION_SPACE = 1
 
-    def __init__(self):
+    def __init__(self, n_envs=8, use_subprocess=False):
+        """
+            n_envs個の環境を同時に進め、TRAJECTORY_SIZE // n_envsステップずつ集める
+        """
+
+        assert self.TRAJECTORY_SIZE % n_envs == 0
 
         self.policy = PolicyNetwork(action_space=self.ACTION_SPACE)
 
         self.value_network = ValueNetwork()
 
-        self.env = gym.make(self.ENV_ID)
+        self.n_envs = n_envs
+
+        if use_subprocess:
+            self.vecenv = SubProcVecEnv(self.ENV_ID, n_envs)
+        else:
+            self.vecenv = VecEnv(self.ENV_ID, n_envs)
 
         self.global_steps = 0
 
@@ -48,13 +62,19 @@ class TRPOAgent:
 
         self.hiscore = None
 
-    def play(self, n_iters):
+        self.policy_update_times = []
 
-        self.epi_reward = 0
+        self._init_network()
 
-        self.epi_steps = 0
+    def _init_network(self):
 
-        self.state = self.env.reset()
+        self.policy(np.zeros((1, self.OBS_SPACE), dtype=np.float32))
+
+        self.flat_params = FlatParams(self.policy.trainable_variables)
+
+    def play(self, n_iters):
+
+        self.states = self.vecenv.reset()
 
         for _ in range(n_iters):
 
@@ -70,48 +90,51 @@ class TRPOAgent:
 
     def generate_trajectory(self):
         """generate trajectory on current policy
+
+            n_envs個の環境を1回のforwardでまとめて進め、
+            各キーは環境ごとに連続した (n_envs * T, ...) の並びで返す
         """
 
-        trajectory = {"s": np.zeros((self.TRAJECTORY_SIZE, self.OBS_SPACE), dtype=np.float32),
-                      "a": np.zeros((self.TRAJECTORY_SIZE, self.ACTION_SPACE), dtype=np.float32),
-                      "r": np.zeros((self.TRAJECTORY_SIZE, 1), dtype=np.float32),
-                      "s2": np.zeros((self.TRAJECTORY_SIZE, self.OBS_SPACE), dtype=np.float32),
-                      "done": np.zeros((self.TRAJECTORY_SIZE, 1), dtype=np.float32)}
+        T = self.TRAJECTORY_SIZE // self.n_envs
 
-        state = self.state
+        trajectory = {"s": np.zeros((self.n_envs, T, self.OBS_SPACE), dtype=np.float32),
+                      "a": np.zeros((self.n_envs, T, self.ACTION_SPACE), dtype=np.float32),
+                      "r": np.zeros((self.n_envs, T, 1), dtype=np.float32),
+                      "s2": np.zeros((self.n_envs, T, self.OBS_SPACE), dtype=np.float32),
+                      "done": np.zeros((self.n_envs, T, 1), dtype=np.float32)}
 
-        for i in range(self.TRAJECTORY_SIZE):
+        states = self.states
 
-            action = self.policy.sample_action(state)
+        for i in range(T):
 
-            next_state, reward, done, _ = self.env.step(action)
+            actions = self.policy.sample_actions(states)
 
-            trajectory["s"][i] = state
+            results = self.vecenv.step(actions)
 
-            trajectory["a"][i] = action
+            trajectory["s"][:, i] = states
 
-            trajectory["r"][i] = reward
+            trajectory["a"][:, i] = actions
 
-            trajectory["s2"][i] = next_state
+            trajectory["r"][:, i, 0] = [result.reward for result in results]
 
-            trajectory["done"][i] = done
+            trajectory["s2"][:, i] = [result.next_state for result in results]
 
-            self.epi_reward += reward
+            trajectory["done"][:, i, 0] = [result.done for result in results]
 
-            self.epi_steps += 1
+            self.global_steps += self.n_envs
 
-            self.global_steps += 1
+            for result in results:
 
-            if done:
-                state = self.env.reset()
+                if result.episode_reward is None:
+                    continue
 
-                self.history.append(self.epi_reward)
+                self.history.append(result.episode_reward)
 
                 recent_score = sum(self.history[-10:]) / 10
 
                 print("===="*5)
                 print("Episode:", len(self.history))
-                print("Episode reward:", self.epi_reward)
+                print("Episode reward:", result.episode_reward)
                 print("Global steps:", self.global_steps)
 
                 if len(self.history) > 100 and (self.hiscore is None or recent_score > self.hiscore):
@@ -119,16 +142,11 @@ class TRPOAgent:
                     self.save_model()
                     self.hiscore = recent_score
 
-                self.epi_reward = 0
+            states = np.stack([result.state for result in results])
 
-                self.epi_steps = 0
+        self.states = states
 
-            else:
-                state = next_state
-
-        self.state = state
-
-        return trajectory
+        return {key: arr.reshape(self.TRAJECTORY_SIZE, -1) for key, arr in trajectory.items()}
 
     def compute_advantage(self, trajectory):
         """Compute
@@ -137,20 +155,23 @@ class TRPOAgent:
             trajectory ([type]): [description]
         """
 
-        trajectory["vpred"] = self.value_network(trajectory["s"]).numpy()
+        T = len(trajectory["r"])
 
-        trajectory["vpred_next"] = self.value_network(trajectory["s2"]).numpy()
+        #: s, s2をまとめて1回のforwardで評価する
+        values = self.value_network(
+            np.vstack([trajectory["s"], trajectory["s2"]])).numpy()
 
-        is_nonterminals = 1 - trajectory["done"]
+        trajectory["vpred"], trajectory["vpred_next"] = values[:T], values[T:]
 
-        deltas = trajectory["r"] + self.GAMMA * is_nonterminals * trajectory["vpred_next"] - trajectory["vpred"]
+        #: 環境ごとに連続した並びなので (n_envs, T // n_envs) に戻してGAEを計算する
+        shape = (self.n_envs, T // self.n_envs)
 
-        advantages = np.zeros_like(deltas, dtype=np.float32)
+        advantages, _ = compute_gae(
+            trajectory["r"].reshape(shape), trajectory["vpred"].reshape(shape),
+            trajectory["vpred_next"].reshape(shape), trajectory["done"].reshape(shape),
+            self.GAMMA, self.GAE_LAMBDA)
 
-        lastgae = 0
-        for i in reversed(range(len(deltas))):
-            lastgae = deltas[i] + self.GAMMA * self.GAE_LAMBDA * is_nonterminals[i] * lastgae
-            advantages[i] = lastgae
+        advantages = advantages.reshape(T, 1)
 
         trajectory["adv"] = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
         #trajectory["adv"] = advantages
@@ -159,17 +180,10 @@ class TRPOAgent:
 
         return trajectory
 
-    def update_policy(self, trajectory):
-
-        def flattengrads(grads):
-            flatgrads_list = [tf.reshape(grad, shape=[1, -1]) for grad in grads]
-            flatgrads = tf.concat(flatgrads_list, axis=1)
-            return flatgrads
-
-        actions = tf.convert_to_tensor(trajectory["a"], dtype=tf.float32)
-        states = tf.convert_to_tensor(trajectory["s"], dtype=tf.float32)
-        advantages = tf.convert_to_tensor(trajectory["adv"], dtype=tf.float32)
-
+    @tf.function
+    def compute_fullstep(self, states, actions, advantages):
+        """自然勾配方向のフルステップをFVPとCGを含めてグラフ内で計算する
+        """
         old_means, old_stdevs = self.policy(states)
         old_logp = compute_logprob(old_means, old_stdevs, actions)
 
@@ -180,66 +194,88 @@ class TRPOAgent:
             loss = tf.exp(new_logp - old_logp) * advantages
             loss = tf.reduce_mean(loss)
 
-        g = tape.gradient(loss, self.policy.trainable_variables)
-        g = tf.transpose(flattengrads(g))
-
-        @tf.function
-        def hvp_func(vector):
-            """Compute hessian-vector product
-            """
-            with tf.GradientTape() as t2:
-                with tf.GradientTape() as t1:
-                    new_means, new_stdevs = self.policy(states)
-                    kl = compute_kl(old_means, old_stdevs, new_means, new_stdevs)
-                    meankl = tf.reduce_mean(kl)
+        g = self.flat_params.flatten(
+            tape.gradient(loss, self.policy.trainable_variables))
 
-                kl_grads = t1.gradient(meankl, self.policy.trainable_variables)
-                kl_grads = flattengrads(kl_grads)
-                grads_vector_product = tf.matmul(kl_grads, vector)
+        def fvp_func(vector):
+            return gaussian_fvp(self.policy, self.flat_params, states, vector)
 
-            hvp = t2.gradient(grads_vector_product, self.policy.trainable_variables)
-            hvp = tf.transpose(flattengrads(hvp))
+        step_direction = cg(fvp_func, g)
 
-            return hvp + vector * 1e-2 #: 共役勾配法の安定化のために微小量を加える
-
-        step_direction = cg(hvp_func, g)
-
-        shs = tf.matmul(tf.transpose(step_direction), hvp_func(step_direction))
+        shs = tf.tensordot(step_direction, fvp_func(step_direction), 1)
         lm = tf.sqrt(2 * self.MAX_KL / shs)
         fullstep = lm * step_direction
 
-        expected_improve = tf.matmul(tf.transpose(g), fullstep)
-        fullstep = restore_shape(fullstep, self.policy.trainable_variables)
+        expected_improve = tf.tensordot(g, fullstep, 1)
+
+        return fullstep, expected_improve, loss, old_means, old_stdevs, old_logp
 
-        params_old = [var.numpy() for var in self.policy.trainable_variables]
-        old_loss = loss
+    def update_policy(self, trajectory):
 
-        for stepsize in [0.5 ** i for i in range(10)]:
-            params_new = [p + step * stepsize for p, step in zip(params_old, fullstep)]
-            self.policy.set_weights(params_new)
+        start = time.time()
 
-            new_means, new_stdevs = self.policy(states)
-            new_logp = compute_logprob(new_means, new_stdevs, actions)
+        actions = tf.convert_to_tensor(trajectory["a"], dtype=tf.float32)
+        states = tf.convert_to_tensor(trajectory["s"], dtype=tf.float32)
+        advantages = tf.convert_to_tensor(trajectory["adv"], dtype=tf.float32)
 
-            new_loss = tf.reduce_mean(tf.exp(new_logp - old_logp) * advantages)
-            improve = new_loss - old_loss
+        (fullstep, expected_improve, old_loss,
+         old_means, old_stdevs, old_logp) = self.compute_fullstep(states, actions, advantages)
 
-            kl = compute_kl(old_means, old_stdevs, new_means, new_stdevs)
-            mean_kl = tf.reduce_mean(kl)
+        accepted_idx, improves, mean_kls = self.line_search(
+            states, actions, advantages, fullstep,
+            old_loss, old_means, old_stdevs, old_logp)
 
-            print(f"Expected: {expected_improve} Actual: {improve}")
-            print(f"KL {mean_kl}")
+        #: ホストへの転送はログ用にここで1回だけ
+        accepted_idx = int(accepted_idx)
 
-            if mean_kl > self.MAX_KL * 1.5:
-                print("violated KL constraint. shrinking step.")
-            elif improve < 0:
-                print("surrogate didn't improve. shrinking step.")
-            else:
-                print("Stepsize OK!")
-                break
+        if accepted_idx >= 0:
+            print(f"Stepsize OK! ({0.5 ** accepted_idx})")
+            print(f"Expected: {expected_improve} Actual: {improves[accepted_idx]}")
+            print(f"KL {mean_kls[accepted_idx]}")
         else:
             print("更新に失敗")
-            self.policy.set_weights(params_old)
+
+        self.policy_update_times.append(time.time() - start)
+
+        print(f"Policy update: {self.policy_update_times[-1] * 1000:.1f} ms")
+
+    @tf.function
+    def line_search(self, states, actions, advantages, fullstep,
+                    old_loss, old_means, old_stdevs, old_logp):
+        """バックトラッキング直線探索
+
+            ステップ幅 0.5^i (i=0,...,BACKTRACK_STEPS-1) の全候補を
+            重みを積み重ねた1回のバッチ化forwardで評価し、
+            KL制約を満たしかつsurrogateが改善する最大のステップ幅を採用する
+            方策の変数の書き換えは採用時の1回のみ (候補なしなら何もしない)
+        """
+        stepsizes = 0.5 ** tf.range(self.BACKTRACK_STEPS, dtype=tf.float32)
+
+        params_old = self.flat_params.get_flat()
+
+        candidates = params_old[None, :] + stepsizes[:, None] * fullstep[None, :]
+
+        new_means, new_stdevs = self.policy.call_batched(
+            states, self.flat_params.unflatten_batch(candidates))
+
+        new_logp = compute_logprob(new_means, new_stdevs, actions)
+
+        new_loss = tf.reduce_mean(tf.exp(new_logp - old_logp) * advantages, axis=[1, 2])
+        improves = new_loss - old_loss
+
+        kl = compute_kl(old_means, old_stdevs, new_means, new_stdevs)
+        mean_kls = tf.reduce_mean(kl, axis=[1, 2])
+
+        is_accepted = tf.logical_and(mean_kls <= self.MAX_KL * 1.5, improves >= 0)
+
+        if tf.reduce_any(is_accepted):
+            #: 先頭のTrue = 最大のステップ幅
+            accepted_idx = tf.argmax(tf.cast(is_accepted, tf.int32), output_type=tf.int32)
+            self.flat_params.set_flat(candidates[accepted_idx])
+        else:
+            accepted_idx = tf.constant(-1, dtype=tf.int32)
+
+        return accepted_idx, improves, mean_kls
 
     def update_vf(self, trajectory):
 
@@ -34,6 +34,23 @@ class PolicyNetwork(tf.keras.Model):
 
         return mean, stdev
 
+    @tf.function
+    def call_batched(self, s, weights):
+        """K組の重み候補それぞれでの出力を1回のforwardで計算する (変数は書き換えない)
+
+            weights: trainable_variablesと同じ並びで、各要素の先頭次元がK
+            returns: (K, B, action_space)のmean, stdev
+        """
+        kernel1, bias1, kernel2, bias2, kernel_mean, bias_mean, kernel_logstd, bias_logstd = weights
+
+        x = tf.tanh(tf.einsum("bi,kio->kbo", s, kernel1) + bias1[:, None, :])
+        x = tf.tanh(tf.matmul(x, kernel2) + bias2[:, None, :])
+        mean = tf.matmul(x, kernel_mean) + bias_mean[:, None, :]
+        logstdev = tf.matmul(x, kernel_logstd) + bias_logstd[:, None, :]
+        stdev = tf.exp(logstdev)
+
+        return mean, stdev
+
     def sample_action(self, state):
 
         state = np.atleast_2d(state).astype(np.float32)
@@ -44,6 +61,18 @@ class PolicyNetwork(tf.keras.Model):
 
         return sampled_action.numpy()[0]
 
+    def sample_actions(self, states):
+        """ベクトル化環境用: N個の状態の行動を1回のforwardでサンプリングする
+        """
+
+        states = np.atleast_2d(states).astype(np.float32)
+
+        mean, stdev = self(states)
+
+        sampled_actions = mean + stdev * tf.random.normal(tf.shape(mean))
+
+        return sampled_actions.numpy()
+
 
 class ValueNetwork(tf.keras.Model):
 
@@ -8,7 +8,7 @@ def compute_logprob(means, stdevs, actions):
     logprob = - 0.5 * np.log(2*np.pi)
     logprob += - tf.math.log(stdevs)
     logprob += - 0.5 * tf.square((actions - means) / stdevs)
-    logprob = tf.reduce_sum(logprob, axis=1, keepdims=True)
+    logprob = tf.reduce_sum(logprob, axis=-1, keepdims=True)
     return logprob
 
 
@@ -22,43 +22,194 @@ def compute_kl(old_means, old_stdevs, new_means, new_stdevs):
     return kl
 
 
-def cg(hvp_func, g, iters=25):
+def cg(fvp_func, g, iters=25, residual_tol=1e-10):
     """
         Ax = b の近似解を共役勾配法で得る
         ※AがH, bがgに当たる
+        g, xはフラットな1次元ベクトルで、tf.function内で呼べばループごとグラフになる
     """
 
     x = tf.zeros_like(g)
     r = tf.identity(g)
     p = tf.identity(r)
-    r_dot_r = tf.reduce_sum(r*r)
+    r_dot_r = tf.tensordot(r, r, 1)
 
-    for _ in range(iters):
-        Ap = hvp_func(p)
-        v = r_dot_r / (tf.matmul(tf.transpose(p), Ap))
+    for _ in tf.range(iters):
+        Ap = fvp_func(p)
+        v = r_dot_r / tf.tensordot(p, Ap, 1)
         x += v*p
         r -= v*Ap
-        new_r_dot_r = tf.reduce_sum(r*r)
+        new_r_dot_r = tf.tensordot(r, r, 1)
         mu = new_r_dot_r / r_dot_r
         p = r + mu * p
         r_dot_r = new_r_dot_r
-        if r_dot_r < 1e-10:
+        if r_dot_r < residual_tol:
             break
 
     return x
 
 
-def restore_shape(flatvars, target_variables):
-    n = 0
-    weights = []
-    for var in target_variables:
-        size = var.shape[0] * var.shape[1] if len(var.shape) == 2 else var.shape[0]
-        tmp = flatvars[n:n+size].numpy().reshape(var.shape)
-        weights.append(tmp)
-        n += size
+class FlatParams:
+    """モデルの変数を1本のフラットなベクトルとして扱う
 
-    assert n == flatvars.shape[0]
-    return weights
+        各変数はベクトル上の[offset, offset+size)の区間に対応し、
+        分割と変形はtf.split/tf.reshapeなのでグラフ内でコピーなしのviewになる
+        (tf.Variable同士はメモリを共有できないので、書き戻しはassignで行う)
+    """
+
+    def __init__(self, variables):
+
+        self.variables = variables
+
+        self.shapes = [var.shape for var in variables]
+
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+
+        self.size = sum(self.sizes)
+
+    def flatten(self, tensors):
+
+        return tf.concat([tf.reshape(t, [-1]) for t in tensors], axis=0)
+
+    def unflatten(self, flat):
+
+        return [tf.reshape(t, shape) for t, shape
+                in zip(tf.split(flat, self.sizes), self.shapes)]
+
+    def unflatten_batch(self, flats):
+        """(K, size)のK個のパラメータ候補を、各変数の形に先頭次元Kを付けて分割する
+        """
+        return [tf.reshape(t, [-1] + shape.as_list()) for t, shape
+                in zip(tf.split(flats, self.sizes, axis=1), self.shapes)]
+
+    def get_flat(self):
+
+        return self.flatten(self.variables)
+
+    def set_flat(self, flat):
+
+        for var, value in zip(self.variables, self.unflatten(flat)):
+            var.assign(value)
+
+
+def gaussian_fvp(policy, flat_params, states, vector, damping=1e-2):
+    """対角ガウス方策のFisher-vector product (解析解)
+
+        mean KLの(μ, σ)に関するヘッセ行列は旧方策の位置で
+        M = diag(1/σ^2, 2/σ^2) なので F = J^T M J / N となる
+        KLの二階微分は使わず、Jのvector積とJ^Tのvector積だけで計算する
+        Jvは線形写像 u -> J^T u をもう一度微分して得る (double-vjp)
+        ※ForwardAccumulatorはtf.function化されたpolicy.call内の変数を追跡できないため
+    """
+    variables = flat_params.variables
+
+    with tf.GradientTape(persistent=True) as tape:
+        means, stdevs = policy(states)
+
+    u_means, u_stdevs = tf.zeros_like(means), tf.zeros_like(stdevs)
+
+    with tf.GradientTape() as t2:
+        t2.watch([u_means, u_stdevs])
+        jtu = tape.gradient([means, stdevs], variables,
+                            output_gradients=[u_means, u_stdevs])
+        jtu_v = tf.tensordot(flat_params.flatten(jtu), vector, 1)
+
+    jvp_means, jvp_stdevs = t2.gradient(jtu_v, [u_means, u_stdevs])
+
+    inv_var = 1. / tf.square(stdevs)
+
+    n = tf.cast(tf.size(means), tf.float32)
+
+    fvp = tape.gradient([means, stdevs], variables,
+                        output_gradients=[jvp_means * inv_var / n,
+                                          2. * jvp_stdevs * inv_var / n])
+
+    del tape
+
+    fvp = flat_params.flatten(fvp)
+
+    return fvp + vector * damping #: 共役勾配法の安定化のために微小量を加える
+
+
+def discounted_cumsum(x, discounts, initial=None):
+    """y[:, t] = x[:, t] + discounts[:, t] * y[:, t+1] を時間方向に逆順で計算する (pure NumPy)
+
+        x, discounts: (n_envs, T)
+        initial: (n_envs,) y[:, T]に相当するbootstrap値, Noneなら0
+        pythonのループは時間方向のみで、env方向はまとめて計算する
+    """
+    n_envs, T = x.shape
+
+    y = np.zeros((n_envs, T), dtype=np.float32)
+
+    last = np.zeros(n_envs, dtype=np.float32) if initial is None else initial
+
+    for t in reversed(range(T)):
+        last = x[:, t] + discounts[:, t] * last
+        y[:, t] = last
+
+    return y
+
+
+@tf.function
+def discounted_cumsum_tf(x, discounts, initial):
+    """discounted_cumsumのtf.scan版 (グラフ内で完結させたいとき用)
+    """
+    #: (n_envs, T) -> (T, n_envs)
+    elems = (tf.transpose(x), tf.transpose(discounts))
+
+    y = tf.scan(lambda acc, elem: elem[0] + elem[1] * acc,
+                elems, initializer=initial, reverse=True)
+
+    return tf.transpose(y)
+
+
+def _discounted_cumsum(x, discounts, initial, use_tf):
+
+    x = x.astype(np.float32)
+
+    discounts = discounts.astype(np.float32)
+
+    if initial is None:
+        initial = np.zeros(x.shape[0], dtype=np.float32)
+    else:
+        initial = np.asarray(initial, dtype=np.float32).reshape(x.shape[0])
+
+    if use_tf:
+        return discounted_cumsum_tf(x, discounts, initial).numpy()
+    else:
+        return discounted_cumsum(x, discounts, initial)
+
+
+def compute_gae(rewards, values, next_values, dones, gamma, lam, use_tf=False):
+    """Generalized Advantage Estimation (GAE, 2016)
+
+        入力はすべて (n_envs, T)
+        戻り値はadvantageと価値関数のターゲット (advantage + value)
+    """
+    is_nonterminals = 1 - np.asarray(dones, dtype=np.float32)
+
+    deltas = rewards + gamma * is_nonterminals * next_values - values
+
+    advantages = _discounted_cumsum(
+        deltas, gamma * lam * is_nonterminals, None, use_tf)
+
+    return advantages, advantages + values
+
+
+def compute_returns(rewards, dones, gamma, last_values=None, use_tf=False):
+    """doneで打ち切る割引報酬和
+
+        rewards, dones: (n_envs, T)
+        last_values: (n_envs,) 最終ステップの次状態の価値でbootstrapする
+    """
+    is_nonterminals = 1 - np.asarray(dones, dtype=np.float32)
+
+    if last_values is not None:
+        last_values = np.asarray(last_values).reshape(-1)
+
+    return _discounted_cumsum(
+        rewards, gamma * is_nonterminals, last_values, use_tf)
 
 
 def main():